@@ -0,0 +1,269 @@
+"""
+BLACKSALT BENCHMARKS
+Builds synthetic rulesets shaped like firewall.py and records the wall time,
+peak RSS, RSS added and allocated objects of each phase of the deploy path,
+as JSON that can be compared between commits.
+
+    python benchmark.py                              # 1k, 10k, 100k and 1M rules
+    python benchmark.py --sizes 1000,10000 --output before.json
+    python benchmark.py --compare before.json --output after.json
+
+Each size runs in its own process, so the peak RSS of one doesn't carry
+over to the next, and the peak is reset before each phase on Linux so it's
+the phase's own. With --compare and no --output the JSON goes to stdout and
+the comparison to stderr. Python 2 has no tracemalloc, the allocations are counted
+as the objects the garbage collector tracks after each phase.
+"""
+
+import gc
+import json
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from functools import partial
+from optparse import SUPPRESS_HELP, OptionParser
+
+from blacksalt import BlackSalt, Rule, __version__
+
+SIZES = [1000, 10000, 100000, 1000000]
+PHASES = ["setrule", "set_subnet", "Rule.generate", "generate"]
+MEASURES = ["seconds", "peak_rss_kb", "rss_kb", "objects"]
+THRESHOLD = 1.10  # A phase this many times slower, or bigger, than before is a regression
+
+#: The rules of firewall.py, one subnet per rule so no two rules are the same
+SHAPES = [
+    {"chain": "input", "interface": {"direction": "in", "name": "eth0"}, "target": "accept",
+     "state": "new, related, established"},
+    {"chain": "output", "interface": {"direction": "out", "name": "eth0"}, "target": "accept",
+     "state": "new, related, established"},
+    {"chain": "input", "interface": {"direction": "in", "name": "eth0"}, "target": "accept",
+     "state": "new, related, established", "icmp": 8},
+    {"chain": "input", "interface": {"direction": "in", "name": "eth0"}, "dst": "80",
+     "state": "new, established, related", "target": "accept"},
+    {"chain": "input", "interface": {"direction": "in", "name": "eth0"}, "state": "new", "target": "drop"},
+]
+
+
+#########
+# RULES #
+#########
+def subnet(index):
+    """
+    @summary: A distinct /24 for each rule, 10.0.0.0/24, 10.0.1.0/24 ...
+    @rtype: str
+    """
+    return "%d.%d.%d.0/24" % (10 + (index >> 16) % 200, (index >> 8) & 0xFF, index & 0xFF)
+
+
+def build(size, rulestore="list"):
+    """
+    @summary: A BlackSalt instance with size rules shaped like firewall.py
+    @rtype: BlackSalt
+    """
+    _blacksalt = BlackSalt(printmode=False, rulestore=rulestore)
+    _blacksalt.setmodule(["ip_conntrack", "ip_conntrack_ftp"])
+    _blacksalt.flush()
+    _blacksalt.policy([("input", "drop"), ("output", "accept"), ("forward", "drop")])
+    for _index in xrange(size):
+        _blacksalt.setrule(subnet=subnet(_index), **SHAPES[_index % len(SHAPES)])
+    return _blacksalt
+
+
+def validate(subnets):
+    """
+    @summary: Validate each subnet as Rule.set_subnet() would for a new rule
+    @rtype: None
+    """
+    _rule = Rule()
+    for _subnet in subnets:
+        _rule.set_subnet(_subnet)
+
+
+###########
+# MEASURE #
+###########
+def measure(phase, function, results):
+    """
+    @summary: Run a phase and record its wall time, how far its peak RSS
+              rose above the RSS it started with, the RSS it left added and
+              the change in tracked objects. The peak is reset before the
+              phase where the kernel allows it (Linux, /proc/self/clear_refs),
+              elsewhere it's how far the phase raised the process's peak.
+    @rtype: the function's return value
+    """
+    gc.collect()
+    _objects = len(gc.get_objects())
+    _rss, _peak = rss()
+    if resetpeak():
+        _peak = _rss
+    _start = time.time()
+    _value = function()
+    _seconds = time.time() - _start
+    _newrss, _newpeak = rss()
+    results[phase] = {
+        "seconds": round(_seconds, 4),
+        "peak_rss_kb": _newpeak - _peak,
+        "rss_kb": _newrss - _rss,
+        "objects": len(gc.get_objects()) - _objects,
+    }
+    return _value
+
+
+def rss():
+    """
+    @summary: The current and peak RSS of this process, from
+              /proc/self/status, or the peak for both without /proc
+    @rtype: (int, int) kB
+    """
+    try:
+        with open("/proc/self/status") as _status:
+            _fields = dict(_line.split(":", 1) for _line in _status if ":" in _line)
+        return int(_fields["VmRSS"].split()[0]), int(_fields["VmHWM"].split()[0])
+    except (IOError, KeyError, ValueError):
+        _peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return _peak, _peak
+
+
+def resetpeak():
+    """
+    @summary: Reset the peak RSS of this process to its current RSS
+    @rtype: bool, False where the kernel doesn't allow it
+    """
+    try:
+        with open("/proc/self/clear_refs", "w") as _clear:
+            _clear.write("5")
+        return True
+    except (IOError, OSError):
+        return False
+
+
+def run(size, rulestore):
+    """
+    @summary: Benchmark every phase for one ruleset size in this process
+    @rtype: dict {phase: {"seconds", "peak_rss_kb", "rss_kb", "objects"}}
+    """
+    _results = {}
+    _blacksalt = measure("setrule", lambda: build(size, rulestore), _results)
+
+    _subnets = [subnet(_index) for _index in xrange(size)]
+    measure("set_subnet", partial(validate, _subnets), _results)
+    del _subnets
+
+    measure("Rule.generate", lambda: sum(1 for _entry in _blacksalt.rules if isinstance(_entry, Rule)
+                                         and _entry.generate()), _results)
+
+    _directory = tempfile.mkdtemp()
+    try:
+        _blacksalt.scriptfile = os.path.join(_directory, "firewall.sh")
+        _blacksalt.overwrite = "always"
+        measure("generate", _blacksalt.generate, _results)
+    finally:
+        shutil.rmtree(_directory)
+    return _results
+
+
+def suite(sizes, rulestore):
+    """
+    @summary: Benchmark each size in its own process
+    @rtype: dict, the JSON document written by main()
+    """
+    _results = {}
+    for _size in sizes:
+        _output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--run", str(_size),
+                                           "--rulestore", rulestore])
+        _results[str(_size)] = json.loads(_output)
+        print >> sys.stderr, "%8d rules: %s" % (_size, ", ".join("%s %.3fs" % (_phase, _results[str(_size)][_phase]
+                                                                              ["seconds"]) for _phase in PHASES))
+    return {
+        "commit": commit(),
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "rulestore": rulestore,
+        "results": _results,
+    }
+
+
+def commit():
+    """
+    @summary: The git commit being benchmarked, None outside a checkout
+    @rtype: str
+    """
+    try:
+        with open(os.devnull, "w") as _devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"], stderr=_devnull,
+                                           cwd=os.path.dirname(os.path.abspath(__file__))).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+###########
+# COMPARE #
+###########
+def compare(before, after, threshold=THRESHOLD, output=sys.stdout):
+    """
+    @summary: Compare two benchmark documents phase by phase, printing the
+              ratio of after to before for each measure to output
+    @rtype: list of str, the regressions past the threshold
+    """
+    _regressions = []
+    print >> output, "%-9s %-14s %14s %14s %14s %14s" % ("rules", "phase", "seconds", "peak_rss_kb", "rss_kb",
+                                                         "objects")
+    for _size in sorted(set(before["results"]) & set(after["results"]), key=int):
+        for _phase in PHASES:
+            _old = before["results"][_size].get(_phase)
+            _new = after["results"][_size].get(_phase)
+            if not _old or not _new:
+                continue
+            _ratios = []
+            for _measure in MEASURES:
+                #: Results from before rss_kb was recorded don't have it
+                _ratio = float(_new[_measure]) / _old[_measure] if _old.get(_measure) and _measure in _new else None
+                _ratios.append("%.2fx" % _ratio if _ratio is not None else "-")
+                if _ratio is not None and _ratio > threshold and _measure != "objects":
+                    _regressions.append("%s rules %s %s %.2fx" % (_size, _phase, _measure, _ratio))
+            print >> output, "%-9s %-14s %14s %14s %14s %14s" % tuple([_size, _phase] + _ratios)
+    return _regressions
+
+
+def main():
+    _parser = OptionParser(usage="%prog [--sizes 1000,10000] [--output FILE] [--compare FILE]")
+    _parser.add_option("--sizes", default=",".join(str(_size) for _size in SIZES),
+                       help="comma separated ruleset sizes [%default]")
+    _parser.add_option("--rulestore", default="list", help="BlackSalt rulestore, list or table [%default]")
+    _parser.add_option("--output", help="write the results here as JSON, otherwise stdout")
+    _parser.add_option("--compare", help="compare against an earlier results file, exit 1 on a regression")
+    _parser.add_option("--threshold", type="float", default=THRESHOLD,
+                       help="ratio past which a slower or bigger phase is a regression [%default]")
+    _parser.add_option("--run", type="int", help=SUPPRESS_HELP)
+    _options, _args = _parser.parse_args()
+
+    if _options.run is not None:
+        json.dump(run(_options.run, _options.rulestore), sys.stdout)
+        return 0
+
+    _results = suite([int(_size) for _size in _options.sizes.split(",")], _options.rulestore)
+    if _options.output:
+        with open(_options.output, "w") as _output:
+            json.dump(_results, _output, indent=2, sort_keys=True)
+    else:
+        json.dump(_results, sys.stdout, indent=2, sort_keys=True)
+        print
+    if _options.compare:
+        #: Without --output stdout is the JSON, the comparison goes to stderr
+        _output = sys.stdout if _options.output else sys.stderr
+        with open(_options.compare) as _before:
+            _regressions = compare(json.load(_before), _results, _options.threshold, _output)
+        for _regression in _regressions:
+            print >> _output, "Regression: %s" % _regression
+        return 1 if _regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -8,8 +8,35 @@ The MIT License (MIT)
 Copyright (c) 2013 Leslie.A.Cordell
 """
 
+import csv
+import functools
+import gc
+import hashlib
+import heapq
+import itertools
+import json
+import math
+import multiprocessing
 import os
 import re
+import shlex
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+import traceback
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import OrderedDict
+from cStringIO import StringIO
+from difflib import SequenceMatcher
+try:
+    import numpy  # Optional, only BlackSalt.simulate() and loadflows() need it
+except ImportError:
+    numpy = None
 __version__ = "0.2.1"
 
 
@@ -24,6 +51,662 @@ class IPTablesError(Exception):
     pass
 
 
+############
+# BACKENDS #
+############
+#: iptables  - a shell script with one iptables command per rule
+#: restore   - an iptables-restore file, loaded in one atomic call
+#: nft       - an nft -f ruleset for nftables, loaded as one transaction
+BACKENDS = ["iptables", "restore", "nft"]
+BUILTIN_CHAINS = ["INPUT", "FORWARD", "OUTPUT"]
+
+
+###############
+# RULE STORES #
+###############
+#: list     - a plain list of Rule instances and strings
+#: table    - a RuleTable, the rules are stored column-wise in arrays
+#: indexed  - a RuleIndex, the rules have stable ids and are indexed for query()
+RULESTORES = ["list", "table", "indexed"]
+
+
+##########
+# OUTPUT #
+##########
+#: What generate() does when the scriptfile already exists
+#: prompt  - ask whether to overwrite it
+#: always  - overwrite it
+#: never   - leave it and skip writing the scriptfile
+#: error   - raise an IPTablesError
+OVERWRITE = ["prompt", "always", "never", "error"]
+BUFSIZE = 1 << 20  # Bytes of output buffered by BlackSalt.write() between writes
+CACHESIZE = 64 << 20  # Bytes of rendered output a CompileCache keeps before evicting
+
+
+###########
+# HELPERS #
+###########
+#: Subnet forms, kept so a packed subnet is written back the way it was given
+SUBNET_ADDRESS = 0  # i.e. 172.16.10.23
+SUBNET_CIDR = 1  # i.e. 172.16.10.0/24
+SUBNET_NETMASK = 2  # i.e. 172.16.10.0/255.255.255.0
+
+#: Interned state tuples, rules with the same states share one tuple
+_STATES = {}
+
+
+def _intern(value):
+    """
+    Intern a string so rules with the same chain, target etc. share it
+    """
+    if type(value) == str:
+        return intern(value)
+    return value
+
+
+def _packaddr(address):
+    """
+    Pack a dotted address into an int, i.e. 10.0.0.1 -> 167772161
+    """
+    return struct.unpack("!I", socket.inet_aton(address))[0]
+
+
+def _unpackaddr(address):
+    """
+    Unpack an int into a dotted address, i.e. 167772161 -> 10.0.0.1
+    """
+    return socket.inet_ntoa(struct.pack("!I", address))
+
+
+def _writelines(target, lines, bufsize=BUFSIZE):
+    """
+    Write lines to a file-like object or file descriptor through one buffer
+    of bufsize bytes, returning the number of lines written
+    """
+    if type(target) in [int, long]:
+        _write = lambda data: _writefd(target, data)
+    else:
+        _write = target.write
+
+    _buffer = []
+    _size = 0
+    _count = 0
+    for _line in lines:
+        _buffer.append(_line)
+        _size += len(_line) + 1
+        _count += 1
+        if _size >= bufsize:
+            _buffer.append("")
+            _write("\n".join(_buffer))
+            _buffer = []
+            _size = 0
+    if _buffer:
+        _buffer.append("")
+        _write("\n".join(_buffer))
+    if hasattr(target, "flush"):
+        target.flush()
+    return _count
+
+
+def _writefd(fd, data):
+    """
+    Write all of data to a file descriptor, os.write may only write part of it
+    """
+    while data:
+        data = data[os.write(fd, data):]
+
+
+def _canonical(spec):
+    """
+    Reduce a rule spec to a form that compares equal however it was written;
+    iptables-save reorders options, adds implicit -m tcp/udp/icmp matches,
+    writes addresses as a masked network and prefix length without /32 and
+    sorts states differently to BlackSalt.
+    """
+    _tokens = spec.split()
+    _options = []
+    _protocol = None
+    _index = 0
+    while _index < len(_tokens):
+        _option = _tokens[_index]
+        _values = []
+        _index += 1
+        #: A negation belongs to the option after it
+        if _option == "!" and _index < len(_tokens):
+            _option = "! %s" % _tokens[_index]
+            _index += 1
+        while _index < len(_tokens) and _tokens[_index] != "!" and not _tokens[_index].startswith("-"):
+            _values.append(_tokens[_index])
+            _index += 1
+        if _option in ["-p", "--protocol"] and _values:
+            _protocol = _values[0]
+        if _option in ["-s", "--source", "-d", "--destination"] and _values:
+            _values = [_canonicalsubnet(_values[0])]
+        if _option == "--state" and _values:
+            _values = [",".join(sorted(_values[0].split(",")))]
+        _options.append((_option, tuple(_values)))
+    #: An implicit match module is the one named by -p
+    _options = [_opt for _opt in _options if not (_opt[0] == "-m" and _opt[1] == (_protocol,))]
+    _jump = [_opt for _opt in _options if _opt[0] in ["-j", "--jump"]]
+    _options = sorted(_opt for _opt in _options if _opt[0] not in ["-j", "--jump"])
+    return " ".join("%s %s" % (_opt, " ".join(_values)) for _opt, _values in _options + _jump)
+
+
+def _canonicalsubnet(subnet):
+    """
+    A subnet as iptables-save prints it, i.e. 10.1.0.5/255.255.255.0 ->
+    10.1.0.0/24; a mask that isn't a plain prefix stays dotted, anything
+    that isn't a subnet, i.e. a hostname, is left as it is
+    """
+    try:
+        _network, _mask, _form = parsesubnet(subnet)
+    except RuleError:
+        return subnet
+    _address = _unpackaddr(_network & _mask)
+    if _mask == 0xFFFFFFFF:
+        return _address
+    if _contiguous(_mask):
+        return "%s/%d" % (_address, _masklen(_mask))
+    return "%s/%s" % (_address, _unpackaddr(_mask))
+
+
+def _diffchain(chain, old, new):
+    """
+    The -R/-I/-D operations that turn the old list of rule specs into the new
+    one for a chain. Positions are 1-based and correct at the time each
+    operation runs; after each opcode the start of the chain matches new[:j2].
+    """
+    _ops = []
+    _matcher = SequenceMatcher(None, [_canonical(_spec) for _spec in old],
+                               [_canonical(_spec) for _spec in new], autojunk=False)
+    for _tag, _i1, _i2, _j1, _j2 in _matcher.get_opcodes():
+        if _tag == "equal":
+            continue
+        _replace = min(_i2 - _i1, _j2 - _j1) if _tag == "replace" else 0
+        for _offset in range(_replace):
+            _ops.append("-R %s %d %s" % (chain, _j1 + _offset + 1, new[_j1 + _offset]))
+        for _offset in range(_i2 - _i1 - _replace):
+            _ops.append("-D %s %d" % (chain, _j1 + _replace + 1))
+        for _offset in range(_replace, _j2 - _j1):
+            _ops.append("-I %s %d %s" % (chain, _j1 + _offset + 1, new[_j1 + _offset]))
+    return _ops
+
+
+def _masklen(mask):
+    """
+    The number of bits set in a packed mask, i.e. 4294967040 -> 24
+    """
+    return bin(mask).count("1")
+
+
+def _prefixmask(length):
+    """
+    The packed mask for a prefix length, i.e. 24 -> 4294967040
+    """
+    return (0xFFFFFFFF << (32 - length)) & 0xFFFFFFFF
+
+
+def _contiguous(mask):
+    """
+    Whether a packed mask is a plain prefix, i.e. 255.255.255.0 but not 255.0.255.0
+    """
+    return mask == _prefixmask(_masklen(mask))
+
+
+#: Octets and prefix lengths by their text, so parsing is a dict lookup and
+#: anything out of range, or with leading zeros, simply isn't found
+_OCTETS = dict((str(_octet), _octet) for _octet in range(256))
+_PREFIXES = dict((str(_length), _prefixmask(_length)) for _length in range(33))
+
+
+def parsesubnet(subnet):
+    """
+    @summary: Parse an address, CIDR or address/netmask into a packed network
+              and mask, and the form it was given in, i.e. 172.16.10.23,
+              172.16.10.0/24 or 172.16.10.0/255.255.255.0. Octets are 0-255
+              and prefix lengths 0-32.
+    @rtype: tuple (network, mask, SUBNET_ADDRESS, SUBNET_CIDR or SUBNET_NETMASK)
+    @param subnet: str
+    """
+    _address, _sep, _mask = subnet.partition("/")
+    _octets = _address.split(".")
+    if len(_octets) == 4 and _octets[0] in _OCTETS and _octets[1] in _OCTETS and _octets[2] in _OCTETS \
+            and _octets[3] in _OCTETS:
+        _network = (_OCTETS[_octets[0]] << 24) | (_OCTETS[_octets[1]] << 16) | (_OCTETS[_octets[2]] << 8) \
+            | _OCTETS[_octets[3]]
+        if not _sep:
+            return _network, 0xFFFFFFFF, SUBNET_ADDRESS
+        if _mask in _PREFIXES:
+            return _network, _PREFIXES[_mask], SUBNET_CIDR
+        _netmask = _parseaddr(_mask)
+        if _netmask is not None:
+            return _network, _netmask, SUBNET_NETMASK
+    raise RuleError("""Subnet must match one of the following forms:
+            0-255.0-255.0-255.0-255    i.e. 172.16.10.23
+            0-255.0-255.0-255.0-255/0-32   i.e. 172.16.10.0/24
+            0-255.0-255.0-255.0-255/0-255.0-255.0-255.0-255    i.e 172.16.10.0/255.255.255.0""")
+
+
+def _parseaddr(address):
+    """
+    Pack a dotted address into an int, None if it isn't four 0-255 octets
+    """
+    try:
+        _first, _second, _third, _fourth = address.split(".")
+        return (_OCTETS[_first] << 24) | (_OCTETS[_second] << 16) | (_OCTETS[_third] << 8) | _OCTETS[_fourth]
+    except (KeyError, ValueError):
+        return None
+
+
+def _parsetarget(target):
+    """
+    The interned target for Rule.set_target(), and a warning for a non
+    default target or None
+    """
+    _default = ["ACCEPT", "DROP", "QUEUE", "RETURN"]
+    _extensions = ["LOG", "NFLOG", "REJECT", "MARK", "CONNMARK", "NOTRACK", "SET", "TCPMSS"]
+    if target.upper() in _default:
+        return intern(target.upper()), None
+    if target.split(" ", 1)[0].upper() in _extensions:
+        _target = target.split(" ", 1)
+        target = " ".join([_target[0].upper()] + _target[1:])
+    return intern(target), "Using a non default target %s" % target
+
+
+def _parseport(port, option):
+    """
+    Check a port, an int or a string of one, is 0-65535, None is no port
+    """
+    if port is None:
+        return None
+    if type(port) == str and port.isdigit():
+        port = int(port)
+    if type(port) == int and 0 <= port <= 65535:
+        return port
+    raise RuleError("%s option must be an integer or integer string from 0-65535, or None" % option)
+
+
+def _subnetkey(rule):
+    """
+    Everything a rule matches on and does apart from its subnet, rules with
+    the same key only differ in which addresses they match
+    """
+    return (rule.chain, rule.target, rule.protocol, rule._ifname, rule._ifdir, rule.dst_port,
+            rule.src_port, rule._state, rule.icmp, rule.extra)
+
+
+def _subnetruns(rules):
+    """
+    The runs of rules, as lists of indexes into rules, that follow each other
+    in their chain and differ only in their subnet. Flush and policy entries
+    end every run, a rule without a subnet, or with a mask that isn't a plain
+    prefix, ends the run in its chain. A packet carries on past a rule with a
+    target that isn't a verdict, i.e. LOG or a jump to a chain that returns,
+    so the subnets of such a run must not overlap; one that overlaps an
+    earlier subnet starts a new run.
+    """
+    _groups = []
+    _runs = {}  # chain -> (key, [indexes], [(network, mask)] or None if terminal) of the run still open
+
+    for _index, _rule in enumerate(rules):
+        if not isinstance(_rule, Rule):
+            _groups.extend(_run[1] for _run in _runs.itervalues())
+            _runs = {}
+            continue
+        _key = None
+        if _rule._network is not None and _contiguous(_rule._mask):
+            _key = _subnetkey(_rule)
+        _run = _runs.get(_rule.chain)
+        if _key is not None and _run and _run[0] == _key:
+            if _run[2] is None:
+                _run[1].append(_index)
+                continue
+            _network, _mask = _rule._network, _rule._mask
+            if all((_network ^ _other) & _mask & _othermask for _other, _othermask in _run[2]):
+                _run[1].append(_index)
+                _run[2].append((_network, _mask))
+                continue
+        if _run:
+            _groups.append(_run[1])
+        if _key is None:
+            _runs.pop(_rule.chain, None)
+        else:
+            _terminal = (_rule.target or "").split(" ", 1)[0] in TERMINAL_TARGETS
+            _runs[_rule.chain] = (_key, [_index], None if _terminal else [(_rule._network, _rule._mask)])
+    _groups.extend(_run[1] for _run in _runs.itervalues())
+    return _groups
+
+
+def _collapse(subnets):
+    """
+    Collapse (network, mask) pairs with contiguous masks into the fewest
+    CIDR blocks covering exactly the same addresses, as (network, length)
+    """
+    #: Merge the address ranges where they overlap or touch
+    _ranges = []
+    for _start, _end in sorted((_net & _mask, (_net & _mask) | (~_mask & 0xFFFFFFFF))
+                               for _net, _mask in subnets):
+        if _ranges and _start <= _ranges[-1][1] + 1:
+            _ranges[-1][1] = max(_ranges[-1][1], _end)
+        else:
+            _ranges.append([_start, _end])
+
+    #: Split each range into the largest aligned blocks that fit
+    _blocks = []
+    for _start, _end in _ranges:
+        while _start <= _end:
+            _size = _start & -_start if _start else 1 << 32
+            while _size > _end - _start + 1:
+                _size >>= 1
+            _blocks.append((_start, 33 - len(bin(_size)) + 2))
+            _start += _size
+    return _blocks
+
+
+#####################
+# PROTOCOL REGISTRY #
+#####################
+class ProtocolRegistry(object):
+    """
+    A process wide registry of the protocols a rule may use. The protocols
+    file is parsed once into a set of names and a dict of numbers, and only
+    read again when its mtime changes, so building a rule doesn't depend on
+    the size of the protocols file.
+    """
+    defaults = ("tcp", "udp", "icmp", "all")  # Always allowed, with or without a protocols file
+
+    def __init__(self, protocolsfile="/etc/protocols", interval=1.0):
+        self.protocolsfile = protocolsfile
+        self.interval = interval  # Seconds between checks of the protocols file mtime
+        self.names = frozenset(self.defaults)
+        self.numbers = {}  # i.e. {"6": "tcp"}
+        self._mtime = None
+        self._checked = None
+
+    def __contains__(self, opts):
+        return self.lookup(opts) is not None
+
+    def __iter__(self):
+        self.refresh()
+        return iter(sorted(self.names))
+
+    def __len__(self):
+        self.refresh()
+        return len(self.names)
+
+    ###########
+    # REFRESH #
+    ###########
+    def refresh(self, force=False):
+        """
+        @summary: Reload the protocols file if its mtime has changed, the
+                  mtime is checked at most once per interval unless forced.
+        @rtype: None
+        @param force: bool
+        """
+        _now = time.time()
+        if not force and self._checked is not None and _now - self._checked < self.interval:
+            return
+        self._checked = _now
+        try:
+            _mtime = os.stat(self.protocolsfile).st_mtime
+        except OSError:
+            _mtime = None
+        if force or _mtime != self._mtime:
+            self._mtime = _mtime
+            self.load()
+
+    ########
+    # LOAD #
+    ########
+    def load(self):
+        """
+        @summary: Parse the protocols file, each line is in the form
+                  "name number aliases... # comment", names and aliases are
+                  allowed protocols, numbers map back to their name.
+        @rtype: None
+        @param: None
+        """
+        _names = set(self.defaults)
+        _numbers = {}
+        try:
+            _protocolsfile = open(self.protocolsfile, "r")
+        except IOError:
+            self.names = frozenset(_names)
+            self.numbers = _numbers
+            return
+        for _line in _protocolsfile:
+            _fields = _line.split("#", 1)[0].split()
+            if len(_fields) < 2:
+                continue
+            _names.update(_fields[:1] + _fields[2:])
+            _numbers.setdefault(_fields[1], _fields[0])
+        _protocolsfile.close()
+        self.names = frozenset(_names)
+        self.numbers = _numbers
+
+    ##########
+    # LOOKUP #
+    ##########
+    def lookup(self, opts):
+        """
+        @summary: Look up a protocol by name or number, returning the
+                  protocol as it should be written in a rule or None if
+                  the protocol isn't known.
+        @rtype: str or None
+        @param opts: str or int
+        """
+        self.refresh()
+        if type(opts) == int:
+            opts = str(opts)
+        if opts in self.names:
+            return opts
+        if opts in self.numbers:
+            return opts
+        return None
+
+
+PROTOCOLS = ProtocolRegistry()
+
+
+###########
+# PROFILE #
+###########
+class Profiler(object):
+    """
+    Instrumentation for a BlackSalt instance, BlackSalt(profiler=Profiler()).
+    Each phase of a deploy, i.e. setrule, generate and its render and write,
+    diff, apply and the optimisation passes, is timed, and rules, warnings,
+    errors, lines and operations are counted. With sample=N every Nth rule
+    added with setrule() is built one setter at a time, so the validation
+    cost of each setter is known without timing every rule. Hooks are called
+    as hook(event, data) at the end of each phase, event "phase" with data
+    {"phase", "seconds"}, and for each sampled rule, event "sample" with data
+    {"rule", "seconds", "setters"}. Without a profiler an instance only
+    checks it has none once per call.
+    """
+    slowest = 10  # Sampled rules kept in the stats, the slowest first
+    #: The setters Rule.setup() calls, in its order, by the option that calls them
+    setters = [("protocol", "set_protocol"), ("chain", "set_chain"), ("interface", "set_interface"),
+               ("dst", "set_port"), ("src", "set_port"), ("subnet", "set_subnet"), ("state", "set_state"),
+               ("icmp", "set_icmp"), ("target", "set_target")]
+
+    def __init__(self, sample=0, hooks=None):
+        self.sample = sample  # Sample every this many rules, 0 for none
+        self.hooks = list(hooks or [])
+        self.reset()
+
+    def __repr__(self):
+        return "<Profiler: %d phases, %d rules>" % (len(self.phases), self.counters.get("rules", 0))
+
+    def reset(self):
+        """
+        @summary: Forget everything recorded so far
+        @rtype: None
+        """
+        self.phases = OrderedDict()  # phase -> [calls, seconds]
+        self.counters = OrderedDict()  # counter -> int
+        self.setterstats = OrderedDict()  # setter -> [calls, seconds] over the sampled rules
+        self._samples = []  # Heap of (seconds, rule) of the slowest sampled rules
+        self._sampled = 0
+        self._rules = 0
+
+    def hook(self, callback):
+        """
+        @summary: Call callback(event, data) at the end of each phase and for
+                  each sampled rule
+        @rtype: None
+        """
+        self.hooks.append(callback)
+
+    ##########
+    # RECORD #
+    ##########
+    def record(self, phase, seconds, notify=True):
+        """
+        @summary: Add a timing to a phase, and tell the hooks unless it's one
+                  of many small timings, i.e. each setrule()
+        @rtype: None
+        """
+        _phase = self.phases.get(phase)
+        if _phase is None:
+            _phase = self.phases[phase] = [0, 0.0]
+        _phase[0] += 1
+        _phase[1] += seconds
+        if notify:
+            self._notify("phase", {"phase": phase, "seconds": seconds})
+
+    def count(self, counter, amount=1):
+        self.counters[counter] = self.counters.get(counter, 0) + amount
+
+    #########
+    # RULES #
+    #########
+    def rule(self, kwargs):
+        """
+        @summary: Build a Rule for setrule(), one setter at a time for every
+                  sample-th rule
+        @rtype: Rule
+        """
+        self._rules += 1
+        if not self.sample or self._rules % self.sample:
+            return Rule(**kwargs)
+        _start = time.time()
+        _setters = OrderedDict()
+        _rule = Rule()
+        for _option, _setter in self.setters:
+            if _option not in kwargs:
+                continue
+            _time = time.time()
+            try:
+                if _setter == "set_port":
+                    _rule.set_port(**{_option: kwargs[_option]})
+                else:
+                    getattr(_rule, _setter)(kwargs[_option])
+            finally:
+                _setters[_setter] = _setters.get(_setter, 0.0) + time.time() - _time
+                _stat = self.setterstats.setdefault(_setter, [0, 0.0])
+                _stat[0] += 1
+                _stat[1] += time.time() - _time
+        _seconds = time.time() - _start
+        self._sampled += 1
+        _text = _rule.generate().strip()
+        if len(self._samples) < self.slowest:
+            heapq.heappush(self._samples, (_seconds, _text))
+        else:
+            heapq.heappushpop(self._samples, (_seconds, _text))
+        self._notify("sample", {"rule": _text, "seconds": _seconds, "setters": _setters})
+        return _rule
+
+    def write(self, target, lines, bufsize):
+        """
+        @summary: BlackSalt.write() with the time spent rendering lines and
+                  writing them recorded apart
+        @rtype: int (the number of lines written)
+        """
+        _render = [0.0]
+
+        def _timed(lines):
+            _lines = iter(lines)
+            while True:
+                _start = time.time()
+                try:
+                    _line = next(_lines)
+                except StopIteration:
+                    _render[0] += time.time() - _start
+                    return
+                _render[0] += time.time() - _start
+                yield _line
+
+        _start = time.time()
+        _count = _writelines(target, _timed(lines), bufsize)
+        self.record("render", _render[0])
+        self.record("write", time.time() - _start - _render[0])
+        self.count("lines", _count)
+        return _count
+
+    #########
+    # STATS #
+    #########
+    def stats(self):
+        """
+        @summary: Everything recorded, as a dict ready for JSON
+        @rtype: OrderedDict {"phases": {phase: {"calls", "seconds"}}, "counters",
+                "samples": {"every", "rules", "setters", "slowest"}}
+        """
+        return OrderedDict([
+            ("phases", OrderedDict((_phase, OrderedDict([("calls", _calls), ("seconds", round(_seconds, 6))]))
+                                   for _phase, (_calls, _seconds) in self.phases.iteritems())),
+            ("counters", OrderedDict(self.counters)),
+            ("samples", OrderedDict([
+                ("every", self.sample),
+                ("rules", self._sampled),
+                ("setters", OrderedDict((_setter, OrderedDict([("calls", _calls),
+                                                               ("seconds", round(_seconds, 6))]))
+                                        for _setter, (_calls, _seconds) in self.setterstats.iteritems())),
+                ("slowest", [OrderedDict([("seconds", round(_seconds, 6)), ("rule", _text)])
+                             for _seconds, _text in sorted(self._samples, reverse=True)]),
+            ])),
+        ])
+
+    def dump(self, target):
+        """
+        @summary: Write stats() as JSON to a path or file-like object
+        @rtype: None
+        @param target: str path or file-like object
+        """
+        _target = open(target, "w") if type(target) == str else target
+        try:
+            json.dump(self.stats(), _target, indent=2)
+            _target.write("\n")
+        finally:
+            if _target is not target:
+                _target.close()
+
+    def _notify(self, event, data):
+        for _hook in self.hooks:
+            _hook(event, data)
+
+
+def _profiled(phase):
+    """
+    Time a BlackSalt method as a phase when the instance has a profiler
+    """
+    def _decorator(method):
+        @functools.wraps(method)
+        def _method(self, *args, **kwargs):
+            _profiler = self.profiler
+            if _profiler is None:
+                return method(self, *args, **kwargs)
+            _start = time.time()
+            try:
+                return method(self, *args, **kwargs)
+            finally:
+                _profiler.record(phase, time.time() - _start)
+        return _method
+    return _decorator
+
+
 #############
 # BLACKSALT #
 #############
@@ -50,6 +733,14 @@ class BlackSalt():
         self.printmode = True  # Default printmode to true unless set otherwise
         self.iptables = "/sbin/iptables"  # Default iptables bin to /sbin/iptables
         self.scriptfile = False
+        self.backend = "iptables"  # Default backend to a shell script of iptables commands
+        self.overwrite = "prompt"  # Default to asking before overwriting an existing scriptfile
+        self.ipset = "/sbin/ipset"  # Default ipset bin to /sbin/ipset
+        self.nft = "/usr/sbin/nft"  # Default nft bin to /usr/sbin/nft
+        self.ipsetfile = False  # When set, generate() writes the ipset restore file here
+        self.sets = OrderedDict()  # ipset name -> list of subnets, see collapsesets()
+        self.cache = None  # A CompileCache of rendered outputs, see contenthash()
+        self.profiler = None  # A Profiler timing each phase, see Profiler
         # Create some aliases
         self.show = self.display = self.preview
         self.last = self.lastrule
@@ -66,6 +757,41 @@ class BlackSalt():
         # for the user.
         if "scriptfile" in kwargs:
             self.scriptfile = kwargs["scriptfile"]
+        # The backend decides the output format, iptables for a shell script,
+        # restore for an iptables-restore file or nft for an nftables ruleset
+        if "backend" in kwargs:
+            if kwargs["backend"] not in BACKENDS:
+                raise IPTablesError("backend must be one of: %s" % ", ".join(BACKENDS))
+            self.backend = kwargs["backend"]
+        # If we have an ipset parameter store it as our ipset bin location
+        if "ipset" in kwargs:
+            self.ipset = kwargs["ipset"]
+        # If we have an nft parameter store it as our nft bin location
+        if "nft" in kwargs:
+            self.nft = kwargs["nft"]
+        # If we get an ipsetfile parameter, we'll write the ipset restore file here
+        if "ipsetfile" in kwargs:
+            self.ipsetfile = kwargs["ipsetfile"]
+        # The overwrite policy decides what happens when the scriptfile exists
+        if "overwrite" in kwargs:
+            if kwargs["overwrite"] not in OVERWRITE:
+                raise IPTablesError("overwrite must be one of: %s" % ", ".join(OVERWRITE))
+            self.overwrite = kwargs["overwrite"]
+        # If we get a cachedir, rendered outputs are kept there and unchanged rulesets
+        # aren't written or applied again, cachesize bounds the bytes it keeps
+        if "cachedir" in kwargs:
+            self.cache = CompileCache(kwargs["cachedir"], kwargs.get("cachesize", CACHESIZE))
+        # If we get a profiler, each phase is timed and counted, True for a default Profiler
+        if "profiler" in kwargs:
+            self.profiler = Profiler() if kwargs["profiler"] is True else kwargs["profiler"] or None
+        # The rule store decides how the rules are kept, a list or a column-wise RuleTable
+        if "rulestore" in kwargs:
+            if kwargs["rulestore"] not in RULESTORES:
+                raise IPTablesError("rulestore must be one of: %s" % ", ".join(RULESTORES))
+            if kwargs["rulestore"] == "table":
+                self.rules = RuleTable()
+            elif kwargs["rulestore"] == "indexed":
+                self.rules = RuleIndex()
 
     # Change default print to similar format: <BlackSalt v0.2.0: 0 rules defined>
     def __repr__(self):
@@ -142,134 +868,1036 @@ class BlackSalt():
     ################
     #GENERATE RULES#
     ################
+    @_profiled("generate")
     def generate(self):
         """
         Output the rules, if we have scriptfile set up in the
         instance variables, try to open and output the
         rules to the files. If printmode is true, print to
-        stdout.
+        stdout. The overwrite policy decides what happens if
+        the scriptfile already exists. If there are ipsets
+        and an ipsetfile, the ipset restore file is written
+        there too. A script compiled by compilefleet() has
+        its output written by the fleet, so generate() does
+        nothing there. With a cache, the output is rendered
+        into the cache once per content hash, and nothing is
+        written when the scriptfile was last written with
+        the same hash.
         Aliases for this function: create()
         """
-        _scriptfile = False
+        if _FLEET["host"]:
+            return
 
-        if self.scriptfile:
-            #  If the scriptfile already exists
-            if os.path.exists(self.scriptfile):
-                #  Prompt to overwrite
-                _option = str(raw_input("%s exists, overwrite this file? [y/n] ").lower())
-                while True:
-                    #  Loop until we get either a y or n
-                    #  Open the scriptfile for overwriting
-                    if _option == "y":
-                        _scriptfile = open(self.scriptfile, "w+")
-                        break
-                    elif _option == "n":
-                        _scriptfile = None
-                        break
-                    else:
-                        _option = raw_input("%s exists, overwrite this file? [y/n] ")
+        _cached = _key = None
+        if self.cache is not None and self.scriptfile:
+            _key = self.cache.key(self.contenthash(), self.backend)
+            if self.cache.deployed(self.scriptfile) == _key and os.path.exists(self.scriptfile):
+                print "%s is unchanged, not writing" % self.scriptfile
+                if self.printmode:
+                    self.write(sys.stdout)
+                return
+            _cached = self.cache.get(_key) or self.cache.put(_key, self.iter_lines())
 
-            #  If the scriptfile doesn't already exists try to open it
-            else:
-                try:
-                    _scriptfile = open(self.scriptfile, "w+")
-                except IOError as err:
-                    print "Unable to open %s; check permissions and path exists" % err.filename
-
-            #  If we have an open script file, write our rules out to it
-            if "_scriptfile" in vars() and _scriptfile and not _scriptfile.closed:
-                # If we have any modules, add the modprobe lines
-                if len(self.modules):
-                    for _module in self.modules:
-                        print "modprobe %s" % _module
-                # Loop through our rules and write them to the file
-                for _rule in self.rules:
-                    _scriptfile.writelines("%s%s\n" % (self.iptables, _rule))
+        #  nftables holds the sets in the ruleset itself
+        if self.ipsetfile and self.sets and self.backend != "nft":
+            _ipsetfile = self.openscript(self.ipsetfile)
+            if _ipsetfile:
+                _writelines(_ipsetfile, self.iter_ipsets())
+                _ipsetfile.close()
+
+        if self.scriptfile:
+            _scriptfile = self.openscript()
+            #  If we have an open script file, stream our lines out to it
+            if _scriptfile:
+                if _cached:
+                    with open(_cached, "r") as _source:
+                        shutil.copyfileobj(_source, _scriptfile, BUFSIZE)
+                else:
+                    self.write(_scriptfile)
                 _scriptfile.close()
+                if _key:
+                    self.cache.setdeployed(self.scriptfile, _key)
 
         #  If printmode is on, print the rules to the screen
         if self.printmode:
-            # Output the modules to probe first
-            if len(self.modules):
-                for _module in self.modules:
-                    print "modprobe %s" % _module
-            for _rule in self.rules:
-                print "%s%s" % (self.iptables, _rule)
+            self.write(sys.stdout)
 
-        else:
+        elif not self.scriptfile:
             print "printmode and scriptfile disabled; enable to output"
 
     ################
-    # REMOVE RULES #
+    # CONTENT HASH #
     ################
-    def remove(self, arg=None):
+    def contenthash(self):
         """
-        Pass in a integer of a line number to remove, if there
-        are no arguments, display the script lines with line number
-        Aliases for this function: rm(), delete()
+        @summary: A sha1 over everything the output depends on; the modules,
+                  the flush, policy and chain entries and the fingerprint of
+                  each rule in order, the ipsets and the binaries written
+                  into the output. The same ruleset hashes the same in any
+                  process, so with the backend it keys the CompileCache.
+        @rtype: str
+        @param: None
         """
-        if arg:
-            try:
-                self.rules.pop(int(arg)-1)
-            except ValueError:
-                print "Not a line number"
-            except IndexError:
-                print "Invalid line number"
+        _hash = hashlib.sha1("blacksalt %s\n" % __version__)
+        _hash.update("%s %s %s\n" % (self.iptables, self.ipset, self.nft))
+        for _module in self.modules:
+            _hash.update("module %s\n" % _module)
+        for _rule in self.rules:
+            if isinstance(_rule, Rule):
+                _hash.update("rule %s\n" % _rule.fingerprint())
+            else:
+                _hash.update("entry %s\n" % _rule.strip())
+        for _name, _subnets in self.sets.iteritems():
+            _hash.update("set %s %s\n" % (_name, " ".join(_subnets)))
+        return _hash.hexdigest()
 
-        else:
-            self.preview()
+    ###############
+    # OPEN SCRIPT #
+    ###############
+    def openscript(self, path=None):
+        """
+        Open the scriptfile, or another path, for writing, following the
+        overwrite policy if it already exists. Returns the open file, or
+        None if it shouldn't be written or can't be opened.
+        """
+        _path = path or self.scriptfile
+        #  If the scriptfile already exists
+        if os.path.exists(_path):
+            if self.overwrite == "never":
+                print "%s exists, not overwriting" % _path
+                return None
+            if self.overwrite == "error":
+                raise IPTablesError("%s exists, not overwriting" % _path)
+            if self.overwrite == "prompt":
+                #  Prompt to overwrite, loop until we get either a y or n
+                _option = ""
+                while _option not in ["y", "n"]:
+                    _option = str(raw_input("%s exists, overwrite this file? [y/n] " % _path)).lower()
+                if _option == "n":
+                    return None
 
-    #################
-    # PREVIEW RULES #
-    #################
-    def preview(self):
+        #  Try to open the scriptfile for overwriting
+        try:
+            return open(_path, "w")
+        except IOError as err:
+            print "Unable to open %s; check permissions and path exists" % err.filename
+            return None
+
+    #########
+    # WRITE #
+    #########
+    def write(self, target, bufsize=BUFSIZE):
         """
-        Show a preview of the current rules
-        Aliases for this function: show(), display()
+        @summary: Stream the output lines to a file-like object or a file
+                  descriptor, i.e. a pipe to iptables-restore or a socket.
+                  Lines are rendered lazily and gathered into one buffer
+                  which is written every bufsize bytes, so the output is
+                  never built in memory and there's no write per line.
+        @rtype: int (the number of lines written)
+        @param target: file-like object or int file descriptor
+        @param bufsize: int
         """
-        if len(self.rules):
-            for _lineno, _rule in enumerate(self.rules):
-                print "[%s] %s" % (_lineno + 1, _rule)
-        else:
-            print "No rules set"
+        if self.profiler is not None:
+            return self.profiler.write(target, self.iter_lines(), bufsize)
+        return _writelines(target, self.iter_lines(), bufsize)
 
-    ########################
-    # SET DEFAULT POLICIES #
-    ########################
-    def policy(self, opts, opt2=None):
+    #########
+    # LINES #
+    #########
+    def lines(self):
         """
-        An easy way to set default chain policies
-        Aliases for this function: pol(), setpol()
+        Return the output lines for the current backend as a list,
+        see iter_lines()
         """
-        # If we get a tuple of options, proceed
-        if type(opts) == tuple:
-            # Construct the command only if tuple arguments are strings
-            if type(opts[0]) == str and type(opts[1]) == str:
-                self.rule = " -P %s %s" % (opts[0].upper(), opts[1].upper())
-                self.rules.append(self.rule)
-                return
-            else:
-                print "Tuple values must be strings i.e. ('INPUT', 'DROP')"
-        # If we get two strings as options
-        elif type(opts) == str and type(opt2) == str:
-            self.rule = " -P %s %s" % (opts.upper(), opt2.upper())
-            self.rules.append(self.rule)
+        return list(self.iter_lines())
+
+    ##############
+    # ITER LINES #
+    ##############
+    def iter_lines(self):
+        """
+        Yield the output lines for the current backend one at a time, for
+        the iptables backend this is a modprobe line for each module followed
+        by an iptables command per rule, for the restore backend see restore()
+        and for the nft backend see nftables()
+        """
+        if self.backend == "restore":
+            for _line in self.iter_restore():
+                yield _line
             return
-        # If we get a list of tuples, loop through the list, and call policy function recursively
-        elif type(opts) == list:
-            for _pol in opts:
-                if type(_pol) == tuple:
-                    # Recursively run function with list item
-                    self.policy(_pol)
-        # Return an error if we don't get a tuple
-        else:
-            print "Tuple of string arguments needed i.e. ('INPUT', 'DROP')"
-            print "Or two strings i.e. 'INPUT', 'DROP'"
-            print "Or a list of tuples i.e. [('INPUT', 'DROP'), ('OUTPUT', 'ACCEPT')]"
+        if self.backend == "nft":
+            for _line in self.iter_nftables():
+                yield _line
             return
 
+        # Output the modules to probe first
+        for _module in self.modules:
+            yield "modprobe %s" % _module
+        # Then load the ipsets the rules match against, in one ipset restore
+        if self.sets:
+            yield "%s restore <<'EOF'" % self.ipset
+            for _line in self.iter_ipsets():
+                yield _line
+            yield "EOF"
+        for _rule in self.iter_rules():
+            yield "%s %s" % (self.iptables, _rule)
+
     ##############
-    # SET MODULE #
+    # ITER RULES #
+    ##############
+    def iter_rules(self):
+        """
+        Yield each entry in the rules rendered as a string without the
+        iptables binary, i.e. "-A INPUT -i lo -j ACCEPT"
+        """
+        for _rule in self.rules:
+            if isinstance(_rule, Rule):
+                yield _rule.generate().strip()
+            else:
+                yield _rule.strip()
+
+    ###########
+    # RESTORE #
+    ###########
+    def restore(self):
+        """
+        @summary: Build the rules in iptables-restore format, so the whole
+                  ruleset is loaded with one atomic iptables-restore call
+                  rather than one iptables call per rule. The filter table
+                  is written as a single section:
+                        *filter
+                        :INPUT DROP [0:0]
+                        -A INPUT ...
+                        COMMIT
+                  iptables-restore replaces the whole table, so the -F and
+                  -X flush entries are implied and not written out. Modules
+                  can't be loaded from a restore file, they are written as
+                  comments at the top of the output.
+        @rtype: list
+        @param: None
+        """
+        return list(self.iter_restore())
+
+    ################
+    # ITER RESTORE #
+    ################
+    def iter_restore(self):
+        """
+        Yield the iptables-restore lines one at a time, see restore(). The
+        rules are walked once for the chain declarations and again to render
+        them, so nothing but the chains and policies is held in memory.
+        """
+        _policies = dict((_chain, "ACCEPT") for _chain in BUILTIN_CHAINS)
+        _chains = list(BUILTIN_CHAINS)
+
+        for _rule in self.rules:
+            if isinstance(_rule, Rule):
+                if _rule.chain and _rule.chain not in _chains:
+                    _chains.append(_rule.chain)
+                continue
+
+            _parts = _rule.split()
+            # Default policies become the chain declarations
+            if len(_parts) == 3 and _parts[0] == "-P":
+                _policies[_parts[1]] = _parts[2]
+            # As do new user defined chains
+            elif len(_parts) == 2 and _parts[0] == "-N" and _parts[1] not in _chains:
+                _chains.append(_parts[1])
+
+        for _module in self.modules:
+            yield "# modprobe %s" % _module
+        if self.sets:
+            yield "# %s restore < %s" % (self.ipset, self.ipsetfile or "ipsetfile")
+        yield "*filter"
+        for _chain in _chains:
+            yield ":%s %s [0:0]" % (_chain, _policies.get(_chain, "-"))
+        for _rule in self.rules:
+            if isinstance(_rule, Rule):
+                if not _rule.chain:
+                    print >> sys.stderr, "Skipping rule without a chain: %s" % _rule
+                    continue
+                yield _rule.generate().strip()
+        yield "COMMIT"
+
+    ############
+    # NFTABLES #
+    ############
+    def nftables(self):
+        """
+        @summary: Build the rules as an nft -f ruleset for nftables. The
+                  ruleset is the state the rules leave the chains in, in a
+                  table of its own which is created, deleted and created
+                  again, so "nft -f" swaps the whole ruleset in one
+                  transaction. The builtin chains become base chains with
+                  their policy, the ipsets from collapsesets() named sets,
+                  and rules that follow each other and differ in one match,
+                  i.e. the subnet or port, are written as one rule matching
+                  an anonymous set, or a verdict map when their verdicts
+                  differ:
+                        ip saddr { 10.0.0.0/24, 10.0.1.0/24 } accept
+                        tcp dport vmap { 22 : jump ssh, 80 : accept }
+                  Options in Rule.extra or targets nftables has no match
+                  for raise an IPTablesError rather than being left out.
+        @rtype: list
+        @param: None
+        """
+        return list(self.iter_nftables())
+
+    #################
+    # ITER NFTABLES #
+    #################
+    def iter_nftables(self):
+        """
+        Yield the nft -f lines one at a time, see nftables(). Each chain is
+        translated and grouped in turn, so only one chain is held in memory.
+        """
+        _chains, _policies = _chaintable(self.rules)
+        _table = "ip %s" % NFT_TABLE
+
+        yield "#!%s -f" % self.nft
+        for _module in self.modules:
+            yield "# modprobe %s" % _module
+        #: Adding the table first means the delete never fails on a first load
+        yield "add table %s" % _table
+        yield "delete table %s" % _table
+        yield "add table %s" % _table
+        for _name, _subnets in self.sets.iteritems():
+            _elements = " elements = { %s };" % ", ".join(_subnets) if _subnets else ""
+            yield "add set %s %s { type ipv4_addr; flags interval;%s }" % (_table, _name, _elements)
+        for _chain in _chains:
+            if _chain in _NFT_HOOKS:
+                _policy = _policies.get(_chain, "ACCEPT")
+                if _policy not in ["ACCEPT", "DROP"]:
+                    raise IPTablesError("nftables chain policies are ACCEPT or DROP, not %s" % _policy)
+                yield "add chain %s %s { type filter hook %s priority 0; policy %s; }" % (
+                    _table, _chain, _NFT_HOOKS[_chain], _policy.lower())
+            else:
+                yield "add chain %s %s" % (_table, _chain)
+        for _chain, _rules in _chains.iteritems():
+            _entries = [_nftrule(_rule, _chains, self.sets) for _line, _rule in _rules]
+            for _group in _nftgroups(_entries):
+                yield "add rule %s %s %s" % (_table, _chain, _nftrender(_group))
+
+    ########
+    # LOAD #
+    ########
+    @_profiled("load")
+    def load(self, source):
+        """
+        @summary: Read the filter table from iptables-save output and add its
+                  policies, chains and rules to this ruleset, see iterparse().
+        @rtype: int (the number of rules added)
+        @param source: str path or file-like object
+        """
+        _count = 0
+        for _entry in iterparse(source):
+            self.rules.append(_entry)
+            if isinstance(_entry, Rule):
+                _count += 1
+        return _count
+
+    ############
+    # SNAPSHOT #
+    ############
+    def snapshot(self):
+        """
+        @summary: Take a Snapshot of the filter table this ruleset builds,
+                  its policies, chains and the rules in each chain, to diff
+                  against later.
+        @rtype: Snapshot
+        @param: None
+        """
+        _snapshot = Snapshot()
+        for _rule in self.rules:
+            if isinstance(_rule, Rule):
+                if _rule.chain:
+                    _snapshot.append(_rule.generate().strip())
+                continue
+
+            _parts = _rule.split()
+            if len(_parts) == 3 and _parts[0] == "-P":
+                _snapshot.policies[_parts[1]] = _parts[2]
+            elif len(_parts) == 2 and _parts[0] == "-N":
+                _snapshot.chains.setdefault(_parts[1], [])
+        return _snapshot
+
+    ########
+    # DIFF #
+    ########
+    @_profiled("diff")
+    def diff(self, previous):
+        """
+        @summary: Compare this ruleset against a previous one and return the
+                  smallest list of iptables operations that turns the previous
+                  ruleset into this one, without flushing. Each chain is matched
+                  rule by rule, changed rules become -R, added rules -I and
+                  removed rules -D at their position in the chain at the time
+                  the operation runs, so the list must be run in order. New
+                  chains are created (-N) first, removed chains are flushed and
+                  deleted (-F, -X) last and changed policies are set with -P.
+                  Operations are returned without the iptables binary, i.e.
+                  "-R INPUT 3 -i eth0 -j ACCEPT"
+        @rtype: list
+        @param previous: BlackSalt, Snapshot, a path or file-like object of
+                         iptables-save or iptables-restore output
+        """
+        if isinstance(previous, BlackSalt):
+            previous = previous.snapshot()
+        elif not isinstance(previous, Snapshot):
+            previous = Snapshot().load(previous)
+        _current = self.snapshot()
+
+        _ops = []
+        #: Create new chains before any rule can jump to them
+        for _chain in _current.chains:
+            if _chain not in previous.chains:
+                _ops.append("-N %s" % _chain)
+
+        for _chain, _specs in _current.chains.iteritems():
+            _ops.extend(_diffchain(_chain, previous.chains.get(_chain, []), _specs))
+
+        for _chain, _policy in _current.policies.iteritems():
+            if previous.policies.get(_chain, "ACCEPT") != _policy:
+                _ops.append("-P %s %s" % (_chain, _policy))
+
+        #: Remove old chains once nothing jumps to them
+        for _chain in previous.chains:
+            if _chain not in _current.chains:
+                _ops.append("-F %s" % _chain)
+                _ops.append("-X %s" % _chain)
+        return _ops
+
+    #########
+    # APPLY #
+    #########
+    @_profiled("apply")
+    def apply(self, previous):
+        """
+        @summary: Apply the difference between a previous ruleset and this one
+                  to the running firewall, one iptables call per operation, see
+                  diff(). If printmode is on each command is printed as it runs.
+                  With a cache, nothing is applied when the last ruleset
+                  applied with this iptables binary had the same content
+                  hash; purge the cache to apply regardless.
+        @rtype: int (the number of operations applied)
+        @param previous: BlackSalt, Snapshot, a path or file-like object of
+                         iptables-save or iptables-restore output
+        """
+        _key = None
+        if self.cache is not None:
+            _key = self.cache.key(self.contenthash(), "apply")
+            if self.cache.deployed(self.iptables) == _key:
+                print "Ruleset is unchanged since it was last applied, not applying"
+                return 0
+        _ops = self.diff(previous)
+        for _op in _ops:
+            if self.printmode:
+                print "%s %s" % (self.iptables, _op)
+            if subprocess.call([self.iptables] + shlex.split(_op)):
+                raise IPTablesError("Failed to apply: %s %s" % (self.iptables, _op))
+        if _key:
+            self.cache.setdeployed(self.iptables, _key)
+        if self.profiler is not None:
+            self.profiler.count("operations", len(_ops))
+        return len(_ops)
+
+    #############
+    # AGGREGATE #
+    #############
+    @_profiled("aggregate")
+    def aggregate(self):
+        """
+        @summary: An optimisation pass over the rules, rules that are the same
+                  apart from their subnet, and follow each other in their chain,
+                  have their subnets collapsed into the fewest CIDR blocks that
+                  cover the same addresses, i.e. 192.168.10.0/24 and
+                  192.168.11.0/24 become 192.168.10.0/23. Flush and policy
+                  entries end a run, as does a rule without a subnet or with
+                  a mask that isn't a plain prefix, i.e. 255.0.255.0. Only
+                  rules next to each other in their chain are merged, so no
+                  rule moves past another rule it could overlap with, and
+                  rules with a target that isn't a verdict, i.e. LOG, only
+                  when their subnets don't overlap, so no packet matches
+                  fewer of them.
+        @rtype: int (the number of rules removed)
+        @param: None
+        """
+        _rules = list(self.rules)
+        _replace = {}
+        for _indexes in _subnetruns(_rules):
+            if len(_indexes) < 2:
+                continue
+            _blocks = _collapse((_rules[_index]._network, _rules[_index]._mask) for _index in _indexes)
+            if len(_blocks) == len(_indexes):
+                continue
+            _collapsed = []
+            for _network, _length in _blocks:
+                _rule = _rules[_indexes[0]].copy()
+                _rule._network = _network
+                _rule._mask = _prefixmask(_length)
+                _rule._subnetform = SUBNET_ADDRESS if _length == 32 else SUBNET_CIDR
+                _collapsed.append(_rule)
+            #: The collapsed rules take the place of the first rule in the run
+            _replace[_indexes[0]] = _collapsed
+            for _index in _indexes[1:]:
+                _replace[_index] = []
+
+        if not _replace:
+            return 0
+        _removed = len(_rules)
+        _aggregated = []
+        for _index, _rule in enumerate(_rules):
+            _aggregated.extend(_replace.get(_index, [_rule]))
+        _removed -= len(_aggregated)
+        self.replacerules(_aggregated)
+        if self.printmode:
+            print "Aggregated subnets; removed %d rules" % _removed
+        return _removed
+
+    ################
+    # COLLAPSE SETS #
+    ################
+    @_profiled("collapsesets")
+    def collapsesets(self, minsize=8):
+        """
+        @summary: An optimisation pass over the rules, runs of at least minsize
+                  rules that follow each other in their chain and differ only in
+                  their subnet are replaced by one rule matching an ipset,
+                  "-m set --match-set NAME src", so the addresses are looked up
+                  in a hash rather than tried one rule at a time. The subnets
+                  are collapsed into a hash:net set named after its contents, so
+                  the same list of subnets always gives the same set. Runs end
+                  the same way as in aggregate(), so rules with a target that
+                  isn't a verdict, i.e. LOG or a jump to a chain that returns,
+                  are only collapsed when their subnets don't overlap. The
+                  sets are written out by iter_ipsets().
+        @rtype: int (the number of rules removed)
+        @param minsize: int
+        """
+        _rules = list(self.rules)
+        _replace = {}
+        for _indexes in _subnetruns(_rules):
+            if len(_indexes) < minsize:
+                continue
+            _blocks = _collapse((_rules[_index]._network, _rules[_index]._mask) for _index in _indexes)
+            #: hash:net can't hold a /0, it's the same as two /1s
+            if _blocks == [(0, 0)]:
+                _blocks = [(0, 1), (0x80000000, 1)]
+            _subnets = ["%s/%d" % (_unpackaddr(_network), _length) for _network, _length in _blocks]
+            _name = "bs-%s" % hashlib.sha1(" ".join(_subnets)).hexdigest()[:12]
+            self.sets[_name] = _subnets
+
+            _rule = _rules[_indexes[0]].copy()
+            _rule._network = _rule._mask = _rule._subnetform = None
+            _rule.extra = " ".join(_opt for _opt in ["-m set --match-set %s src" % _name, _rule.extra] if _opt)
+            _replace[_indexes[0]] = [_rule]
+            for _index in _indexes[1:]:
+                _replace[_index] = []
+
+        if not _replace:
+            return 0
+        _collapsed = []
+        for _index, _rule in enumerate(_rules):
+            _collapsed.extend(_replace.get(_index, [_rule]))
+        _removed = len(_rules) - len(_collapsed)
+        self.replacerules(_collapsed)
+        if self.printmode:
+            print "Collapsed subnets into %d ipsets; removed %d rules" % (len(self.sets), _removed)
+        return _removed
+
+    ###############
+    # ITER IPSETS #
+    ###############
+    def iter_ipsets(self):
+        """
+        @summary: Yield the ipset restore lines for the sets made by
+                  collapsesets(). Each set is filled under a temporary name
+                  and swapped in, so "ipset restore" replaces every set
+                  atomically, even one the running rules already match on.
+        @rtype: generator
+        @param: None
+        """
+        for _name, _subnets in self.sets.iteritems():
+            _temporary = "%s-t" % _name
+            _maxelem = max(65536, len(_subnets))
+            yield "create %s hash:net family inet maxelem %d -exist" % (_name, _maxelem)
+            yield "create %s hash:net family inet maxelem %d -exist" % (_temporary, _maxelem)
+            yield "flush %s" % _temporary
+            for _subnet in _subnets:
+                yield "add %s %s" % (_temporary, _subnet)
+            yield "swap %s %s" % (_temporary, _name)
+            yield "destroy %s" % _temporary
+
+    ###########
+    # ANALYZE #
+    ###########
+    @_profiled("analyze")
+    def analyze(self, prune=False):
+        """
+        @summary: Find rules that can never match, or whose order matters,
+                  comparing each rule with the earliest rule in its chain
+                  that contains it or, failing that, the earliest rule with
+                  a different target that overlaps it:
+                        shadowed        an earlier rule with a different
+                                        target matches everything it does
+                        redundant       an earlier rule with the same target
+                                        matches everything it does
+                        correlated      an earlier rule with a different
+                                        target matches some of what it does
+                        generalization  it matches everything an earlier
+                                        rule with a different target does
+                  Only rules with a terminal target (ACCEPT, DROP etc.) are
+                  taken to stop a packet. Earlier rules are found through a
+                  MatchIndex, not by comparing every pair. Flush entries
+                  start the comparison again. Shadowed and redundant rules
+                  can never match, with prune they are removed.
+        @rtype: dict {kind: [(line, earlier line)]}, lines are as in preview()
+        @param prune: bool
+        """
+        _report = OrderedDict((_kind, []) for _kind in ["shadowed", "redundant", "correlated", "generalization"])
+        _indexes = {}  # chain -> MatchIndex of the earlier terminal rules
+        _dead = set()
+
+        for _index, _rule in enumerate(self.rules):
+            if not isinstance(_rule, Rule):
+                if _rule.split()[:1] in [["-F"], ["-X"]]:
+                    _indexes = {}
+                continue
+            _space = _rule.matchspace()
+            _matchindex = _indexes.setdefault(_rule.chain, MatchIndex())
+            #: The earliest rule that matches everything this one does
+            _earlier = _matchindex.earliest(_space, contains=True)
+            if _earlier:
+                _dead.add(_index)
+            else:
+                #: Or the earliest rule with a different target that overlaps it
+                _earlier = _matchindex.earliest(_space, exclude=_space.target)
+            if _earlier:
+                _report[_relation(_space, _earlier[1])].append((_index + 1, _earlier[0] + 1))
+            if _space.terminal and _index not in _dead:
+                _matchindex.add(_index, _space)
+
+        for _kind in _report:
+            _report[_kind].sort()
+        if self.printmode:
+            for _kind, _findings in _report.iteritems():
+                for _line, _earlier in _findings:
+                    print "[%s] %s by [%s]" % (_line, _kind, _earlier)
+        if prune and _dead:
+            self.replacerules([_rule for _index, _rule in enumerate(self.rules) if _index not in _dead])
+            if self.printmode:
+                print "Removed %d rules that can never match" % len(_dead)
+        return _report
+
+    ###########
+    # REORDER #
+    ###########
+    @_profiled("reorder")
+    def reorder(self, counters):
+        """
+        @summary: Move the rules hit most often towards the top of their
+                  chain, going by the packet counters of the running
+                  firewall. A rule only moves up past rules with fewer hits
+                  that it can't overlap, see MatchSpace, so every packet still
+                  meets the same rule first and gets the same verdict. Rules
+                  don't move across flush or other raw entries, and chains
+                  whose rule count doesn't match the counters are left alone.
+        @rtype: OrderedDict {chain: (average depth before, after)}, the
+                average number of rules a packet is tested against in the
+                chain, packets that reach the policy included
+        @param counters: str path or file-like object of iptables -L -v -x -n
+                         output, or parsecounters() output
+        """
+        if not isinstance(counters, dict):
+            counters = parsecounters(counters)
+        _chains = OrderedDict()  # chain -> [(segment, index)]
+        _segment = 0
+        for _index, _rule in enumerate(self.rules):
+            if isinstance(_rule, Rule):
+                _chains.setdefault(_rule.chain, []).append((_segment, _index))
+            elif _rule.split()[:1] not in [["-N"], ["-P"]]:
+                _segment += 1
+
+        _rules = list(self.rules)
+        _report = OrderedDict()
+        for _chain, _entries in _chains.iteritems():
+            if _chain not in counters:
+                continue
+            _policy, _packets = counters[_chain]
+            if len(_packets) != len(_entries):
+                if self.printmode:
+                    print "Skipping %s, %d rules but %d counters" % (_chain, len(_entries), len(_packets))
+                continue
+            _before, _after = [], []
+            for _segment, _group in itertools.groupby(zip(_entries, _packets), lambda _entry: _entry[0][0]):
+                _placed = []  # [(packets, index, space, network, mask)]
+                for (_segment, _index), _hits in _group:
+                    _space = self.rules[_index].matchspace()
+                    _at = len(_placed)
+                    while _at:
+                        _earlier = _placed[_at - 1]
+                        if _earlier[0] >= _hits:
+                            break
+                        #: Different source networks are the cheap, common way not to overlap
+                        if (not (_earlier[3] ^ _space.network) & _earlier[4] & _space.mask
+                                and _earlier[2].overlaps(_space)):
+                            break
+                        _at -= 1
+                    _placed.insert(_at, (_hits, _index, _space, _space.network, _space.mask))
+                    _before.append(_hits)
+                for _entry, _slot in zip(_placed, sorted(_entry[1] for _entry in _placed)):
+                    _hits, _index = _entry[:2]
+                    _rules[_slot] = self.rules[_index]
+                    _after.append(_hits)
+            _report[_chain] = (_depth(_before, _policy), _depth(_after, _policy))
+
+        self.replacerules(_rules)
+        if self.printmode:
+            for _chain, (_before, _after) in _report.iteritems():
+                print "%s: average depth %.2f -> %.2f" % (_chain, _before, _after)
+        return _report
+
+    ################
+    # COMPILE TREE #
+    ################
+    @_profiled("compiletree")
+    def compiletree(self, chains=None, maxdepth=3, fanout=16, minrules=32):
+        """
+        @summary: An optimisation pass over the rules, long chains are split
+                  into a tree of user defined sub-chains so a packet is tested
+                  against a few rules at each level rather than every rule in
+                  the chain. At each level the rules are split on the field
+                  that divides them best, the interface, the protocol, the
+                  leading bits of the source address or buckets of
+                  destination ports, and the chain holds one rule per value
+                  going (-g) to a sub-chain with the rules for that value.
+                  Rules without a value for the field are copied, in order,
+                  into every sub-chain they could match in and kept after
+                  the goto rules for packets that match none of them. A goto
+                  rather than a jump means falling off the end of a
+                  sub-chain ends the walk the way the end of the chain would,
+                  so every packet meets the same rules in the same order as
+                  before up to its first match. Only the rules after the last
+                  flush or other raw entry are compiled, the sub-chains are
+                  created (-N) where those rules started. Sub-chains are
+                  named bs-<chain>-<n>, within iptables' 28 character limit
+                  and skipping names of chains already in the rules.
+        @rtype: int (the number of sub-chains created)
+        @param chains: list of chain names to compile, None for every chain
+        @param maxdepth: int, the most levels of sub-chains under a chain
+        @param fanout: int, the most sub-chains under any one chain
+        @param minrules: int, chains with fewer rules aren't split
+        """
+        if maxdepth < 1 or fanout < 2:
+            raise IPTablesError("compiletree needs a maxdepth of at least 1 and a fanout of at least 2")
+        _rules = list(self.rules)
+        _chains = OrderedDict()  # chain -> [index] of its rules after the last flush
+        _taken = set()  # Chain names in use, i.e. sub-chains of an earlier compiletree, sub-chains skip them
+        for _index, _rule in enumerate(_rules):
+            if isinstance(_rule, Rule):
+                _chains.setdefault(_rule.chain, []).append(_index)
+                _taken.add(_rule.chain)
+                continue
+            _words = _rule.split()
+            if _words[:1] == ["-N"]:
+                _taken.update(_words[1:2])
+            elif _words[:1] != ["-P"]:
+                _chains = OrderedDict()
+
+        _replace = {}
+        _created = OrderedDict()  # chain -> [sub-chain names]
+        for _chain, _indexes in _chains.iteritems():
+            if chains is not None and _chain not in chains or len(_indexes) < minrules:
+                continue
+            _names = []
+            _compiled = _jumptree(_chain, [(_rules[_index], _rules[_index].matchspace()) for _index in _indexes],
+                                  0, (_chain, maxdepth, fanout, minrules, _taken), _names)
+            if not _names:
+                continue
+            _created[_chain] = _names
+            _replace[_indexes[0]] = ["-N %s" % _name for _name in _names] + _compiled
+            for _index in _indexes[1:]:
+                _replace[_index] = []
+
+        if not _replace:
+            return 0
+        _tree = []
+        for _index, _rule in enumerate(_rules):
+            _tree.extend(_replace.get(_index, [_rule]))
+        self.replacerules(_tree)
+        if self.printmode:
+            for _chain, _names in _created.iteritems():
+                print "Compiled %s into %d sub-chains" % (_chain, len(_names))
+        return sum(len(_names) for _names in _created.itervalues())
+
+    ############
+    # SIMULATE #
+    ############
+    @_profiled("simulate")
+    def simulate(self, flows):
+        """
+        @summary: Work out what the rules do to a batch of flows, each
+                  builtin chain (and the user defined chains it jumps to)
+                  is walked by every flow to its first matching rule or the
+                  policy. Each rule is tested against all the flows still
+                  walking the chain at once with NumPy, not flow by flow.
+                  Rules with options in extra the simulator doesn't model,
+                  see _simoptions(), are taken to match. Needs NumPy.
+        @rtype: OrderedDict {chain: (verdicts, lines)}, NumPy arrays with a
+                verdict per flow, i.e. "ACCEPT", and the line of the rule
+                that gave it as in preview(), 0 for the policy
+        @param flows: dict {field: sequence} of FLOW_FIELDS, or a str path or
+                      file-like object of CSV flows, see loadflows()
+        """
+        _requirenumpy()
+        if not isinstance(flows, dict):
+            flows = loadflows(flows)
+        _simulator = _Simulator(self, flows)
+        _results = OrderedDict()
+        for _chain in BUILTIN_CHAINS:
+            _results[_chain] = _simulator.run(_chain)
+        if _simulator.unmodelled and self.printmode:
+            print "Taken to match, options not simulated: %s" % ", ".join(sorted(_simulator.unmodelled))
+        return _results
+
+    ############
+    # ESTIMATE #
+    ############
+    @_profiled("estimate")
+    def estimate(self, dominant=0.8):
+        """
+        @summary: Estimate what each packet costs the kernel, without loading
+                  the rules or sending traffic. Packets are split into traffic
+                  classes by interface, protocol and connection state, and
+                  each builtin chain is walked by each class in the worst
+                  case; every rule up to the first one certain to give the
+                  whole class a verdict is tested, as is every chain it may
+                  jump to. Rules matching on anything more than the class
+                  (addresses, ports, extra options) only maybe match, so
+                  they're tested but don't end the walk. The chains that
+                  make up the dominant share of all the tests are the ones
+                  worth reordering, see reorder() and compiletree().
+        @rtype: OrderedDict {"classes": OrderedDict {(chain, interface,
+                protocol, state): {"tests", "best", "jumps", "path",
+                "modules", "verdict", "line"}}, "chains": OrderedDict {chain:
+                {"rules", "tests", "share", "modules"}}, "dominant": [chain]};
+                tests is the most rules a packet of the class is tested
+                against, best the fewest before it could get a verdict,
+                jumps the chains it may jump to on the way, path the chains
+                on the worst case walk, verdict and line the target and line
+                as in preview() that it ends at, 0 for the policy. ANY
+                ("*") is an interface or protocol no rule names.
+        @param dominant: float share of all the tests the dominant chains make
+        """
+        _chains, _policies = _chaintable(self.rules)
+        _model = _CostModel(_chains, _policies)
+        _classes = OrderedDict()
+        _tests = dict((_chain, 0) for _chain in _chains)
+        _modules = dict((_chain, set()) for _chain in _chains)
+        for _class, _walk in _costwalks(_model, _chains):
+            _classes[_class] = {"tests": _walk["tests"], "best": _walk["best"], "jumps": _walk["jumps"],
+                                "path": _walk["path"], "modules": sorted(_walk["modules"]),
+                                "verdict": _walk["verdict"], "line": _walk["line"]}
+            for _walked, _count in _walk["chains"].iteritems():
+                _tests[_walked] += _count
+        for _chain, _entries in _model.rules.iteritems():
+            for _line, _rule in _entries:
+                _modules[_chain].update(_rule.modules)
+
+        _total = float(sum(_tests.itervalues())) or 1.0
+        _report = OrderedDict()
+        _report["classes"] = _classes
+        _report["chains"] = OrderedDict((_chain, {"rules": len(_chains[_chain]), "tests": _tests[_chain],
+                                                  "share": _tests[_chain] / _total,
+                                                  "modules": sorted(_modules[_chain])}) for _chain in _chains)
+        _report["dominant"] = _dominant(_tests, dominant)
+        if self.printmode:
+            print "%d traffic classes, at most %d rules tested per packet" % (
+                len(_classes), max(_cost["tests"] for _cost in _classes.itervalues()))
+            for _chain in _report["dominant"]:
+                _cost = _report["chains"][_chain]
+                print "%s: %d rules, %.0f%% of tests, modules %s" % (
+                    _chain, _cost["rules"], 100 * _cost["share"], ", ".join(_cost["modules"]) or "none")
+        return _report
+
+    #############
+    # FAST PATH #
+    #############
+    @_profiled("fastpath")
+    def fastpath(self, states=("ESTABLISHED", "RELATED")):
+        """
+        @summary: Accept packets of established connections as early as each
+                  chain allows; a single conntrack rule (-m state --state
+                  ESTABLISHED,RELATED -j ACCEPT) goes in front of the rules,
+                  and the states it takes are stripped from the rules after
+                  it, rules left with no states are removed. A state is only
+                  taken when the chain is certain to accept it anyway, by a
+                  rule matching nothing else or an ACCEPT policy, and the
+                  fast path goes after the last rule that could do anything
+                  else with a packet in that state (DROP, LOG, a jump etc).
+                  Every chain is then checked to give each state the same
+                  verdicts as before, a chain that doesn't is left alone.
+        @rtype: OrderedDict {"chains": OrderedDict {chain: {"states", "line",
+                "stripped", "removed"}}, "tests": OrderedDict {chain:
+                (before, after)}}; the states hoisted, the line of the fast
+                path as in preview() after the pass, the rules stripped of
+                states and removed, and the worst case rules tested summed
+                over every traffic class of each builtin chain, see
+                estimate()
+        @param states: the states a fast path may take, any of STATES
+        """
+        _states = [_state.upper() for _state in states]
+        _chains, _policies = _chaintable(self.rules)
+        _before = _costtotals(_chains, _policies)
+        _inserts, _replaces = {}, {}
+        _report = OrderedDict([("chains", OrderedDict()), ("tests", OrderedDict())])
+
+        _accepting = dict((_state, set()) for _state in STATES)
+        #: User defined chains first, a jump to one that accepts a state is as good as ACCEPT
+        for _chain in sorted(_chains, key=lambda _chain: _chain in BUILTIN_CHAINS):
+            _entries = _chains[_chain]
+            #: A user defined chain returns to the chain that jumped to it
+            _policy = _policies.get(_chain, "ACCEPT") if _chain in BUILTIN_CHAINS else None
+            _spaces = [MatchSpace(_rule) for _line, _rule in _entries]
+            _plan = _fastpathplan(_entries, _spaces, _states, _policy, _accepting)
+            if _plan is not None:
+                _position, _hoisted, _fastrule, _changes = _plan
+                _newspaces = [_space if _rule is _old else MatchSpace(_rule) for (_line, _old), _rule, _space
+                              in zip(_entries, _changes, _spaces) if _rule is not None]
+                _newspaces.insert(_position, MatchSpace(_fastrule))
+                if any(_statetrace(_spaces, _state, _policy, _accepting)
+                       != _statetrace(_newspaces, _state, _policy, _accepting) for _state in STATES):
+                    if self.printmode:
+                        print "%s: left alone, a fast path would change a verdict" % _chain
+                else:
+                    _inserts[_entries[_position][0] - 1] = _fastrule
+                    for (_line, _rule), _newrule in zip(_entries, _changes):
+                        if _newrule is not _rule:
+                            _replaces[_line - 1] = _newrule
+                    _report["chains"][_chain] = {
+                        "states": _hoisted, "line": None,
+                        "stripped": sum(1 for (_line, _rule), _new in zip(_entries, _changes)
+                                        if _new is not None and _new is not _rule),
+                        "removed": sum(1 for _new in _changes if _new is None)}
+                    _spaces = _newspaces
+            for _state in STATES:
+                if _statetrace(_spaces, _state, _policy, _accepting) == ([], "ACCEPT"):
+                    _accepting[_state].add(_chain)
+        #: Keep the chains in their order in the report
+        _report["chains"] = OrderedDict((_chain, _report["chains"][_chain]) for _chain in _chains
+                                        if _chain in _report["chains"])
+
+        if _report["chains"]:
+            _rules = []
+            for _index, _rule in enumerate(self.rules):
+                if _index in _inserts:
+                    _rules.append(_inserts[_index])
+                    _report["chains"][_inserts[_index].chain]["line"] = len(_rules)
+                _rule = _replaces.get(_index, _rule)
+                if _rule is not None:
+                    _rules.append(_rule)
+            self.replacerules(_rules)
+
+        _after = _costtotals(*_chaintable(self.rules))
+        for _chain in BUILTIN_CHAINS:
+            _report["tests"][_chain] = (_before[_chain], _after[_chain])
+        if self.printmode:
+            for _chain, _hoist in _report["chains"].iteritems():
+                print "[%s] %s fast path for %s, %d rules stripped, %d removed" % (
+                    _hoist["line"], ",".join(_hoist["states"]), _chain, _hoist["stripped"], _hoist["removed"])
+            for _chain, (_old, _new) in _report["tests"].iteritems():
+                if _old != _new:
+                    print "%s: %d rules tested in the worst case over all traffic classes, was %d" % (
+                        _chain, _new, _old)
+        return _report
+
+    #################
+    # REPLACE RULES #
+    #################
+    def replacerules(self, rules):
+        """
+        Replace every entry in the rules with a new list of entries, keeping
+        the same kind of rule store, and the ids of the entries a RuleIndex
+        already held
+        """
+        if isinstance(self.rules, list):
+            self.rules[:] = rules
+        elif isinstance(self.rules, RuleIndex):
+            self.rules.reset(list(rules))
+        else:
+            self.rules = type(self.rules)(rules)
+
+    ################
+    # REMOVE RULES #
+    ################
+    def remove(self, arg=None):
+        """
+        Pass in a integer of a line number to remove, if there
+        are no arguments, display the script lines with line number
+        Aliases for this function: rm(), delete()
+        """
+        if arg:
+            try:
+                self.rules.pop(int(arg)-1)
+            except ValueError:
+                print "Not a line number"
+            except IndexError:
+                print "Invalid line number"
+
+        else:
+            self.preview()
+
+    #################
+    # PREVIEW RULES #
+    #################
+    def preview(self):
+        """
+        Show a preview of the current rules
+        Aliases for this function: show(), display()
+        """
+        if len(self.rules):
+            for _lineno, _rule in enumerate(self.rules):
+                print "[%s] %s" % (_lineno + 1, _rule)
+        else:
+            print "No rules set"
+
+    ########################
+    # SET DEFAULT POLICIES #
+    ########################
+    def policy(self, opts, opt2=None):
+        """
+        An easy way to set default chain policies
+        Aliases for this function: pol(), setpol()
+        """
+        # If we get a tuple of options, proceed
+        if type(opts) == tuple:
+            # Construct the command only if tuple arguments are strings
+            if type(opts[0]) == str and type(opts[1]) == str:
+                self.rule = " -P %s %s" % (opts[0].upper(), opts[1].upper())
+                self.rules.append(self.rule)
+                return
+            else:
+                print "Tuple values must be strings i.e. ('INPUT', 'DROP')"
+        # If we get two strings as options
+        elif type(opts) == str and type(opt2) == str:
+            self.rule = " -P %s %s" % (opts.upper(), opt2.upper())
+            self.rules.append(self.rule)
+            return
+        # If we get a list of tuples, loop through the list, and call policy function recursively
+        elif type(opts) == list:
+            for _pol in opts:
+                if type(_pol) == tuple:
+                    # Recursively run function with list item
+                    self.policy(_pol)
+        # Return an error if we don't get a tuple
+        else:
+            print "Tuple of string arguments needed i.e. ('INPUT', 'DROP')"
+            print "Or two strings i.e. 'INPUT', 'DROP'"
+            print "Or a list of tuples i.e. [('INPUT', 'DROP'), ('OUTPUT', 'ACCEPT')]"
+            return
+
+    ##############
+    # SET MODULE #
     ##############
     def setmodule(self, opts):
         """
@@ -309,6 +1937,8 @@ class BlackSalt():
         @param opts: dict
         @rtype: None
         """
+        if self.profiler is not None:
+            return self._profilesetrule(kwargs)
         try:
             _rule = Rule(**kwargs)
             self.rules.append(_rule)
@@ -316,29 +1946,298 @@ class BlackSalt():
         except RuleError as err:
             print err
 
+    def _profilesetrule(self, kwargs):
+        """
+        setrule() timed and counted by the profiler
+        """
+        _profiler = self.profiler
+        _start = time.time()
+        try:
+            _rule = _profiler.rule(kwargs)
+            self.rules.append(_rule)
+            _profiler.count("rules")
+            if _rule.warning:
+                _profiler.count("warnings")
+
+        except RuleError as err:
+            _profiler.count("errors")
+            print err
+        finally:
+            _profiler.record("setrule", time.time() - _start, notify=False)
+
+    #############
+    # SET RULES #
+    #############
+    @_profiled("setrules")
+    def setrules(self, rules):
+        """
+        @summary: Add many rules at once, with the same options as setrule().
+                  Each distinct value in a column is validated once and the
+                  rules are built in one pass, rows with an invalid value
+                  are skipped and reported rather than printed. An interface
+                  can be given as an "interface" name with a "direction"
+                  column. Empty values leave the option unset.
+        @rtype: OrderedDict {"added": int, "errors": [(row, option, message)],
+                "warnings": [(row, message)]}, rows count from 1 in the order
+                given, not counting a CSV's header
+        @param rules: an iterable of dicts, a dict of columns {option: [values]}
+                      or a str path or file-like object of a CSV with a header
+                      row of options
+        """
+        #: Nothing built here is garbage, collecting while it's built only
+        #: rescans the new tuples and rules over and over
+        _collecting = gc.isenabled()
+        gc.disable()
+        try:
+            _report = self._setrules(_bulkcolumns(rules))
+            if self.profiler is not None:
+                self.profiler.count("rules", _report["added"])
+                self.profiler.count("warnings", len(_report["warnings"]))
+                self.profiler.count("errors", len(_report["errors"]))
+            return _report
+        finally:
+            if _collecting:
+                gc.enable()
+
+    def _setrules(self, columns):
+        """
+        setrules() on validated columns, see setrules()
+        """
+        _count = len(columns.values()[0]) if columns else 0
+        _report = OrderedDict([("added", 0), ("errors", []), ("warnings", [])])
+        _slots = dict((_slot, [None] * _count) for _slot in Rule.fields)
+        _warned = _slots["warning"]
+        _failed = set()
+
+        #: Validate each column, once per distinct value
+        _direction = columns.pop("direction", None)
+        if _direction is not None and "interface" in columns:
+            columns["interface"] = [{"name": _name, "direction": _to} if type(_name) == str and _name else _name
+                                    for _name, _to in zip(columns["interface"], _direction)]
+        for _option, _values in columns.iteritems():
+            _setslots, _validate = _BULK[_option]
+            try:
+                _keys, _distinct = _values, set(_values)
+            except TypeError:
+                #: Dicts and lists as hashable tuples, this runs once per row
+                _keys = [tuple(sorted(_value.iteritems())) if type(_value) == dict else
+                         tuple(_value) if type(_value) == list else _value for _value in _values]
+                _distinct = set(_keys)
+            _fields = {}  # key -> the slot values
+            _errors, _warnings = {}, {}  # key -> message
+            if _option in _BULKCOLUMNS:
+                _fields = _BULKCOLUMNS[_option](_distinct)
+                _distinct = [_key for _key in _distinct if _key not in _fields]
+            for _key in _distinct:
+                if _key is None or _key == "":
+                    _fields[_key] = (None,) * len(_setslots)
+                    continue
+                try:
+                    _fields[_key], _warning = _validate(dict(_key) if type(_key) == tuple and _option == "interface"
+                                                        else list(_key) if type(_key) == tuple else _key)
+                    if _warning:
+                        _warnings[_key] = _warning
+                except (RuleError, ValueError, TypeError) as err:
+                    _fields[_key] = (None,) * len(_setslots)
+                    _errors[_key] = str(err).split("\n")[0]
+            _results = map(_fields.__getitem__, _keys)
+            for _slot, _column in zip(_setslots, zip(*_results) if _results else [()] * len(_setslots)):
+                _slots[_slot] = _column
+            if _errors or _warnings:
+                for _row, _key in enumerate(_keys, 1):
+                    if _key in _errors:
+                        _report["errors"].append((_row, _option, _errors[_key]))
+                        _failed.add(_row)
+                    elif _key in _warnings:
+                        _report["warnings"].append((_row, _warnings[_key]))
+                        _warned[_row - 1] = "Warning: %s" % _warnings[_key]
+        _report["errors"].sort()
+        _report["warnings"].sort()
+
+        #: Build the rules in one pass over the validated columns
+        _rows = zip(_slots["chain"], _slots["_ifname"], _slots["_ifdir"], zip(*[_slots[_slot] for _slot in _BULKSLOTS]))
+        if _failed:
+            _rows = [_values for _row, _values in enumerate(_rows, 1) if _row not in _failed]
+        _rules = []
+        _append, _new = _rules.append, Rule.__new__
+        for _chain, _ifname, _ifdir, _values in _rows:
+            _rule = _new(Rule)
+            (_rule.protocol, _rule.dst_port, _rule.src_port, _rule._network, _rule._mask, _rule._subnetform,
+             _rule._state, _rule.icmp, _rule.target, _rule.warning) = _values
+            _rule.chain = _chain
+            _rule._ifname = _ifname
+            #: The chain decides the interface direction, as in set_chain()
+            _rule._ifdir = "in" if _chain == "INPUT" else "out" if _chain == "OUTPUT" else _ifdir
+            _rule.extra = None
+            _append(_rule)
+
+        self.rules.extend(_rules)
+        _report["added"] = len(_rules)
+        if self.printmode:
+            print "Added %d rules, skipped %d rows with errors" % (len(_rules), len(_report["errors"]))
+        return _report
+
 
-class Rule():
+########
+# BULK #
+########
+def _bulkcolumns(rules):
+    """
+    @summary: setrules() input as columns of one length
+    @rtype: OrderedDict {option: list of values}
+    """
+    if type(rules) == str or hasattr(rules, "read"):
+        _source = open(rules, "rb") if type(rules) == str else rules
+        try:
+            _reader = csv.reader(_source)
+            _header = [_option.strip().lower() for _option in next(_reader, [])]
+            _rows = list(_reader)
+        finally:
+            if _source is not rules:
+                _source.close()
+        _columns = OrderedDict(zip(_header, [list(_column) for _column in zip(*_rows)] or [[]] * len(_header)))
+    elif isinstance(rules, dict):
+        _columns = OrderedDict((_option, list(_values)) for _option, _values in rules.iteritems())
+        if len(set(len(_values) for _values in _columns.itervalues())) > 1:
+            raise IPTablesError("setrules columns must all be the same length")
+    else:
+        _records = list(rules)
+        _columns = OrderedDict((_option, [_record.get(_option) for _record in _records])
+                               for _option in sorted(set().union(*_records)))
+    _unknown = set(_columns) - set(_BULK) - set(["direction"])
+    if _unknown:
+        raise IPTablesError("Unknown setrules options: %s" % ", ".join(sorted(_unknown)))
+    return _columns
+
+
+def _bulkrule(setter, slots):
+    """
+    @summary: A setrules() validator that runs a Rule setter on a blank rule
+              and keeps the slots it set
+    @rtype: function value -> (slot values, warning)
+    """
+    def _validate(value):
+        _rule = Rule.__new__(Rule)
+        _rule.chain = _rule._ifdir = None
+        setter(_rule, value)
+        return tuple(getattr(_rule, _slot) for _slot in slots), None
+    return _validate
+
+
+def _bulkprotocol(value):
+    _protocol = PROTOCOLS.lookup(value)
+    if not _protocol:
+        raise RuleError("protocol must be a valid protocol: %s" % ", ".join(PROTOCOLS))
+    return (_intern(_protocol),), None
+
+
+def _bulkicmp(value):
+    if type(value) == str and value.isdigit():
+        value = int(value)
+    if type(value) != int or not 0 <= value <= 255:
+        raise RuleError("ICMP must be an int from 0-40 or 41-255 for reserved")
+    return (value,), "You are using a reserved ICMP code; %s" % value if value > 40 else None
+
+
+def _bulktarget(value):
+    if type(value) != str:
+        raise RuleError("Target must be a string")
+    _target, _warning = _parsetarget(value)
+    return (_target,), _warning
+
+
+def _bulksubnet(value):
+    if type(value) != str:
+        raise RuleError("Subnet must be a string")
+    return parsesubnet(value), None
+
+
+def _bulksubnets(values):
+    """
+    @summary: parsesubnet() for the distinct values of a subnet column,
+              addresses and CIDRs share the parse of their first three
+              octets, the fields for the values it parsed; anything else
+              is left to _bulksubnet() and its error
+    @rtype: dict {value: (network, mask, form)}
+    """
+    _heads = {}  # "a.b.c" -> the packed first three octets, None if they aren't octets
+    _parsed = {}
+    for _value in values:
+        if type(_value) != str:
+            continue
+        _address, _sep, _length = _value.partition("/")
+        _head, _dot, _last = _address.rpartition(".")
+        if _head in _heads:
+            _network = _heads[_head]
+        else:
+            _octets = _head.split(".")
+            _network = _heads[_head] = (_OCTETS[_octets[0]] << 24 | _OCTETS[_octets[1]] << 16
+                                        | _OCTETS[_octets[2]] << 8) if len(_octets) == 3 \
+                and _octets[0] in _OCTETS and _octets[1] in _OCTETS and _octets[2] in _OCTETS else None
+        if _network is None or _last not in _OCTETS:
+            continue
+        if not _sep:
+            _parsed[_value] = (_network | _OCTETS[_last], 0xFFFFFFFF, SUBNET_ADDRESS)
+        elif _length in _PREFIXES:
+            _parsed[_value] = (_network | _OCTETS[_last], _PREFIXES[_length], SUBNET_CIDR)
+    return _parsed
+
+
+#: setrules() options, the Rule slots each one sets and its validator
+_BULK = OrderedDict([
+    ("chain", (["chain"], _bulkrule(lambda _rule, _value: _rule.set_chain(_value), ["chain"]))),
+    ("interface", (["_ifname", "_ifdir"],
+                   _bulkrule(lambda _rule, _value: _rule.set_interface(_value), ["_ifname", "_ifdir"]))),
+    ("protocol", (["protocol"], _bulkprotocol)),
+    ("dst", (["dst_port"], lambda _value: ((_parseport(_value, "dst"),), None))),
+    ("src", (["src_port"], lambda _value: ((_parseport(_value, "src"),), None))),
+    ("subnet", (["_network", "_mask", "_subnetform"], _bulksubnet)),
+    ("state", (["_state"], _bulkrule(lambda _rule, _value: _rule.set_state(_value), ["_state"]))),
+    ("icmp", (["icmp"], _bulkicmp)),
+    ("target", (["target"], _bulktarget)),
+])
+
+#: setrules() options with a validator for all of a column's distinct values at once, see _bulksubnets()
+_BULKCOLUMNS = {"subnet": _bulksubnets}
+
+#: The Rule slots setrules() sets together, besides the chain and interface
+_BULKSLOTS = ["protocol", "dst_port", "src_port", "_network", "_mask", "_subnetform", "_state", "icmp", "target",
+              "warning"]
+
+
+class Rule(object):
     """
     This class will generate a new rule for us, we'll pass it parameters,
     depending on the parameters of the rule, the output function for the
     rule will change. An object of initializing parameters will be passed
-    to create the rule
+    to create the rule. Rules are kept compact; the fields live in slots,
+    strings are interned, the subnet is packed into ints and the interface
+    and state are stored flat, the interface, subnet and state properties
+    give them back in their usual dict, string and list forms. The rendered
+    rule and its fingerprint are cached until a set_* method or setup()
+    changes it; after writing a field directly call invalidate().
     """
+    fields = ("protocol", "_ifname", "_ifdir", "dst_port", "src_port", "_network", "_mask",
+              "_subnetform", "_state", "chain", "icmp", "target", "extra", "warning")
+    __slots__ = fields + ("_text", "_fingerprint")
+
     def __init__(self, **kwargs):
         self.protocol = None  # i.e tcp, udp, icmp
-        self.protocols = ["tcp", "udp", "icmp", "all"]  # The 3 default protocols
-        self.interface = {"name": None, "direction": None}
+        self._ifname = None  # i.e. eth0
+        self._ifdir = None  # in or out
         self.dst_port = None
         self.src_port = None
-        self.subnet = None
-        self.state = None  # Loads (-m state) module, accepts list like ["new", "established", "related"]#
+        self._network = None  # The subnet address packed into an int
+        self._mask = None  # The subnet mask packed into an int
+        self._subnetform = None  # SUBNET_ADDRESS, SUBNET_CIDR or SUBNET_NETMASK
+        self._state = None  # Loads (-m state) module, an interned tuple like ("NEW", "ESTABLISHED")
         self.chain = None
         self.icmp = None  # This should be an int for ICMP code
         self.target = None  # ACCEPT, DROP, QUEUE, RETURN
-        self.protocolsfile = "/etc/protocols"
+        self.extra = None  # Any other match options, written verbatim before the target
         self.warning = None  # If this rule gets a warning, it will be stored here.
-        #: Set the default protocols
-        self.set_default_protocols()
+        self._text = None  # The cached generate(), None when it has to be rendered again
+        self._fingerprint = None  # The cached fingerprint()
         #: Set the rules
         self.setup(**kwargs)
 
@@ -349,10 +2248,122 @@ class Rule():
 
         return "No parameters set for rule"
 
-    ##########
-    # SET UP #
-    ##########
-    def setup(self, **kwargs):
+    def __eq__(self, other):
+        return isinstance(other, Rule) and self.fingerprint() == other.fingerprint()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(self.fingerprint())
+
+    def copy(self):
+        """
+        @summary: A new Rule with the same settings as this one, it renders
+                  again after its fields are changed without invalidate()
+        @rtype: Rule
+        """
+        _rule = Rule.__new__(Rule)
+        for _slot in Rule.fields:
+            setattr(_rule, _slot, getattr(self, _slot))
+        _rule._text = _rule._fingerprint = None
+        return _rule
+
+    ##############
+    # INVALIDATE #
+    ##############
+    def invalidate(self):
+        """
+        @summary: Drop the cached rendering and fingerprint, for when a field
+                  is written directly rather than through a set_* method
+        @rtype: None
+        @param: None
+        """
+        self._text = self._fingerprint = None
+
+    ###############
+    # FINGERPRINT #
+    ###############
+    def fingerprint(self):
+        """
+        @summary: A stable fingerprint of the rule, the sha1 of generate(),
+                  so two rules that render the same have the same fingerprint
+                  in any process; rules compare and hash by it, so the same
+                  rule added twice is found with a set or dict
+        @rtype: str
+        @param: None
+        """
+        try:
+            if self._fingerprint is not None:
+                return self._fingerprint
+        except AttributeError:
+            pass
+        self._fingerprint = hashlib.sha1(self.generate()).hexdigest()
+        return self._fingerprint
+
+    ###############
+    # MATCH SPACE #
+    ###############
+    def matchspace(self):
+        """
+        @summary: The packets this rule matches, as a MatchSpace, for
+                  comparing rules with each other
+        @rtype: MatchSpace
+        """
+        return MatchSpace(self)
+
+    ##############
+    # PROPERTIES #
+    ##############
+    def _get_interface(self):
+        return {"name": self._ifname, "direction": self._ifdir}
+
+    def _set_interface(self, params):
+        self._text = self._fingerprint = None
+        if params is None:
+            self._ifname = self._ifdir = None
+        else:
+            self._ifname = _intern(params.get("name"))
+            self._ifdir = _intern(params.get("direction"))
+
+    interface = property(_get_interface, _set_interface)
+
+    def _get_subnet(self):
+        if self._network is None:
+            return None
+        if self._subnetform == SUBNET_CIDR:
+            return "%s/%d" % (_unpackaddr(self._network), _masklen(self._mask))
+        if self._subnetform == SUBNET_NETMASK:
+            return "%s/%s" % (_unpackaddr(self._network), _unpackaddr(self._mask))
+        return _unpackaddr(self._network)
+
+    def _set_subnet(self, subnet):
+        self._text = self._fingerprint = None
+        if subnet is None:
+            self._network = self._mask = self._subnetform = None
+        else:
+            self.set_subnet(subnet)
+
+    subnet = property(_get_subnet, _set_subnet)
+
+    def _get_state(self):
+        if self._state is None:
+            return None
+        return list(self._state)
+
+    def _set_state(self, param):
+        self._text = self._fingerprint = None
+        if param is None:
+            self._state = None
+        else:
+            self.set_state(param)
+
+    state = property(_get_state, _set_state)
+
+    ##########
+    # SET UP #
+    ##########
+    def setup(self, **kwargs):
         """
         @summary:  This is called on initialisation, the kwargs are forwarded
                    to this function which sets the rule up. It can also be used
@@ -406,22 +2417,13 @@ class Rule():
     #########################
     def set_default_protocols(self):
         """
-        @summary: This function takes no arguments, instead it takes the protocolsfile
-                  address and tries to open it if it exists. It will pass it and try to
-                  pull out valid protocols, these can be used when specifying a rule.
-                  They will be appended to the current list of allowed protocols
+        @summary: This function takes no arguments, the allowed protocols are kept in
+                  the shared PROTOCOLS registry, this forces it to reload the protocols
+                  file rather than wait for the next mtime check.
         @rtype: None
         @param: None
         """
-        if os.path.exists(self.protocolsfile) and os.access(self.protocolsfile, os.R_OK):
-            _protocolsfile = open(self.protocolsfile, 'r').readlines()
-            for _line in _protocolsfile:
-                if _line[0] not in ["#", "\w", "\n"]:
-                    _allowedprotocol = _line.split("\t")[0]
-                    if _allowedprotocol not in self.protocols:
-                        self.protocols.append(_allowedprotocol)
-        else:
-            return
+        PROTOCOLS.refresh(force=True)
 
     ##########################
     # SET RULE PROTOCOL TYPE #
@@ -429,15 +2431,18 @@ class Rule():
     def set_protocol(self, opts=None):
         """
         @summary: Sets the protocol to be used, it requires that the protocol is in the default
-                  protocols which is collected from the system or tcp, udp or icmp
+                  protocols which is collected from the system or tcp, udp or icmp. Protocol
+                  numbers from the protocols file are allowed too.
         @rtype: None
-        @param opts: str
+        @param opts: str or int
         """
-        if type(opts) == str:
-            if opts in self.protocols:
-                self.protocol = opts
+        self._text = self._fingerprint = None
+        if type(opts) == str or type(opts) == int:
+            _protocol = PROTOCOLS.lookup(opts)
+            if _protocol:
+                self.protocol = _intern(_protocol)
             else:
-                print "protocol must be a valid protocol: %s" % ", ".join(self.protocols)
+                print "protocol must be a valid protocol: %s" % ", ".join(PROTOCOLS)
         else:
             print "protocol must be a string i.e. 'tcp'"
             return
@@ -448,40 +2453,19 @@ class Rule():
     def set_port(self, **kwargs):
         """
         @summary: Set the destination port, set the source port to None.
-                  The argument must be dst=80 or src=80 etc
+                  The argument must be dst=80 or src=80 etc, a port from
+                  0-65535
         @rtype: None
         @param **kwargs: dst=str/int, src=str/int
         """
+        self._text = self._fingerprint = None
         #: If we get a destination port
         if "dst" in kwargs:
-            if kwargs["dst"] is None:
-                self.dst_port = None
-
-            if type(kwargs["dst"]) == str:
-                try:
-                    #: Try to convert the argument to an int
-                    kwargs["dst"] = int(kwargs["dst"])
-                except TypeError:
-                    raise RuleError("dst option must be an integer or a string integer")
-
-            if type(kwargs["dst"]) == int:
-                #: Set the dst_port to the port number and set src_port to blank
-                self.dst_port = kwargs["dst"]
+            self.dst_port = _parseport(kwargs["dst"], "dst")
 
         #: If we get a source port
         elif "src" in kwargs:
-            if kwargs["src"] is None:
-                self.src_port = None
-            if type(kwargs["src"]) == str:
-                try:
-                    #: Try to convert the argument to an int
-                        kwargs["src"] = int(kwargs["src"])
-                except TypeError:
-                    raise RuleError("src option must be an integer or a string integer")
-
-            if type(kwargs["src"]) == int:
-                #: Set the dst_port to the port number and set src_port to blank
-                self.src_port = kwargs["src"]
+            self.src_port = _parseport(kwargs["src"], "src")
 
         #: If we get an unknown kwarg, show an error
         else:
@@ -494,33 +2478,34 @@ class Rule():
     def set_subnet(self, subnet):
         """
         @summary: Set subnet for this rule, it accepts only a string and must match proper
-                  subnetting format:
+                  subnetting format, see parsesubnet():
                   xxx.xxx.xxx.xxx
                   xxx.xxx.xxx.xxx/24
-                  xxx.xxx.xxx.xxx/xxx.xxx.xxx.xxx.xxx
+                  xxx.xxx.xxx.xxx/xxx.xxx.xxx.xxx
+                  It's kept as a packed network and mask.
+        @rtype: None
+        @param subnet: str, None removes the subnet
+        """
+        self._text = self._fingerprint = None
+        if subnet is None:
+            self._network = self._mask = self._subnetform = None
+        elif type(subnet) == str:
+            self._network, self._mask, self._subnetform = parsesubnet(subnet)
+        else:
+            raise RuleError("Subnet must be a string")
+
+    ###############
+    # PACK SUBNET #
+    ###############
+    def pack_subnet(self, subnet):
+        """
+        @summary: Store an already validated subnet string as a packed address
+                  and mask, remembering which of the three forms it was given in.
         @rtype: None
         @param subnet: str
         """
-        #_maxmask = "([01][0-9][0-9]|2[0-4][0-9]|25[0-5])" # 1-255
-        _maxmask = "([0-9]|[1-9][0-9]|1[0-9][0-9]|2[0-4][0-9]|25[0-5])"  # 1-255
-        _maxcidr = "([1-9]|1[0-9]|2[0-4])"  # 1-24
-        _netmatch = "%s\.%s\.%s\.%s" % (_maxmask, _maxmask, _maxmask, _maxmask)  # 1-255.1-255.1-255.1-255
-        _patterns = [
-            re.compile("^%s$" % _netmatch),
-            re.compile("^%s\/%s$" % (_netmatch, _netmatch)),
-            re.compile("^%s\/%s$" % (_netmatch, _maxcidr))
-        ]
-        if type(subnet) == str:
-            #: If our subnet is a string and it matches one of our patterns, then set the subnet
-            for _pattern in _patterns:
-                if re.match(_pattern, subnet):
-                    self.subnet = subnet
-                    return
-            #: If we don't match a pattern, return an error and set subnet to false
-            raise RuleError("""Subnet must match the following patterns:
-            1-255.1-255.1-255    i.e. 172.16.10.23
-            1-255.1-255.1-255/1-24   i.e. 172.16.10.0/24
-            1-255.1-255.1-255/1-255.1-255.1-255.1-255    i.e 172.16.10.0/255.255.255.0""")
+        self._text = self._fingerprint = None
+        self._network, self._mask, self._subnetform = parsesubnet(subnet)
 
     #############
     # SET STATE #
@@ -533,21 +2518,25 @@ class Rule():
         @rtype: None
         @param param: str or list
         """
+        self._text = self._fingerprint = None
         _allowed = ["new", "established", "related", "invalid"]
-        self.state = []
-        #: If we get a string, split it by comma and re-run the function
+        #: If we get a string, split it by comma
         if type(param) == str:
-            self.set_state(param.split(","))
+            param = param.split(",")
         #: If we get a list, check parameter against allowed and add them to state
-        elif type(param) == list:
+        if type(param) == list:
+            _states = []
             for _state in param:
                 if type(_state) == str:
                     _state = _state.strip()
-                    if type(_state) == str and _state.lower() in _allowed:
-                        self.state.append(_state.upper().replace(" ", ""))
-
+                    if _state.lower() in _allowed:
+                        _states.append(intern(_state.upper().replace(" ", "")))
+            #: Share one tuple between every rule with the same states
+            _states = tuple(_states)
+            self._state = _STATES.setdefault(_states, _states)
             return
         else:
+            self._state = ()
             raise RuleError("Invalid State Format; must be string, a comma delimited string or list")
 
     #############
@@ -563,24 +2552,22 @@ class Rule():
         @rtype: None
         @param param: str, list or comma delimited str
         """
+        self._text = self._fingerprint = None
         _default = ["INPUT", "OUTPUT", "FORWARD"]
         if type(param) == str:
             #: If the chain is in the list of defaults add it as uppercase
             if param.upper() in _default:
-                self.chain = param.upper()
+                self.chain = intern(param.upper())
                 #: If the chain is input, set the interface direction to -i
-                if self.chain and self.chain == "INPUT":
-                    if type(self.interface) == dict:
-                        self.interface["direction"] = "in"
-                    else:
-                        self.interface = {"name": None, "direction": "in"}
+                if self.chain == "INPUT":
+                    self._ifdir = "in"
 
                 #: If the chain is output, set the interface direction to -o
-                if self.chain and self.chain == "OUTPUT":
-                    if type(self.interface) == dict:
-                        self.interface["direction"] = "out"
-                    else:
-                        self.interface = {"name": None, "direction": "out"}
+                if self.chain == "OUTPUT":
+                    self._ifdir = "out"
+            #: Otherwise it's a user defined chain, these are case sensitive
+            else:
+                self.chain = intern(param)
             return
         raise RuleError("Chain must be a string")
 
@@ -592,23 +2579,17 @@ class Rule():
         @summary: This simply sets the icmp protocol. Setting this will
                   adjust the presentation of the rule.
         @rtype : None
-        @type param: int (1-40 for valid or 41-255 for reserved ICMP protocol)
+        @type param: int (0-40 for valid or 41-255 for reserved ICMP types)
         """
-        _valid = range(1, 40)
-        _reserved = range(41, 255)
-
-        if type(param) == int:
-            #: If our code is in the valid range; set icmp
-            if param in _valid:
-                self.icmp = param
-                return
-            if param in _reserved:
-            #: If our code is in the reserved range; warn, set icmp
-                self.icmp = param
+        self._text = self._fingerprint = None
+        if type(param) == int and 0 <= param <= 255:
+            self.icmp = param
+            #: If our type is in the reserved range; warn
+            if param > 40:
                 self.warn("You are using a reserved ICMP code; %s" % param)
-                return
+            return
 
-        return RuleError("ICMP must be an int from 1-40 or 41,255 for reserved")
+        raise RuleError("ICMP must be an int from 0-40 or 41-255 for reserved")
 
     ##############
     # SET TARGET #
@@ -618,18 +2599,18 @@ class Rule():
         @summary: This will set the target or action for the rule
                   extentions can allow for other targets, a warning
                   is raised if a default rule isn't used, but an
-                  exception is not raised.
+                  exception is not raised. Extension targets like LOG
+                  are uppercased, anything else is taken to be a user
+                  defined chain and kept as it is.
         @rtype: None
         @param param: Case-insensitive String for target or action:
                       ACCEPT, DROP, QUEUE or RETURN
         """
-        _default = ["ACCEPT", "DROP", "QUEUE", "RETURN"]
+        self._text = self._fingerprint = None
         if type(param) == str:
-            if param.upper() in _default:
-                self.target = param.upper()
-            else:
-                self.target = param
-                self.warn("Using a non default target %s" % param)
+            self.target, _warning = _parsetarget(param)
+            if _warning:
+                self.warn(_warning)
             return
 
         raise RuleError("Target must be a string")
@@ -647,6 +2628,7 @@ class Rule():
         @rtype: None
         @param params: dict {"name": "eth1", "direction": "in"}
         """
+        self._text = self._fingerprint = None
         _directions = ["in", "out"]
 
         if type(params) == dict:
@@ -657,13 +2639,14 @@ class Rule():
                     if params["direction"] not in _directions:
                         raise RuleError("Invalid direction passed to interface; must be 'in' or 'out'")
                     #: Set the interface
-                    self.interface = {"name": params["name"], "direction": params["direction"]}
+                    self._ifname = intern(params["name"])
+                    self._ifdir = intern(params["direction"])
                     #: If the chain is INPUT set direction to in
                     if self.chain and self.chain.upper() == "INPUT":
-                        self.interface["direction"] = "in"
+                        self._ifdir = "in"
                     #: If the chain is OUTPUT set the direction to out
                     elif self.chain and self.chain.upper() == "OUTPUT":
-                        self.interface["direction"] = "out"
+                        self._ifdir = "out"
                     return
 
             raise RuleError("set_interface needs to be called with a dictionary {'name': str, 'direction': str}")
@@ -681,6 +2664,13 @@ class Rule():
         @rtype: str
         @param: none
         """
+        #: Rules built without __init__, i.e. by the parser, start without a cache
+        try:
+            if self._text is not None:
+                return self._text
+        except AttributeError:
+            pass
+
         #: Initiate default and empty values
         _protocol = None
         _subnet = None
@@ -691,46 +2681,42 @@ class Rule():
         _chain = None
         _icmp = None
         _target = None
+        _extra = self.extra
 
         #: Check our variables and set the string values
         if self.protocol and type(self.protocol) == str:
             _protocol = "-p %s" % self.protocol
-        if self.interface and type(self.interface) == dict:  # {"name": None, "direction": None}
-            if "name" in self.interface and "direction" in self.interface:
-                #: Make sure we get an interface name before we assign _interage or we'll
-                #: End up with i.e. -i None  or -o None
-                if self.interface["name"]:
-                    if self.interface["direction"] == "in":
-                        _interface = "-i %s" % str(self.interface["name"])
-                    if self.interface["direction"] == "out":
-                        _interface = "-o %s" % str(self.interface["name"])
+        #: Make sure we get an interface name before we assign _interface or we'll
+        #: End up with i.e. -i None  or -o None
+        if self._ifname:
+            if self._ifdir == "in":
+                _interface = "-i %s" % str(self._ifname)
+            if self._ifdir == "out":
+                _interface = "-o %s" % str(self._ifname)
         if self.dst_port and (type(self.dst_port) == str or type(self.dst_port) == int):
             _dst_port = "--dport %s" % str(self.dst_port)
         if self.src_port and (type(self.src_port) == str or type(self.src_port) == int):
             _src_port = "--sport %s" % str(self.src_port)
-        if self.subnet and type(self.subnet) == str:
+        if self._network is not None:
             _subnet = "-s %s" % self.subnet
-        if self.state and type(self.state) == list:
-            _state = "-m state --state %s" % ','.join(self.state)
+        if self._state:
+            _state = "-m state --state %s" % ','.join(self._state)
         if self.chain and type(self.chain) == str:
             _chain = "-A %s" % self.chain
-        if self.icmp and type(self.icmp) == int:
+        if type(self.icmp) == int:
             _protocol = "-p icmp"
             _dst_port = None
             _src_port = None
             _icmp = "--icmp-type %d" % self.icmp
         if self.target and type(self.target) == str:
-            _target = "-j %s" % self.target.upper()
+            _target = "-j %s" % self.target
 
         #: We'll now store these values in their generally expected order
-        _rule = [_chain, _interface, _protocol, _icmp, _subnet, _src_port, _dst_port, _state, _target]
-        _finalstr = ""
-        #: We'll loop through our values and then construct our final rule if they exists
-        for entry in _rule:
-            if entry:
-                _finalstr = "%s %s" % (_finalstr, entry)
-
-        return _finalstr
+        _rule = [_chain, _interface, _protocol, _icmp, _subnet, _src_port, _dst_port, _state, _extra, _target]
+        #: And join the ones that exist in one go, with the leading space rules have always had
+        _parts = " ".join(filter(None, _rule))
+        self._text = " %s" % _parts if _parts else ""
+        return self._text
 
     ########
     # WARN #
@@ -745,3 +2731,3178 @@ class Rule():
         _msg = "Warning: %s" % msg
         self.warning = _msg
         print _msg
+
+
+#############
+# RULETABLE #
+#############
+class RuleTable(object):
+    """
+    A column-wise store for BlackSalt.rules, BlackSalt(rulestore="table").
+    Every rule field is kept in its own array and strings are pooled, so a
+    rule costs a few dozen bytes rather than an instance. It behaves like
+    the rules list, rules are packed on the way in and unpacked into a new
+    Rule on the way out; changing a rule taken from the table doesn't change
+    the table, set it back with table[i] = rule.
+    """
+    def __init__(self, rules=None):
+        self._pool = [None]  # Pooled strings and state tuples, 0 is None
+        self._poolindex = {None: 0}
+        self._raw = array("i")  # Pool index of a flush/policy string, 0 for a Rule
+        self._chain = array("i")
+        self._target = array("i")
+        self._protocol = array("i")
+        self._ifname = array("i")
+        self._ifdir = array("i")
+        self._state = array("i")
+        self._network = array("I")
+        self._mask = array("I")
+        self._subnetform = array("b")  # -1 for no subnet
+        self._dst_port = array("l")  # -1 for no port
+        self._src_port = array("l")
+        self._icmp = array("h")  # -1 for no icmp type
+        self._extra = array("i")
+        self._warnings = {}  # Only a few rules have warnings, so keep them by row
+        self._columns = (self._raw, self._chain, self._target, self._protocol, self._ifname,
+                         self._ifdir, self._state, self._network, self._mask, self._subnetform,
+                         self._dst_port, self._src_port, self._icmp, self._extra)
+        if rules:
+            self.extend(rules)
+
+    def __len__(self):
+        return len(self._raw)
+
+    def __iter__(self):
+        for _row in xrange(len(self._raw)):
+            yield self._unpack(_row)
+
+    def __getitem__(self, index):
+        if type(index) == slice:
+            return [self._unpack(_row) for _row in xrange(*index.indices(len(self)))]
+        return self._unpack(self._row(index))
+
+    def __setitem__(self, index, rule):
+        _row = self._row(index)
+        self._warnings.pop(_row, None)
+        for _column, _value in zip(self._columns, self._pack(rule, _row)):
+            _column[_row] = _value
+
+    def __delitem__(self, index):
+        self.pop(index)
+
+    def __repr__(self):
+        return "<RuleTable: %d rules>" % len(self)
+
+    def append(self, rule):
+        for _column, _value in zip(self._columns, self._pack(rule, len(self))):
+            _column.append(_value)
+
+    def extend(self, rules):
+        for _rule in rules:
+            self.append(_rule)
+
+    def insert(self, index, rule):
+        _row = min(max(index + len(self) if index < 0 else index, 0), len(self))
+        self._shiftwarnings(_row, 1)
+        for _column, _value in zip(self._columns, self._pack(rule, _row)):
+            _column.insert(_row, _value)
+
+    def pop(self, index=-1):
+        _row = self._row(index)
+        _rule = self._unpack(_row)
+        for _column in self._columns:
+            _column.pop(_row)
+        self._warnings.pop(_row, None)
+        self._shiftwarnings(_row, -1)
+        return _rule
+
+    ###########
+    # HELPERS #
+    ###########
+    def _row(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("RuleTable index out of range")
+        return index
+
+    def _shiftwarnings(self, row, offset):
+        if self._warnings:
+            self._warnings = dict((_row + offset if _row >= row else _row, _msg)
+                                  for _row, _msg in self._warnings.iteritems())
+
+    def _id(self, value):
+        _index = self._poolindex.get(value)
+        if _index is None:
+            _index = self._poolindex[value] = len(self._pool)
+            self._pool.append(value)
+        return _index
+
+    def _pack(self, rule, row):
+        """
+        Pack a Rule or a flush/policy string into a tuple of column values
+        """
+        if not isinstance(rule, Rule):
+            return (self._id(str(rule)), 0, 0, 0, 0, 0, 0, 0, 0, -1, -1, -1, -1, 0)
+        if rule.warning:
+            self._warnings[row] = rule.warning
+        _subnet = rule._network is not None
+        return (0, self._id(rule.chain), self._id(rule.target), self._id(rule.protocol),
+                self._id(rule._ifname), self._id(rule._ifdir), self._id(rule._state),
+                rule._network if _subnet else 0, rule._mask if _subnet else 0,
+                rule._subnetform if _subnet else -1,
+                -1 if rule.dst_port is None else rule.dst_port,
+                -1 if rule.src_port is None else rule.src_port,
+                -1 if rule.icmp is None else rule.icmp, self._id(rule.extra))
+
+    def _unpack(self, row):
+        """
+        Unpack a row back into a new Rule, or the flush/policy string
+        """
+        _pool = self._pool
+        if self._raw[row]:
+            return _pool[self._raw[row]]
+        _rule = Rule.__new__(Rule)
+        _rule.chain = _pool[self._chain[row]]
+        _rule.target = _pool[self._target[row]]
+        _rule.protocol = _pool[self._protocol[row]]
+        _rule._ifname = _pool[self._ifname[row]]
+        _rule._ifdir = _pool[self._ifdir[row]]
+        _rule._state = _pool[self._state[row]]
+        if self._subnetform[row] == -1:
+            _rule._network = _rule._mask = _rule._subnetform = None
+        else:
+            _rule._network = self._network[row]
+            _rule._mask = self._mask[row]
+            _rule._subnetform = self._subnetform[row]
+        _rule.dst_port = None if self._dst_port[row] == -1 else self._dst_port[row]
+        _rule.src_port = None if self._src_port[row] == -1 else self._src_port[row]
+        _rule.icmp = None if self._icmp[row] == -1 else self._icmp[row]
+        _rule.extra = _pool[self._extra[row]]
+        _rule.warning = self._warnings.get(row)
+        return _rule
+
+
+#############
+# RULEINDEX #
+#############
+class RuleIndex(object):
+    """
+    An indexed store for BlackSalt.rules, BlackSalt(rulestore="indexed").
+    It behaves like the rules list, and also gives every entry a stable id
+    that survives inserts and deletes around it, so rules can be inserted
+    before or after, replaced or deleted by id. The ids are kept in order
+    in blocks of at most blocksize, so finding, inserting or deleting an
+    id touches one block rather than shifting the whole list. Rules are
+    indexed on their chain, target, protocol, interface and ports, and
+    their subnets by prefix, so query() answers from the indexes rather
+    than scanning every rule. A rule is indexed as it was when it was
+    added, change a rule in the store with replace().
+    """
+    blocksize = 512  # Ids in a block before it's split in two
+    #: The fields query() can look rules up on, and the Rule slot each is indexed from
+    fields = OrderedDict([("chain", "chain"), ("target", "target"), ("protocol", "protocol"),
+                          ("interface", "_ifname"), ("dport", "dst_port"), ("sport", "src_port")])
+
+    def __init__(self, rules=None):
+        self.reset(rules or [])
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __iter__(self):
+        _entries = self._entries
+        for _block in self._blocks:
+            for _id in _block:
+                yield _entries[_id]
+
+    def __getitem__(self, index):
+        if type(index) == slice:
+            return [self._entries[_id] for _id in self.ids()][index]
+        return self._entries[self.at(index)]
+
+    def __setitem__(self, index, rule):
+        self.replace(self.at(index), rule)
+
+    def __delitem__(self, index):
+        self.delete(self.at(index))
+
+    def __repr__(self):
+        return "<RuleIndex: %d rules>" % len(self)
+
+    #########
+    # RESET #
+    #########
+    def reset(self, rules):
+        """
+        @summary: Replace every entry, entries that were already in the store
+                  keep their ids, so an optimisation pass through
+                  BlackSalt.replacerules() doesn't renumber the rules it kept
+        @rtype: None
+        @param rules: iterable of Rule or str
+        """
+        _kept = dict((id(_entry), _id) for _id, _entry in getattr(self, "_entries", {}).iteritems())
+        self._entries = {}  # id -> Rule or flush/policy string
+        self._blocks = [[]]  # The ids in order
+        self._blockof = {}  # id -> the block holding it
+        self._starts = None  # The position of each block's first id, None when it has to be worked out again
+        #: Ids are never issued twice, not even ones deleted before the reset
+        self._next = max([getattr(self, "_next", 1)] + [_id + 1 for _id in _kept.itervalues()])
+        self._indexes = dict((_field, {}) for _field in RuleIndex.fields)  # field -> {value: set of ids}
+        self._prefixes = [{} for _length in range(33)]  # prefix length -> {network: set of ids}
+        self._networks = [[] for _length in range(33)]  # prefix length -> sorted networks
+        self._masked = set()  # The ids of rules with a mask that isn't a plain prefix
+        for _entry in rules:
+            self._add(_entry, _kept.pop(id(_entry), None))
+
+    ########
+    # LIST #
+    ########
+    def append(self, rule):
+        """
+        @summary: Add an entry at the end
+        @rtype: int (its id)
+        """
+        return self._add(rule)
+
+    def extend(self, rules):
+        for _rule in rules:
+            self._add(_rule)
+
+    def insert(self, index, rule):
+        """
+        @summary: Insert an entry before the one at index, as list.insert()
+        @rtype: int (its id)
+        """
+        if index < 0:
+            index += len(self)
+        if index >= len(self):
+            return self._add(rule)
+        return self.insertbefore(self.at(max(index, 0)), rule)
+
+    def pop(self, index=-1):
+        return self.delete(self.at(index))
+
+    ######
+    # ID #
+    ######
+    def ids(self):
+        """
+        @summary: The ids in order
+        @rtype: generator of int
+        """
+        for _block in self._blocks:
+            for _id in _block:
+                yield _id
+
+    def iteritems(self):
+        """
+        @summary: The (id, entry) pairs in order
+        @rtype: generator
+        """
+        for _id in self.ids():
+            yield _id, self._entries[_id]
+
+    def get(self, ruleid):
+        """
+        @summary: The entry with an id
+        @rtype: Rule or str
+        """
+        try:
+            return self._entries[ruleid]
+        except KeyError:
+            raise IndexError("No rule with id %s" % ruleid)
+
+    def at(self, index):
+        """
+        @summary: The id of the entry at a 0-based position
+        @rtype: int
+        """
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError("RuleIndex index out of range")
+        _starts = self._positions()
+        _block = bisect_right(_starts, index) - 1
+        return self._blocks[_block][index - _starts[_block]]
+
+    def position(self, ruleid):
+        """
+        @summary: The 0-based position of the entry with an id
+        @rtype: int
+        """
+        _block = self._blockof.get(ruleid)
+        if _block is None:
+            raise IndexError("No rule with id %s" % ruleid)
+        _starts = self._positions()
+        return _starts[self._blockindex[id(_block)]] + _block.index(ruleid)
+
+    ###########
+    # EDITING #
+    ###########
+    def insertbefore(self, ruleid, rule):
+        """
+        @summary: Insert an entry before the one with an id
+        @rtype: int (the new entry's id)
+        """
+        self.get(ruleid)
+        _block = self._blockof[ruleid]
+        return self._add(rule, at=(_block, _block.index(ruleid)))
+
+    def insertafter(self, ruleid, rule):
+        """
+        @summary: Insert an entry after the one with an id
+        @rtype: int (the new entry's id)
+        """
+        self.get(ruleid)
+        _block = self._blockof[ruleid]
+        return self._add(rule, at=(_block, _block.index(ruleid) + 1))
+
+    def replace(self, ruleid, rule):
+        """
+        @summary: Put an entry in the place of the one with an id, keeping
+                  the id
+        @rtype: Rule or str (the entry replaced)
+        """
+        _old = self.get(ruleid)
+        self._unindex(ruleid, _old)
+        self._entries[ruleid] = rule
+        self._index(ruleid, rule)
+        return _old
+
+    def delete(self, ruleid):
+        """
+        @summary: Remove the entry with an id
+        @rtype: Rule or str (the entry removed)
+        """
+        _entry = self.get(ruleid)
+        self._unindex(ruleid, _entry)
+        del self._entries[ruleid]
+        _block = self._blockof.pop(ruleid)
+        _block.remove(ruleid)
+        if not _block and len(self._blocks) > 1:
+            self._positions()
+            del self._blocks[self._blockindex[id(_block)]]
+        self._starts = None
+        return _entry
+
+    #########
+    # QUERY #
+    #########
+    def query(self, **criteria):
+        """
+        @summary: The ids, in order, of the rules matching every criterion;
+                  chain, target, protocol, interface, dport and sport are
+                  looked up by value, subnet finds the rules whose subnet
+                  overlaps it, i.e. query(subnet="10.0.0.0/8", interface="eth0")
+                  for every rule touching 10.0.0.0/8 on eth0. Rules without a
+                  subnet aren't counted as touching one.
+        @rtype: list of int
+        @param criteria: chain, target, protocol, interface, dport, sport, subnet
+        """
+        _sets = []
+        for _field, _value in criteria.iteritems():
+            if _field == "subnet":
+                _sets.append(self._overlapping(_value))
+            elif _field in self._indexes:
+                _sets.append(self._indexes[_field].get(self._key(_field, _value), set()))
+            else:
+                raise IPTablesError("Rules can be queried on subnet, %s" % ", ".join(RuleIndex.fields))
+        if not _sets:
+            return list(self.ids())
+        _sets.sort(key=len)
+        _ids = set(_sets[0])
+        for _set in _sets[1:]:
+            _ids &= _set
+        #: Few matches are put in order by their position, many by a pass over the order
+        if len(_ids) * self.blocksize < len(self):
+            return sorted(_ids, key=self.position)
+        return [_id for _id in self.ids() if _id in _ids]
+
+    ###########
+    # HELPERS #
+    ###########
+    def _add(self, rule, ruleid=None, at=None):
+        if ruleid is None:
+            ruleid = self._next
+            self._next += 1
+        if at is None:
+            _block, _offset = self._blocks[-1], len(self._blocks[-1])
+        else:
+            _block, _offset = at
+        _block.insert(_offset, ruleid)
+        self._blockof[ruleid] = _block
+        self._entries[ruleid] = rule
+        if len(_block) > self.blocksize:
+            self._split(_block)
+        self._starts = None
+        self._index(ruleid, rule)
+        return ruleid
+
+    def _split(self, block):
+        self._positions()
+        _half = block[len(block) // 2:]
+        del block[len(block) // 2:]
+        for _id in _half:
+            self._blockof[_id] = _half
+        self._blocks.insert(self._blockindex[id(block)] + 1, _half)
+        self._starts = None
+
+    def _positions(self):
+        """
+        The position of each block's first id, and each block's index by its id()
+        """
+        if self._starts is None:
+            _starts, _at = [], 0
+            for _block in self._blocks:
+                _starts.append(_at)
+                _at += len(_block)
+            self._starts = _starts
+            self._blockindex = dict((id(_block), _index) for _index, _block in enumerate(self._blocks))
+        return self._starts
+
+    def _key(self, field, value):
+        """
+        A query value as it's stored in a Rule
+        """
+        if field == "chain" and value.upper() in BUILTIN_CHAINS:
+            return value.upper()
+        if field == "target":
+            return _parsetarget(value)[0]
+        if field in ["dport", "sport"]:
+            return _parseport(value, field)
+        return value
+
+    def _index(self, ruleid, rule):
+        if not isinstance(rule, Rule):
+            return
+        for _field, _slot in RuleIndex.fields.iteritems():
+            _value = getattr(rule, _slot)
+            if _value is not None:
+                self._indexes[_field].setdefault(_value, set()).add(ruleid)
+        if rule._network is None:
+            return
+        if not _contiguous(rule._mask):
+            self._masked.add(ruleid)
+            return
+        _length = _masklen(rule._mask)
+        _network = rule._network & rule._mask
+        _prefixes = self._prefixes[_length]
+        if _network not in _prefixes:
+            _prefixes[_network] = set()
+            insort(self._networks[_length], _network)
+        _prefixes[_network].add(ruleid)
+
+    def _unindex(self, ruleid, rule):
+        if not isinstance(rule, Rule):
+            return
+        for _field, _slot in RuleIndex.fields.iteritems():
+            _value = getattr(rule, _slot)
+            _ids = self._indexes[_field].get(_value)
+            if _ids is not None:
+                _ids.discard(ruleid)
+                if not _ids:
+                    del self._indexes[_field][_value]
+        if rule._network is None:
+            return
+        if not _contiguous(rule._mask):
+            self._masked.discard(ruleid)
+            return
+        _length = _masklen(rule._mask)
+        _network = rule._network & rule._mask
+        _ids = self._prefixes[_length][_network]
+        _ids.discard(ruleid)
+        if not _ids:
+            del self._prefixes[_length][_network]
+            _networks = self._networks[_length]
+            del _networks[bisect_left(_networks, _network)]
+
+    def _overlapping(self, subnet):
+        """
+        The ids of the rules whose subnet overlaps a subnet; a prefix overlaps
+        the shorter prefixes containing it and the longer ones inside it
+        """
+        _network, _mask, _form = parsesubnet(subnet)
+        if not _contiguous(_mask):
+            raise IPTablesError("Rules can only be queried on a subnet with a plain prefix, not %s" % subnet)
+        _network &= _mask
+        _last = _network | (~_mask & 0xFFFFFFFF)
+        _length = _masklen(_mask)
+        _ids = set()
+        for _prefix, (_prefixes, _networks) in enumerate(zip(self._prefixes, self._networks)):
+            if not _prefixes:
+                continue
+            if _prefix <= _length:
+                _ids.update(_prefixes.get(_network & _prefixmask(_prefix), ()))
+            else:
+                for _inside in _networks[bisect_left(_networks, _network):bisect_right(_networks, _last)]:
+                    _ids.update(_prefixes[_inside])
+        for _id in self._masked:
+            _rule = self._entries[_id]
+            if not (_rule._network ^ _network) & _rule._mask & _mask:
+                _ids.add(_id)
+        return _ids
+
+
+############
+# SNAPSHOT #
+############
+class Snapshot(object):
+    """
+    The filter table as iptables sees it, the chain policies and the rule
+    specs in each chain in order, without the -A CHAIN. A Snapshot can be
+    taken of a BlackSalt ruleset with BlackSalt.snapshot(), or loaded from
+    iptables-save or iptables-restore output, for BlackSalt.diff().
+    """
+    def __init__(self):
+        self.policies = {}  # i.e. {"INPUT": "DROP"}
+        self.chains = OrderedDict((_chain, []) for _chain in BUILTIN_CHAINS)
+
+    def __repr__(self):
+        return "<Snapshot: %d chains, %d rules>" % (len(self.chains),
+                                                    sum(len(_specs) for _specs in self.chains.itervalues()))
+
+    ##########
+    # APPEND #
+    ##########
+    def append(self, spec):
+        """
+        @summary: Add an "-A CHAIN ..." rule spec to the end of its chain
+        @rtype: None
+        @param spec: str
+        """
+        _append, _chain, _spec = (spec.split(None, 2) + ["", ""])[:3]
+        self.chains.setdefault(_chain, []).append(_spec)
+
+    ########
+    # LOAD #
+    ########
+    def load(self, source):
+        """
+        @summary: Load the filter table from iptables-save or iptables-restore
+                  output, other tables are skipped. Counters, as written by
+                  iptables-save -c, are ignored.
+        @rtype: Snapshot (itself)
+        @param source: str path or file-like object
+        """
+        _source = open(source, "r") if type(source) == str else source
+        _table = None
+        for _line in _source:
+            _line = _line.strip()
+            if _line.startswith("["):
+                #: Strip counters i.e. [12:3400] -A INPUT ...
+                _line = _line.split("]", 1)[1].strip()
+            if not _line or _line.startswith("#"):
+                continue
+            if _line.startswith("*"):
+                _table = _line[1:]
+            elif _table != "filter" or _line == "COMMIT":
+                continue
+            elif _line.startswith(":"):
+                _chain, _policy = _line[1:].split()[:2]
+                self.chains.setdefault(_chain, [])
+                if _policy != "-":
+                    self.policies[_chain] = _policy
+            elif _line.startswith("-A "):
+                self.append(_line)
+        if _source is not source:
+            _source.close()
+        return self
+
+
+##########
+# PARSER #
+##########
+#: Match modules iptables-save writes out that the protocol already implies
+_IMPLICIT = ["tcp", "udp", "icmp"]
+#: A double quoted token, i.e. a --comment, or a plain one
+_TOKEN = re.compile(r'"((?:[^"\\]|\\.)*)"|(\S+)')
+
+
+def parsesave(source, **kwargs):
+    """
+    @summary: Parse iptables-save output into a new BlackSalt instance, the
+              kwargs are passed on to BlackSalt, see iterparse()
+    @rtype: BlackSalt
+    @param source: str path or file-like object
+    """
+    _blacksalt = BlackSalt(**kwargs)
+    _blacksalt.load(source)
+    return _blacksalt
+
+
+def iterparse(source):
+    """
+    @summary: Stream iptables-save output, yielding the filter table as
+              BlackSalt rules entries; a " -P CHAIN POLICY" string for each
+              builtin chain policy, a "-N CHAIN" string for each user
+              defined chain and a Rule for each -A line. Options a Rule
+              doesn't model, i.e. -d, negations or other match modules,
+              are kept verbatim in Rule.extra. Other tables are skipped.
+    @rtype: generator
+    @param source: str path or file-like object
+    """
+    _source = open(source, "r") if type(source) == str else source
+    _table = None
+    try:
+        for _line in _source:
+            if _line.startswith("-A "):
+                if _table == "filter":
+                    yield _parserule(_line)
+            elif _line.startswith("["):
+                #: Counters from iptables-save -c i.e. [12:3400] -A INPUT ...
+                _line = _line.split("]", 1)[1].strip()
+                if _table == "filter" and _line.startswith("-A "):
+                    yield _parserule(_line)
+            elif _line.startswith("*"):
+                _table = _line[1:].strip()
+            elif _line.startswith(":") and _table == "filter":
+                _chain, _policy = _line[1:].split()[:2]
+                if _policy != "-":
+                    yield " -P %s %s" % (_chain, _policy)
+                elif _chain not in BUILTIN_CHAINS:
+                    yield "-N %s" % _chain
+    finally:
+        if _source is not source:
+            _source.close()
+
+
+def _parserule(line):
+    """
+    Build a Rule from an iptables-save "-A CHAIN ..." line. The values come
+    from iptables so they are set directly rather than through the setters.
+    """
+    if '"' in line:
+        _tokens = [_plain or _quoted.replace('\\"', '"') for _quoted, _plain in _TOKEN.findall(line)]
+    else:
+        _tokens = line.split()
+    _rule = Rule.__new__(Rule)
+    _rule.protocol = _rule._ifname = _rule._ifdir = _rule.dst_port = _rule.src_port = None
+    _rule._network = _rule._mask = _rule._subnetform = _rule._state = None
+    _rule.icmp = _rule.target = _rule.extra = _rule.warning = None
+    _rule.chain = intern(_tokens[1])
+    _extra = []
+    _count = len(_tokens)
+    _index = 2
+    while _index < _count:
+        _option = _tokens[_index]
+        _value = _tokens[_index + 1] if _index + 1 < _count else None
+        _index += 2
+        if _option == "-j":
+            _rule.target = intern(_value)
+            #: Target options i.e. --reject-with are kept verbatim after the target
+            if _index < _count:
+                _rule.target = intern(" ".join([_value] + [_quote(_token) for _token in _tokens[_index:]]))
+            break
+        elif _option == "-p" and _rule.protocol is None:
+            _rule.protocol = intern(_value)
+        elif _option == "-s" and _rule._network is None:
+            _rule.pack_subnet(_value)
+        elif _option in ["-i", "-o"] and _rule._ifname is None:
+            _rule._ifname = intern(_value)
+            _rule._ifdir = "in" if _option == "-i" else "out"
+        elif _option == "-m" and _value in _IMPLICIT:
+            continue
+        elif _option == "-m" and _value == "state" and _index + 1 < _count and _tokens[_index] == "--state":
+            _states = tuple(intern(_state) for _state in _tokens[_index + 1].split(","))
+            _rule._state = _STATES.setdefault(_states, _states)
+            _index += 2
+        elif _option == "--dport" and _value.isdigit() and _rule.dst_port is None:
+            _rule.dst_port = int(_value)
+        elif _option == "--sport" and _value.isdigit() and _rule.src_port is None:
+            _rule.src_port = int(_value)
+        elif _option == "--icmp-type" and _value.isdigit() and _rule.icmp is None:
+            _rule.icmp = int(_value)
+        else:
+            #: Anything else is kept as it was, up to the next option
+            _index -= 1
+            _extra.append(_quote(_option))
+            while _index < _count and (_option == "!" or not _tokens[_index].startswith("-")):
+                _option = _tokens[_index]
+                _extra.append(_quote(_option))
+                _index += 1
+    if _extra:
+        _rule.extra = " ".join(_extra)
+    return _rule
+
+
+def _quote(token):
+    """
+    Quote a token with spaces in it again, i.e. a --comment
+    """
+    if " " in token or not token:
+        return '"%s"' % token.replace('"', '\\"')
+    return token
+
+
+############
+# COUNTERS #
+############
+#: A chain heading, i.e. "Chain INPUT (policy DROP 12 packets, 3400 bytes)"
+_CHAIN = re.compile(r"^Chain (\S+) \((?:policy \S+ (\S+) packets)?")
+_SCALE = {"K": 10 ** 3, "M": 10 ** 6, "G": 10 ** 9, "T": 10 ** 12}
+
+
+def parsecounters(source):
+    """
+    @summary: Parse iptables -L -v -x -n output into the packet counters of
+              each chain, with or without --line-numbers. Counters without
+              -x, i.e. 12K, are scaled back up.
+    @rtype: OrderedDict {chain: (policy packets, [packets per rule])}, the
+            policy packets are None for user defined chains
+    @param source: str path or file-like object
+    """
+    _source = open(source, "r") if type(source) == str else source
+    _counters = OrderedDict()
+    _packets = None
+    _column = 0
+    try:
+        for _line in _source:
+            _fields = _line.split()
+            if not _fields:
+                continue
+            _heading = _CHAIN.match(_line)
+            if _heading:
+                _policy = _heading.group(2)
+                _packets = []
+                _counters[_heading.group(1)] = (None if _policy is None else _counter(_policy), _packets)
+            elif _fields[0] in ["pkts", "num"]:
+                _column = _fields.index("pkts")
+            elif _packets is not None:
+                _packets.append(_counter(_fields[_column]))
+    finally:
+        if _source is not source:
+            _source.close()
+    return _counters
+
+
+def _counter(value):
+    """
+    @summary: A counter as iptables -L prints it, i.e. "120" or "12K"
+    @rtype: int
+    """
+    if value[-1:] in _SCALE:
+        return int(value[:-1]) * _SCALE[value[-1]]
+    return int(value)
+
+
+def _depth(packets, policy=None):
+    """
+    @summary: The average number of rules a packet is tested against, given
+              the packets each rule in a chain matched in order and the
+              packets that reached the policy
+    @rtype: float
+    """
+    _total = sum(packets) + (policy or 0)
+    if not _total:
+        return 0.0
+    _tested = sum(_hits * _position for _position, _hits in enumerate(packets, 1))
+    return float(_tested + (policy or 0) * len(packets)) / _total
+
+
+###############
+# MATCH SPACE #
+###############
+#: Targets that stop a packet going any further in the chain
+TERMINAL_TARGETS = ["ACCEPT", "DROP", "REJECT", "QUEUE", "NFQUEUE", "RETURN"]
+STATES = frozenset(["NEW", "ESTABLISHED", "RELATED", "INVALID"])
+
+
+class MatchSpace(object):
+    """
+    The packets a rule matches, one range or set per field. None is a
+    wildcard, addresses are kept as a packed network and mask (masks
+    needn't be plain prefixes), ports as (low, high) ranges. Options in
+    Rule.extra can only narrow a match, so a rule with extra options is
+    never taken to contain another one unless they're the same options.
+    """
+    __slots__ = ("ifin", "ifout", "protocol", "icmp", "network", "mask", "sport", "dport",
+                 "states", "extra", "target", "terminal")
+
+    def __init__(self, rule):
+        self.ifin = rule._ifname if rule._ifname and rule._ifdir == "in" else None
+        self.ifout = rule._ifname if rule._ifname and rule._ifdir == "out" else None
+        self.protocol = _protocolname(rule.protocol)
+        self.icmp = rule.icmp
+        if rule.icmp is not None:
+            self.protocol = "icmp"
+        if rule._network is None:
+            self.network = self.mask = 0
+        else:
+            self.network = rule._network & rule._mask
+            self.mask = rule._mask
+        self.sport = _portrange(rule.src_port)
+        self.dport = _portrange(rule.dst_port)
+        self.states = frozenset(rule._state) if rule._state else STATES
+        self.extra = rule.extra
+        self.target = rule.target
+        self.terminal = bool(rule.target) and rule.target.split(" ", 1)[0] in TERMINAL_TARGETS
+
+    def __repr__(self):
+        return "<MatchSpace: %s/%s %s %s %s>" % (_unpackaddr(self.network), _unpackaddr(self.mask),
+                                                 self.protocol or "all", self.dport, ",".join(sorted(self.states)))
+
+    def contains(self, other):
+        """
+        @summary: Whether every packet the other space matches, this one matches
+        @rtype: bool
+        @param other: MatchSpace
+        """
+        return (_ifcontains(self.ifin, other.ifin) and _ifcontains(self.ifout, other.ifout)
+                and (self.protocol is None or self.protocol == other.protocol)
+                and (self.icmp is None or self.icmp == other.icmp)
+                and not self.mask & ~other.mask and not (self.network ^ other.network) & self.mask
+                and self.sport[0] <= other.sport[0] and other.sport[1] <= self.sport[1]
+                and self.dport[0] <= other.dport[0] and other.dport[1] <= self.dport[1]
+                and other.states <= self.states
+                and (self.extra is None or self.extra == other.extra))
+
+    def overlaps(self, other):
+        """
+        @summary: Whether any packet could match both spaces, options in extra
+                  are assumed to overlap
+        @rtype: bool
+        @param other: MatchSpace
+        """
+        return (_ifoverlaps(self.ifin, other.ifin) and _ifoverlaps(self.ifout, other.ifout)
+                and (self.protocol is None or other.protocol is None or self.protocol == other.protocol)
+                and (self.icmp is None or other.icmp is None or self.icmp == other.icmp)
+                and not (self.network ^ other.network) & self.mask & other.mask
+                and self.sport[0] <= other.sport[1] and other.sport[0] <= self.sport[1]
+                and self.dport[0] <= other.dport[1] and other.dport[0] <= self.dport[1]
+                and not self.states.isdisjoint(other.states))
+
+
+class MatchIndex(object):
+    """
+    An index of the terminal rules in a chain, for finding the earliest rule
+    that overlaps or contains a new one without trying every rule. Rules are
+    grouped by target and interfaces, then by source prefix; a dict by
+    (network, length) for the prefixes as wide or wider than a new rule,
+    looked up once per prefix length in use, and a list sorted by network
+    for the narrower ones. Each prefix keeps its rules in chain order, all
+    together and by destination port, so a search stops at the first match.
+    Rules with masks that aren't plain prefixes are always tried.
+    """
+    def __init__(self):
+        self.groups = {}  # (target, ifin, ifout) -> _PrefixIndex
+        self.others = []  # [(position, space)] with masks that aren't plain prefixes
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, position, space):
+        """
+        @summary: Add a rule's space, rules must be added in chain order
+        @rtype: None
+        """
+        self.count += 1
+        if not _contiguous(space.mask):
+            self.others.append((position, space))
+            return
+        _key = (space.target, space.ifin, space.ifout)
+        _prefixindex = self.groups.get(_key)
+        if _prefixindex is None:
+            _prefixindex = self.groups[_key] = _PrefixIndex()
+        _prefixindex.add(position, space)
+
+    def earliest(self, space, contains=False, exclude=None):
+        """
+        @summary: The earliest indexed rule that overlaps the space, or with
+                  contains that matches everything it does, leaving out rules
+                  with the exclude target.
+        @rtype: (position, space) or None
+        @param space: MatchSpace
+        @param contains: bool
+        @param exclude: str target
+        """
+        _best = None
+        for _position, _other in self.others:
+            if _other.target != exclude and (_other.contains(space) if contains else _other.overlaps(space)):
+                _best = (_position, _other)
+                break
+        _length = _masklen(space.mask) if _contiguous(space.mask) else -1
+        for (_target, _ifin, _ifout), _prefixindex in self.groups.iteritems():
+            if _target == exclude or not (_ifoverlaps(_ifin, space.ifin) and _ifoverlaps(_ifout, space.ifout)):
+                continue
+            _found = _prefixindex.earliest(space, contains, _length, _best[0] if _best else None)
+            if _found and (_best is None or _found[0] < _best[0]):
+                _best = _found
+        return _best
+
+
+class _PrefixIndex(object):
+    """
+    Rules in one MatchIndex group by their source prefix, see MatchIndex
+    """
+    _scan = 256  # Narrower prefixes past this many are searched in chain order
+
+    def __init__(self):
+        self.prefixes = {}  # (network, length) -> _PrefixBucket
+        self.lengths = []  # Sorted prefix lengths in use
+        self.starts = []  # Sorted (network, length, position, space)
+        self.order = []  # (position, network, length, space) in chain order
+
+    def add(self, position, space):
+        _length = _masklen(space.mask)
+        _bucket = self.prefixes.get((space.network, _length))
+        if _bucket is None:
+            _bucket = self.prefixes[(space.network, _length)] = _PrefixBucket()
+            if _length not in self.lengths:
+                insort(self.lengths, _length)
+        _bucket.add(position, space)
+        insort(self.starts, (space.network, _length, position, space))
+        self.order.append((position, space.network, _length, space))
+
+    def earliest(self, space, contains, length, before=None):
+        _best = None
+        #: Prefixes as wide or wider, one lookup per prefix length in use
+        if length >= 0:
+            for _wider in self.lengths[:bisect_right(self.lengths, length)]:
+                _bucket = self.prefixes.get((space.network & _prefixmask(_wider), _wider))
+                _found = _bucket and _bucket.earliest(space, contains)
+                if _found and (_best is None or _found[0] < _best[0]):
+                    _best = _found
+        if _best and before is not None:
+            before = min(before, _best[0])
+        elif _best:
+            before = _best[0]
+
+        if contains:
+            return _best
+
+        #: Narrower prefixes, the range of networks inside this one
+        _start = space.network & _prefixmask(max(length, 0))
+        _end = _start | (~_prefixmask(max(length, 0)) & 0xFFFFFFFF)
+        _first = bisect_left(self.starts, (_start, length + 1))
+        _last = bisect_right(self.starts, (_end, 33))
+        if _last - _first <= self._scan:
+            for _network, _narrower, _position, _other in self.starts[_first:_last]:
+                if (_narrower > length and (before is None or _position < before)
+                        and _other.overlaps(space)):
+                    before = _position
+                    _best = (_position, _other)
+            return _best
+        for _position, _network, _narrower, _other in self.order:
+            if before is not None and _position >= before:
+                break
+            if _narrower > length and _start <= _network <= _end and _other.overlaps(space):
+                return _position, _other
+        return _best
+
+
+class _PrefixBucket(object):
+    """
+    Rules with the same source prefix in chain order, all together and by
+    protocol and destination port, see MatchIndex
+    """
+    def __init__(self):
+        self.rules = []  # [(position, space)]
+        self.keys = {}  # (protocol, port) -> [(position, space)], None for any or a range
+
+    def add(self, position, space):
+        self.rules.append((position, space))
+        self.keys.setdefault(_bucketkey(space), []).append((position, space))
+
+    def earliest(self, space, contains):
+        _protocol, _port = _bucketkey(space)
+        if contains:
+            #: Only rules as wide in protocol and port can contain it
+            _lists = [self.keys.get((_protocolkey, _portkey), ())
+                      for _protocolkey in set([_protocol, None])
+                      for _portkey in set([_port, None])]
+        elif _protocol is not None and _port is not None:
+            _lists = [self.keys.get((_protocolkey, _portkey), ())
+                      for _protocolkey in (_protocol, None)
+                      for _portkey in (_port, None)]
+        else:
+            _lists = [self.rules]
+        _best = None
+        for _rules in _lists:
+            for _position, _other in _rules:
+                if _best is not None and _position >= _best[0]:
+                    break
+                if _other.contains(space) if contains else _other.overlaps(space):
+                    _best = (_position, _other)
+                    break
+        return _best
+
+
+def _bucketkey(space):
+    """
+    @summary: The protocol and single destination port of a space, None for
+              any protocol or a port range
+    @rtype: tuple
+    """
+    return space.protocol, (space.dport[0] if space.dport[0] == space.dport[1] else None)
+
+
+def _relation(space, earlier):
+    """
+    How a rule relates to an earlier, overlapping, terminal rule in its
+    chain, see BlackSalt.analyze(). None if it doesn't matter, the same
+    target and not contained.
+    """
+    _same = earlier.target == space.target
+    if earlier.contains(space):
+        return "redundant" if _same else "shadowed"
+    if _same:
+        return None
+    if space.contains(earlier):
+        return "generalization"
+    return "correlated"
+
+
+def _protocolname(protocol):
+    """
+    A protocol by name in lowercase, or None for any protocol
+    """
+    if protocol is None:
+        return None
+    protocol = PROTOCOLS.numbers.get(protocol, protocol).lower()
+    return None if protocol in ["all", "0"] else protocol
+
+
+def _portrange(port):
+    """
+    A port as a (low, high) range, None is any port
+    """
+    if port is None:
+        return (0, 65535)
+    return (port, port)
+
+
+def _ifcontains(outer, inner):
+    """
+    Whether an interface, or wildcard like eth+, covers another
+    """
+    if outer is None:
+        return True
+    if inner is None:
+        return False
+    if outer.endswith("+"):
+        return inner.startswith(outer[:-1])
+    return outer == inner
+
+
+def _ifoverlaps(first, second):
+    """
+    Whether two interfaces, or wildcards like eth+, have any name in common
+    """
+    if first is None or second is None or first == second:
+        return True
+    if first.endswith("+") and second.startswith(first[:-1]):
+        return True
+    return second.endswith("+") and first.startswith(second[:-1])
+
+
+#############
+# JUMP TREE #
+#############
+_CHAIN_NAMELEN = 28  # The longest chain name iptables accepts
+
+
+def _jumptree(chain, entries, depth, settings, names):
+    """
+    @summary: Compile the rules of a chain, as [(Rule, MatchSpace)] in chain
+              order, into the chain's rules and a tree of sub-chains under
+              it, see BlackSalt.compiletree(). The names of the sub-chains
+              are added to names, and to the set of names already taken.
+    @rtype: list of Rule
+    """
+    _root, _maxdepth, _fanout, _minrules, _taken = settings
+    _split = None
+    if depth < _maxdepth and len(entries) >= _minrules:
+        _split = _bestsplit(entries, _fanout)
+    if _split is None:
+        return [_inchain(_rule, chain) for _rule, _space in entries]
+
+    _keys, _dispatch = _split
+    _buckets = OrderedDict((_value, []) for _value in _dispatch)
+    _matches = dict((_value, _rule.matchspace()) for _value, _rule in _dispatch.iteritems())
+    _rest = []
+    for _entry, _key in zip(entries, _keys):
+        if _key is not None:
+            _buckets[_key].append(_entry)
+            continue
+        #: Rules that don't split on the field go everywhere they could match
+        _rest.append(_entry)
+        for _value, _bucket in _buckets.iteritems():
+            if _matches[_value].overlaps(_entry[1]):
+                _bucket.append(_entry)
+
+    _parent, _children = [], []
+    for _value, _bucket in _buckets.iteritems():
+        names.append(_subchain(_root, len(names) + 1, _taken))
+        _rule = _dispatch[_value]
+        _rule.chain = chain
+        _rule.extra = " ".join(_opt for _opt in [_rule.extra, "-g %s" % names[-1]] if _opt)
+        _parent.append(_rule)
+        _children.extend(_jumptree(names[-1], _bucket, depth + 1, settings, names))
+    return _parent + [_inchain(_rule, chain) for _rule, _space in _rest] + _children
+
+
+def _subchain(root, number, taken):
+    """
+    @summary: A name for a sub-chain of root, bs-<root>-<number> with the
+              root cut short to fit the chain name limit, the number is
+              counted up past any name already taken
+    @rtype: str
+    """
+    while True:
+        _suffix = "-%d" % number
+        _name = "bs-%s%s" % (root.lower()[:min(16, _CHAIN_NAMELEN - 3 - len(_suffix))], _suffix)
+        if _name not in taken:
+            taken.add(_name)
+            return _name
+        number += 1
+
+
+def _bestsplit(entries, fanout):
+    """
+    @summary: The field that best splits the rules into sub-chains, the one
+              leaving the fewest rules to test on the longest path through
+              it, tried in order; the in and out interface, the protocol,
+              the leading bits of the source address and the destination
+              port. Rules that don't have a value for the field, or have a
+              wildcard like eth+, are None, a split that would copy them
+              into sub-chains more than half as many times as there are
+              rules isn't used.
+    @rtype: ([key per entry], OrderedDict {key: dispatch Rule}) or None
+    """
+    _spaces = [_space for _rule, _space in entries]
+    _best, _bestcost = None, len(entries)
+    for _keys, _dispatch in _splits(_spaces, fanout):
+        if not 2 <= len(_dispatch) <= fanout:
+            continue
+        _counts = {}
+        for _key in _keys:
+            _counts[_key] = _counts.get(_key, 0) + 1
+        _wildcards = _counts.pop(None, 0)
+        #: Copies of the rules without a value add at most half as many rules again
+        if _wildcards * len(_dispatch) * 2 > len(entries):
+            continue
+        _cost = len(_dispatch) + _wildcards + max(_counts.itervalues())
+        if _cost < _bestcost:
+            _best, _bestcost = (_keys, _dispatch), _cost
+    return _best
+
+
+def _splits(spaces, fanout):
+    """
+    @summary: The candidate splits for _bestsplit()
+    @rtype: generator of ([key per space], OrderedDict {key: dispatch Rule})
+    """
+    for _direction in ["in", "out"]:
+        _keys = [_ifname if _ifname and not _ifname.endswith("+") else None
+                 for _ifname in (_space.ifin if _direction == "in" else _space.ifout for _space in spaces)]
+        _dispatch = OrderedDict()
+        for _ifname in sorted(set(_keys) - set([None])):
+            _rule = _dispatch[_ifname] = Rule()
+            _rule._ifname, _rule._ifdir = _ifname, _direction
+        yield _keys, _dispatch
+
+    _keys = [_space.protocol for _space in spaces]
+    _dispatch = OrderedDict()
+    for _protocol in sorted(set(_keys) - set([None])):
+        _dispatch[_protocol] = Rule()
+        _dispatch[_protocol].protocol = _protocol
+    yield _keys, _dispatch
+
+    #: Source prefixes, one split per prefix length with few enough prefixes
+    _lengths = [_masklen(_space.mask) if _space.mask and _contiguous(_space.mask) else 0 for _space in spaces]
+    for _length in range(1, 33):
+        _shift = 32 - _length
+        _prefixes = set(_space.network >> _shift for _space, _masked in zip(spaces, _lengths) if _masked >= _length)
+        if not 2 <= len(_prefixes) <= fanout:
+            continue
+        _keys = [_space.network >> _shift if _masked >= _length else None for _space, _masked in zip(spaces, _lengths)]
+        _dispatch = OrderedDict()
+        for _prefix in sorted(_prefixes):
+            _rule = _dispatch[_prefix] = Rule()
+            _rule._network, _rule._mask = _prefix << _shift, _prefixmask(_length)
+            _rule._subnetform = SUBNET_ADDRESS if _length == 32 else SUBNET_CIDR
+        yield _keys, _dispatch
+
+    #: Destination ports of a single protocol, in up to fanout buckets of
+    #: neighbouring ports with about as many rules in each
+    _protocols = set(_space.protocol for _space in spaces if _space.dport != (0, 65535))
+    if len(_protocols) != 1:
+        return
+    _protocol = _protocols.pop()
+    _ports = sorted(_space.dport[0] for _space in spaces
+                    if _space.protocol == _protocol and _space.dport[0] == _space.dport[1])
+    if not _ports:
+        return
+    _ranges = []
+    _size = (len(_ports) + fanout - 1) // fanout
+    for _port in _ports:
+        if _ranges and (_port == _ranges[-1][1] or _ranges[-1][2] < _size):
+            _ranges[-1] = (_ranges[-1][0], _port, _ranges[-1][2] + 1)
+        else:
+            _ranges.append((_port, _port, 1))
+    _starts = [_low for _low, _high, _count in _ranges]
+    _keys = []
+    for _space in spaces:
+        _key = None
+        if _space.protocol == _protocol and _space.dport != (0, 65535):
+            _low, _high, _count = _ranges[max(bisect_right(_starts, _space.dport[0]) - 1, 0)]
+            if _low <= _space.dport[0] and _space.dport[1] <= _high:
+                _key = _low
+        _keys.append(_key)
+    _dispatch = OrderedDict()
+    for _low, _high, _count in _ranges:
+        _rule = _dispatch[_low] = Rule()
+        _rule.protocol = _protocol
+        if _low == _high:
+            _rule.dst_port = _low
+        else:
+            _rule.extra = "--dport %d:%d" % (_low, _high)
+    yield _keys, _dispatch
+
+
+def _inchain(rule, chain):
+    """
+    @summary: The rule, or a copy of it moved to another chain
+    @rtype: Rule
+    """
+    if rule.chain == chain:
+        return rule
+    _rule = rule.copy()
+    _rule.chain = chain
+    return _rule
+
+
+############
+# SIMULATE #
+############
+#: The fields of a flow for BlackSalt.simulate(); src is a dotted quad or
+#: packed int, ports and the icmp type are ints, state is a conntrack state
+FLOW_FIELDS = ["interface", "direction", "protocol", "src", "sport", "dport", "icmp", "state"]
+_VERDICTS = ["ACCEPT", "DROP", "REJECT", "QUEUE", "NFQUEUE"]
+
+
+def _requirenumpy():
+    """
+    @summary: Raise an IPTablesError unless NumPy can be imported
+    @rtype: None
+    """
+    if numpy is None:
+        raise IPTablesError("The simulator needs NumPy, i.e. pip install numpy")
+
+
+def loadflows(source):
+    """
+    @summary: Read flows from a CSV file whose header row names the columns
+              from FLOW_FIELDS, i.e. fields exported from a pcap, into the
+              NumPy arrays BlackSalt.simulate() takes. Protocols may be
+              numbers or names. Empty values are left unset.
+    @rtype: dict {field: numpy.ndarray}
+    @param source: str path or file-like object
+    """
+    _requirenumpy()
+    _source = open(source, "rb") if type(source) == str else source
+    try:
+        _reader = csv.reader(_source)
+        _header = [_name.strip().lower() for _name in next(_reader)]
+        _unknown = set(_header) - set(FLOW_FIELDS)
+        if _unknown:
+            raise IPTablesError("Unknown flow fields: %s" % ", ".join(sorted(_unknown)))
+        _columns = zip(*_reader) or [()] * len(_header)
+    finally:
+        if _source is not source:
+            _source.close()
+    return _flowarrays(dict(zip(_header, _columns)))
+
+
+def _flowarrays(flows):
+    """
+    @summary: The flows as NumPy arrays of one length; strings for the
+              interface, direction, protocol and state, an unsigned int
+              source address, and ints for the ports and icmp type with -1
+              where they're unset
+    @rtype: dict {field: numpy.ndarray}
+    """
+    _unknown = set(flows) - set(FLOW_FIELDS)
+    if _unknown:
+        raise IPTablesError("Unknown flow fields: %s" % ", ".join(sorted(_unknown)))
+    _lengths = set(len(_values) for _values in flows.itervalues())
+    if len(_lengths) > 1:
+        raise IPTablesError("Flow fields must all be the same length")
+    _count = _lengths.pop() if _lengths else 0
+
+    _arrays = {}
+    for _field in FLOW_FIELDS:
+        _values = flows.get(_field)
+        if isinstance(_values, numpy.ndarray) and _values.dtype.kind in "iu":
+            if _field == "src":
+                _arrays[_field] = _values.astype(numpy.uint32)
+            elif _field == "protocol":
+                _names = numpy.array([_protocolname(str(_number)) or "" for _number in range(256)], "S")
+                _arrays[_field] = _names[_values]
+            elif _field in ["sport", "dport", "icmp"]:
+                _arrays[_field] = _values.astype(numpy.int32)
+            else:
+                raise IPTablesError("Flow field %s must be strings" % _field)
+        elif _values is None:
+            _arrays[_field] = (numpy.zeros(_count, numpy.uint32) if _field == "src" else
+                               numpy.full(_count, -1, numpy.int32) if _field in ["sport", "dport", "icmp"] else
+                               numpy.full(_count, "", "S1"))
+        elif _field == "src":
+            _arrays[_field] = numpy.fromiter((_value if isinstance(_value, (int, long)) else
+                                              _packaddr(_value) if _value else 0 for _value in _values),
+                                             numpy.uint32, _count)
+        elif _field in ["sport", "dport", "icmp"]:
+            _arrays[_field] = numpy.fromiter((int(_value) if _value not in ["", None] else -1 for _value in _values),
+                                             numpy.int32, _count)
+        elif _field == "protocol":
+            _arrays[_field] = numpy.array([_protocolname(str(_value).strip()) or ""
+                                           for _value in _values], "S")
+        elif _field == "state":
+            _arrays[_field] = numpy.char.upper(numpy.array(_values, "S"))
+        else:
+            _arrays[_field] = numpy.array(_values, "S")
+    return _arrays
+
+
+class _Simulator(object):
+    """
+    Walks flows through the chains of a BlackSalt ruleset for simulate().
+    The flows are sorted by source address, so a rule's subnet is a slice
+    of them found by bisection and its other fields are only tested inside
+    that slice. The flows walking a chain are a bool mask, masks for the
+    values rules share, i.e. an interface or a set of states, are worked
+    out once over every flow and cached.
+    """
+    _maxdepth = 64  # Jumps iptables would refuse as a loop
+
+    def __init__(self, blacksalt, flows):
+        _flows = _flowarrays(flows)
+        self.order = numpy.argsort(_flows["src"], kind="mergesort")
+        self.flows = dict((_field, _values[self.order]) for _field, _values in _flows.iteritems())
+        self.count = len(self.order)
+        self.chains, self.policies = _chaintable(blacksalt.rules)
+        self.sets = blacksalt.sets
+        self.masks = {}  # (field, value) -> bool array over every flow
+        self.spaces = {}  # id(rule) -> (MatchSpace, options, first flow, last flow + 1)
+        self.unmodelled = set()
+        self.names = self.verdicts = self.lines = None
+
+    def run(self, chain):
+        """
+        @summary: Walk every flow through a builtin chain
+        @rtype: (verdicts, lines), see BlackSalt.simulate()
+        """
+        self.names = list(_VERDICTS)
+        self.verdicts = numpy.zeros(self.count, numpy.int8)
+        self.lines = numpy.zeros(self.count, numpy.int32)
+        _left = self.walk(chain, numpy.ones(self.count, bool), 0)
+        _policy = self.policies.get(chain, "ACCEPT")
+        if _policy not in self.names:
+            self.names.append(_policy)
+        self.verdicts[_left] = self.names.index(_policy)
+        #: Back into the order the flows were given in
+        _verdicts = numpy.empty(self.count, numpy.int8)
+        _lines = numpy.empty(self.count, numpy.int32)
+        _verdicts[self.order] = self.verdicts
+        _lines[self.order] = self.lines
+        return numpy.array(self.names)[_verdicts], _lines
+
+    def walk(self, chain, walking, depth):
+        """
+        @summary: Walk the flows set in the walking mask through a chain,
+                  the mask is changed as the flows get verdicts
+        @rtype: numpy.ndarray of bool, the flows that come back out of the
+                chain, falling off the end or on a RETURN
+        """
+        if depth > self._maxdepth:
+            raise IPTablesError("Jumps nest more than %d chains deep at %s" % (self._maxdepth, chain))
+        _returned = numpy.zeros(self.count, bool)
+        for _line, _rule in self.chains.get(chain, ()):
+            _first, _hits = self.match(_rule, walking)
+            if not len(_hits):
+                continue
+            _hits += _first
+            walking[_hits] = False
+            _goto = self.spaces[id(_rule)][1]["goto"]
+            _target = _rule.target.split(" ", 1)[0] if _rule.target else None
+            if _goto or _target in self.chains:
+                _jumped = numpy.zeros(self.count, bool)
+                _jumped[_hits] = True
+                _back = self.walk(_goto or _target, _jumped, depth + 1)
+                if _goto:
+                    _returned |= _back
+                else:
+                    walking |= _back
+            elif _target == "RETURN":
+                _returned[_hits] = True
+            elif _target in _VERDICTS:
+                self.verdicts[_hits] = self.names.index(_target)
+                self.lines[_hits] = _line
+            else:
+                #: Targets that don't end the walk, i.e. LOG
+                walking[_hits] = True
+        _returned |= walking
+        return _returned
+
+    def match(self, rule, walking):
+        """
+        @summary: Which walking flows the rule matches
+        @rtype: (int, numpy.ndarray), the first flow of the rule's slice and
+                the offsets of the matching flows in it
+        """
+        _cached = self.spaces.get(id(rule))
+        if _cached is None:
+            _cached = self.spaces[id(rule)] = self.prepare(rule)
+        _space, _options, _first, _last = _cached
+        _matched = walking[_first:_last]
+        if not _matched.any():
+            return _first, _matched.nonzero()[0]
+        _flows = self.flows
+        for _direction, _ifname in [("in", _space.ifin), ("out", _space.ifout)]:
+            if _ifname:
+                _matched = _matched & self.mask("interface", (_direction, _ifname))[_first:_last]
+        if _space.protocol:
+            _matched = _matched & self.mask("protocol", _space.protocol)[_first:_last]
+        if _space.icmp is not None:
+            _matched = _matched & (_flows["icmp"][_first:_last] == _space.icmp)
+        if _space.mask and not _contiguous(_space.mask):
+            _matched = _matched & ((_flows["src"][_first:_last] ^ numpy.uint32(_space.network))
+                                   & numpy.uint32(_space.mask) == 0)
+        if rule._state:
+            _matched = _matched & self.mask("state", rule._state)[_first:_last]
+        if _options["set"]:
+            _matched = _matched & self.mask("set", _options["set"])[_first:_last]
+        for _field, (_low, _high) in [("sport", _options["sport"] or _space.sport),
+                                      ("dport", _options["dport"] or _space.dport)]:
+            if (_low, _high) != (0, 65535):
+                _ports = _flows[_field][_first:_last]
+                _matched = _matched & (_ports >= _low) & (_ports <= _high)
+        return _first, _matched.nonzero()[0]
+
+    def prepare(self, rule):
+        """
+        @summary: A rule's MatchSpace, the options in its extra and the slice
+                  of flows its subnet covers
+        @rtype: tuple
+        """
+        _space = MatchSpace(rule)
+        _options = _simoptions(rule.extra or "")
+        self.unmodelled.update(_options["unmodelled"])
+        _first, _last = 0, self.count
+        if _space.mask and _contiguous(_space.mask):
+            _src = self.flows["src"]
+            _first = numpy.searchsorted(_src, numpy.uint32(_space.network), "left")
+            _last = numpy.searchsorted(_src, numpy.uint32(_space.network | (~_space.mask & 0xFFFFFFFF)), "right")
+        return _space, _options, int(_first), int(_last)
+
+    def mask(self, field, value):
+        """
+        @summary: The flows matching a value rules share, over every flow
+        @rtype: numpy.ndarray of bool
+        """
+        _mask = self.masks.get((field, value))
+        if _mask is not None:
+            return _mask
+        _flows = self.flows
+        if field == "interface":
+            _direction, _ifname = value
+            if _ifname.endswith("+"):
+                _names = numpy.char.startswith(_flows["interface"], _ifname[:-1])
+            else:
+                _names = _flows["interface"] == _ifname
+            _mask = _names & (_flows["direction"] == _direction)
+        elif field == "protocol":
+            _mask = _flows["protocol"] == value
+        elif field == "state":
+            _mask = numpy.in1d(_flows["state"], numpy.array(value, "S"))
+        elif field == "set":
+            _blocks = _collapse((_packaddr(_subnet.split("/")[0]), _prefixmask(int((_subnet + "/32").split("/")[1])))
+                                for _subnet in self.sets.get(value, ()))
+            _starts = numpy.array([_network for _network, _length in _blocks] or [0], numpy.uint32)
+            _ends = numpy.array([_network | (~_prefixmask(_length) & 0xFFFFFFFF) for _network, _length in _blocks]
+                                or [0], numpy.uint32)
+            _at = numpy.maximum(numpy.searchsorted(_starts, _flows["src"], "right") - 1, 0)
+            _mask = (_flows["src"] >= _starts[_at]) & (_flows["src"] <= _ends[_at]) & bool(_blocks)
+        self.masks[(field, value)] = _mask
+        return _mask
+
+
+def _simoptions(extra):
+    """
+    @summary: The options in Rule.extra the simulator models; a goto (-g),
+              port ranges (--sport/--dport low:high) and ipset source
+              matches (-m set --match-set NAME src). Comments are skipped,
+              anything else is listed as unmodelled.
+    @rtype: dict
+    """
+    _options = {"goto": None, "sport": None, "dport": None, "set": None, "unmodelled": []}
+    _tokens = [_quoted or _plain for _quoted, _plain in _TOKEN.findall(extra)]
+    _index = 0
+    while _index < len(_tokens):
+        _token = _tokens[_index]
+        _value = _tokens[_index + 1] if _index + 1 < len(_tokens) else ""
+        if _token == "-g":
+            _options["goto"] = _value
+        elif _token in ["--sport", "--dport"]:
+            _low, _high = (_value.split(":") + [_value])[:2]
+            _options[_token[2:]] = (int(_low or 0), int(_high or 65535))
+        elif _token == "--match-set" and _tokens[_index + 2:_index + 3] == ["src"]:
+            _options["set"] = _value
+            _index += 1
+        elif _token == "-m" and _value in ["set", "comment"]:
+            pass
+        elif _token == "--comment":
+            pass
+        else:
+            _options["unmodelled"].append(_token)
+            _index -= 1
+        _index += 2
+    return _options
+
+
+def _chaintable(rules):
+    """
+    @summary: The chains a ruleset leaves once its entries have run in order;
+              a flush (-F) drops the rules before it, -X drops user defined
+              chains, -N creates one and -P sets a policy
+    @rtype: (OrderedDict {chain: [(line, Rule)]}, dict {chain: policy}), the
+            lines are as in preview()
+    """
+    _chains = OrderedDict((_chain, []) for _chain in BUILTIN_CHAINS)
+    _policies = {}
+    for _line, _rule in enumerate(rules, 1):
+        if isinstance(_rule, Rule):
+            if _rule.chain:
+                _chains.setdefault(_rule.chain, []).append((_line, _rule))
+            continue
+        _parts = _rule.split()
+        if _parts[:1] == ["-F"]:
+            for _chain in _parts[1:] or list(_chains):
+                if _chain in _chains:
+                    _chains[_chain] = []
+        elif _parts[:1] == ["-X"]:
+            for _chain in _parts[1:] or list(_chains):
+                if _chain not in BUILTIN_CHAINS:
+                    _chains.pop(_chain, None)
+        elif _parts[:1] == ["-N"] and len(_parts) == 2:
+            _chains.setdefault(_parts[1], [])
+        elif _parts[:1] == ["-P"] and len(_parts) == 3:
+            _policies[_parts[1]] = _parts[2]
+    return _chains, _policies
+
+
+############
+# NFTABLES #
+############
+#: The table the nft backend loads the ruleset into, it's replaced as a whole
+NFT_TABLE = "blacksalt"
+_NFT_HOOKS = {"INPUT": "input", "FORWARD": "forward", "OUTPUT": "output"}
+_NFT_VERDICTS = {"ACCEPT": "accept", "DROP": "drop", "RETURN": "return"}
+_NFT_TERMINAL = ["accept", "drop", "return", "goto", "reject", "queue"]  # Actions a packet doesn't carry on from
+_NFT_PORTS = ["tcp", "udp", "udplite", "sctp", "dccp"]  # Protocols nft names in a port match
+_NFT_LEVELS = ["emerg", "alert", "crit", "err", "warn", "notice", "info", "debug"]
+_NFT_MODULES = ["set", "comment", "state", "tcp", "udp", "icmp"]  # -m modules whose options are translated
+
+
+def _nftrule(rule, chains, sets):
+    """
+    @summary: A Rule translated to nft, its matches in the order they are
+              written, the action and whether the action is a verdict a
+              verdict map can hold. Each match is (field, value, key), the
+              key is what runs of rules are grouped on; an (low, high) int
+              interval, a string compared for equality, or None when the
+              match can't go in a set.
+    @rtype: (tuple of matches, str action, bool verdict, str comment)
+    @param chains: the chain names a target can jump to
+    @param sets: the ipset names collapsesets() made
+    """
+    _matches = []
+    _ports = {}
+    _states = rule._state
+    _action = None
+    _comment = None
+
+    #: The options in extra, the same ones the simulator models and -d
+    _tokens = [_quoted or _plain for _quoted, _plain in _TOKEN.findall(rule.extra or "")]
+    _index = 0
+    _after = []  # Matches on the set and destination, after the source subnet
+    while _index < len(_tokens):
+        _token = _tokens[_index]
+        _value = _tokens[_index + 1] if _index + 1 < len(_tokens) else ""
+        if _token == "-g":
+            _action = "goto %s" % _value
+        elif _token in ["--sport", "--dport"]:
+            _low, _high = (_value.split(":") + [_value])[:2]
+            _ports[_token[2:]] = (int(_low or 0), int(_high or 65535))
+        elif _token == "--match-set" and _tokens[_index + 2:_index + 3] in [["src"], ["dst"]]:
+            if _value not in sets:
+                raise IPTablesError("Unknown ipset %s, can't translate to nftables: %s" % (_value, rule))
+            _after.append(("ip %saddr" % _tokens[_index + 2][0], "@%s" % _value, None))
+            _index += 1
+        elif _token == "-d":
+            _network, _mask, _form = parsesubnet(_value)
+            _after.append(_nftaddr("ip daddr", _network, _mask))
+        elif _token == "--state":
+            _states = tuple(_value.split(","))
+        elif _token == "--comment":
+            _comment = _value
+        elif _token == "-m" and _value in _NFT_MODULES:
+            pass
+        else:
+            raise IPTablesError("Can't translate %s to nftables: %s" % (_token, rule))
+        _index += 2
+
+    if rule._ifname and rule._ifdir in ["in", "out"]:
+        _field = "iifname" if rule._ifdir == "in" else "oifname"
+        #: A wildcard, eth+, is a prefix match nft can't look up in a set
+        if rule._ifname.endswith("+"):
+            _matches.append((_field, '"%s*"' % rule._ifname[:-1], None))
+        else:
+            _matches.append((_field, '"%s"' % rule._ifname, rule._ifname))
+    if rule._network is not None:
+        _matches.append(_nftaddr("ip saddr", rule._network, rule._mask))
+    _matches.extend(_after)
+
+    if type(rule.icmp) == int:
+        _matches.append(("icmp type", str(rule.icmp), (rule.icmp, rule.icmp)))
+    else:
+        _protocol = rule.protocol.lower() if type(rule.protocol) == str else None
+        for _option, _port in [("sport", rule.src_port), ("dport", rule.dst_port)]:
+            if _port is not None and _option not in _ports:
+                _ports[_option] = (int(_port), int(_port))
+        _named = _protocol in _NFT_PORTS
+        if _protocol and _protocol not in ["all", "0"] and not (_ports and _named):
+            _matches.append(("meta l4proto", _protocol, _protocol))
+        for _option in ["sport", "dport"]:
+            if _option in _ports:
+                _low, _high = _ports[_option]
+                _matches.append(("%s %s" % (_protocol if _named else "th", _option),
+                                 str(_low) if _low == _high else "%d-%d" % (_low, _high), (_low, _high)))
+    if _states:
+        _matches.append(("ct state", ",".join(_state.lower() for _state in _states), None))
+
+    if _action:
+        return tuple(_matches), _action, True, _comment
+    if not rule.target:
+        return tuple(_matches), "counter", False, _comment
+    _action, _verdict = _nftaction(rule.target, chains, rule)
+    return tuple(_matches), _action, _verdict, _comment
+
+
+def _nftaddr(field, network, mask):
+    """
+    An address match, a plain prefix can go in a set, any other mask can't
+    """
+    _network = network & mask
+    if _contiguous(mask):
+        _length = _masklen(mask)
+        _value = _unpackaddr(_network) if _length == 32 else "%s/%d" % (_unpackaddr(_network), _length)
+        return field, _value, (_network, _network | (~mask & 0xFFFFFFFF))
+    return "%s & %s ==" % (field, _unpackaddr(mask)), _unpackaddr(_network), None
+
+
+def _nftaction(target, chains, rule):
+    """
+    @summary: A target as an nft verdict or statement
+    @rtype: (str action, bool verdict)
+    """
+    if target in _NFT_VERDICTS:
+        return _NFT_VERDICTS[target], True
+    if target in chains:
+        return "jump %s" % target, True
+    _tokens = [_quoted or _plain for _quoted, _plain in _TOKEN.findall(target)]
+    _name = _tokens[0]
+    _options = dict(zip(_tokens[1::2], _tokens[2::2]))
+    if _name == "QUEUE":
+        return "queue", False
+    if _name == "LOG":
+        _action = ["log"]
+        if "--log-prefix" in _options:
+            _action.append('prefix "%s"' % _options["--log-prefix"])
+        if "--log-level" in _options:
+            _level = _options["--log-level"]
+            _action.append("level %s" % (_NFT_LEVELS[int(_level)] if _level.isdigit() else _level))
+        return " ".join(_action), False
+    if _name == "NFLOG":
+        _action = ["log group %s" % _options.get("--nflog-group", "0")]
+        if "--nflog-prefix" in _options:
+            _action.append('prefix "%s"' % _options["--nflog-prefix"])
+        return " ".join(_action), False
+    if _name == "REJECT":
+        _with = _options.get("--reject-with", "icmp-port-unreachable")
+        if _with == "tcp-reset":
+            return "reject with tcp reset", False
+        return "reject with icmp type %s" % _with.replace("icmp-", "", 1), False
+    raise IPTablesError("Can't translate target %s to nftables: %s" % (target, rule))
+
+
+def _nftrun(entries, start, index, vmap):
+    """
+    @summary: How many rules from start differ only in the match at index,
+              and can be written as one rule matching it against a set, all
+              with the same action, or against a verdict map, each with its
+              own verdict. A map looks up one element, so its keys can't
+              overlap or first match wouldn't be kept, nor can a set's for
+              an action a packet carries on from (log, jump etc) as each
+              overlapping rule it matched would act on it.
+    @rtype: int
+    """
+    _matches, _action, _verdict, _comment = entries[start]
+    _before, _after, _field = _matches[:index], _matches[index + 1:], _matches[index][0]
+    _disjoint = vmap or _action.split(" ", 1)[0] not in _NFT_TERMINAL
+    _keys = []
+    _end = start
+    while _end < len(entries):
+        _other, _otheraction, _otherverdict, _othercomment = entries[_end]
+        if (len(_other) != len(_matches) or _other[index][0] != _field or _other[index][2] is None
+                or _other[:index] != _before or _other[index + 1:] != _after or _othercomment != _comment):
+            break
+        if vmap and not _otherverdict or not vmap and _otheraction != _action:
+            break
+        if _disjoint and not _nftdisjoint(_keys, _other[index][2]):
+            break
+        _end += 1
+    return _end - start
+
+
+def _nftdisjoint(keys, key):
+    """
+    Add a key to a sorted list of keys that don't overlap, False if it
+    overlaps one already there
+    """
+    _at = bisect_left(keys, key)
+    if type(key) == tuple:
+        if (_at and keys[_at - 1][1] >= key[0]) or (_at < len(keys) and keys[_at][0] <= key[1]):
+            return False
+    elif _at < len(keys) and keys[_at] == key:
+        return False
+    keys.insert(_at, key)
+    return True
+
+
+def _nftgroups(entries):
+    """
+    @summary: Split a chain's translated rules into runs of rules that
+              follow each other and differ in one match only, taking the
+              longest run at each rule. A run with one action becomes a
+              rule matching a set, one with different verdicts a rule
+              looking the match up in a verdict map.
+    @rtype: list of (entries, index of the grouped match or None, bool vmap)
+    """
+    _groups = []
+    _start = 0
+    while _start < len(entries):
+        _best = (1, None, False)
+        for _index, (_field, _value, _key) in enumerate(entries[_start][0]):
+            if _key is None:
+                continue
+            for _vmap in [False, True] if entries[_start][2] else [False]:
+                _length = _nftrun(entries, _start, _index, _vmap)
+                if _length > _best[0]:
+                    _best = (_length, _index, _vmap)
+        _groups.append((entries[_start:_start + _best[0]], _best[1], _best[2]))
+        _start += _best[0]
+    return _groups
+
+
+def _nftelements(matches):
+    """
+    @summary: The elements of a set from the grouped matches, without
+              repeats and with overlapping intervals merged, a set can't
+              hold overlapping intervals
+    @rtype: list of str
+    """
+    if type(matches[0][2]) != tuple:
+        return list(OrderedDict((_value, None) for _field, _value, _key in matches))
+    _elements = []  # [value, low, high]
+    for _field, _value, (_low, _high) in sorted(matches, key=lambda _match: (_match[2][0], -_match[2][1])):
+        if _elements and _low <= _elements[-1][2]:
+            #: Subnets only nest, port ranges can overlap part way
+            if _high > _elements[-1][2]:
+                _elements[-1] = ["%d-%d" % (_elements[-1][1], _high), _elements[-1][1], _high]
+            continue
+        _elements.append([_value, _low, _high])
+    return [_value for _value, _low, _high in _elements]
+
+
+def _nftrender(group):
+    """
+    @summary: A group from _nftgroups() as the text of one nft rule
+    @rtype: str
+    """
+    _entries, _index, _vmap = group
+    _matches, _action, _verdict, _comment = _entries[0]
+    _parts = []
+    for _at, (_field, _value, _key) in enumerate(_matches):
+        if _at != _index:
+            _parts.append("%s %s" % (_field, _value))
+        elif _vmap:
+            _parts.append("%s vmap { %s }" % (_field, ", ".join("%s : %s" % (_entry[0][_at][1], _entry[1])
+                                                               for _entry in _entries)))
+        else:
+            _parts.append("%s { %s }" % (_field, ", ".join(_nftelements([_entry[0][_at] for _entry in _entries]))))
+    if not _vmap:
+        _parts.append(_action)
+    if _comment is not None:
+        _parts.append('comment "%s"' % _comment.replace('"', '\\"'))
+    return " ".join(_parts)
+
+
+#########
+# FLEET #
+#########
+#: What each worker process shares between the hosts it compiles, set in
+#: the parent before the pool forks and by _fleetinit() in each worker
+_FLEET = {"common": {}, "scripts": {}, "host": None}
+
+
+def loadaddresses(source):
+    """
+    @summary: Read an address list, one address, CIDR or address/netmask per
+              line with # comments, validating each one, so a list shared
+              by the hosts of a fleet is parsed once rather than per host
+    @rtype: list of str
+    @param source: str path or file-like object
+    """
+    _source = open(source, "r") if type(source) == str else source
+    _addresses = []
+    try:
+        for _number, _line in enumerate(_source, 1):
+            _address = _line.split("#", 1)[0].strip()
+            if not _address:
+                continue
+            try:
+                parsesubnet(_address)
+            except RuleError:
+                raise RuleError("Invalid address on line %d: %s" % (_number, _address))
+            _addresses.append(intern(_address))
+    finally:
+        if _source is not source:
+            _source.close()
+    return _addresses
+
+
+def compilefleet(hosts, outdir, common=None, processes=None, backend=None):
+    """
+    @summary: Compile a firewall for each host of a fleet in a pool of
+              processes and write each one to outdir/HOST. A host is
+              (name, source, variables), the source is either a builder
+              callable, called as source(**variables) and returning a
+              BlackSalt, or the path of a firewall.py style script run with
+              the variables as globals, whose BlackSalt instance is written
+              out. The common inputs, i.e. address lists from
+              loadaddresses(), are passed to every host along with its own
+              variables; they, the protocols file and the compiled scripts
+              are loaded once in this process and shared with the workers
+              rather than once per host. A host that fails is reported and
+              the rest of the fleet carries on, as does a host whose name
+              isn't a plain file name (a path, "..") as its output would
+              be written outside outdir. Builders must be module
+              level functions so they can be sent to the workers, with
+              processes=1 the hosts are compiled in this process.
+    @rtype: OrderedDict {"hosts": OrderedDict {name: OrderedDict {"seconds",
+            "rules", "output", "error", "traceback"}}, "compiled", "failed", "seconds"}
+    @param hosts: iterable of (name, source, variables), or a dict {name: (source, variables)}
+    @param outdir: str
+    @param common: dict of variables for every host
+    @param processes: int, defaults to the number of CPUs
+    @param backend: one of BACKENDS, defaults to each host's own backend
+    """
+    if backend is not None and backend not in BACKENDS:
+        raise IPTablesError("backend must be one of: %s" % ", ".join(BACKENDS))
+    _hosts = [(_name,) + tuple(_host) for _name, _host in hosts.iteritems()] if isinstance(hosts, dict) \
+        else list(hosts)
+    if len(set(_name for _name, _source, _variables in _hosts)) != len(_hosts):
+        raise IPTablesError("compilefleet host names must be unique")
+    if not os.path.isdir(outdir):
+        os.makedirs(outdir)
+    _start = time.time()
+
+    #: Load what the hosts share before the pool forks
+    PROTOCOLS.refresh(force=True)
+    _FLEET["common"] = dict(common or {})
+    _FLEET["scripts"] = {}
+    for _name, _source, _variables in _hosts:
+        if type(_source) == str and _source not in _FLEET["scripts"]:
+            #: A script that can't be read or compiled fails its hosts in the worker
+            try:
+                _FLEET["scripts"][_source] = _fleetscript(_source)
+            except (IOError, SyntaxError):
+                pass
+
+    _tasks, _results = [], []
+    for _name, _source, _variables in _hosts:
+        _error = _fleetname(_name)
+        if _error:
+            _results.append((_name, OrderedDict([("seconds", 0.0), ("rules", 0), ("output", None),
+                                                 ("error", "IPTablesError: %s" % _error), ("traceback", None)])))
+        else:
+            _tasks.append((_name, _source, _variables, os.path.join(outdir, _name), backend))
+    if processes == 1 or not _tasks:
+        _results.extend(map(_fleethost, _tasks))
+    else:
+        _pool = multiprocessing.Pool(processes, _fleetinit, (_FLEET["common"],))
+        try:
+            _results.extend(_pool.imap_unordered(_fleethost, _tasks))
+            _pool.close()
+        except BaseException:
+            _pool.terminate()
+            raise
+        finally:
+            _pool.join()
+
+    _byname = dict((_result[0], _result[1]) for _result in _results)
+    _report = OrderedDict([("hosts", OrderedDict((_name, _byname[_name]) for _name, _source, _variables
+                                                 in _hosts)),
+                           ("compiled", 0), ("failed", 0), ("seconds", 0.0)])
+    _report["failed"] = sum(1 for _host in _byname.itervalues() if _host["error"])
+    _report["compiled"] = len(_hosts) - _report["failed"]
+    _report["seconds"] = round(time.time() - _start, 4)
+    return _report
+
+
+def _fleetname(name):
+    """
+    Why a host name can't be the name of its output file in outdir, or None
+    """
+    if not isinstance(name, basestring) or not name:
+        return "Host name must be a non empty string: %r" % (name,)
+    if os.path.isabs(name) or os.sep in name or (os.altsep and os.altsep in name) or ".." in name:
+        return "Host name %r would write outside outdir" % name
+    return None
+
+
+def _fleetinit(common):
+    """
+    Pool initializer, the common inputs for the hosts this worker compiles
+    """
+    _FLEET["common"] = common
+
+
+def _fleetscript(path):
+    """
+    A firewall script compiled to a code object
+    """
+    with open(path, "r") as _script:
+        return compile(_script.read(), path, "exec")
+
+
+def _fleethost(task):
+    """
+    @summary: Compile one host of a fleet and write its output, the output
+              is written to a temporary file and renamed so a failed host
+              never leaves a partial file behind. Anything the host prints
+              is discarded and its own generate() calls do nothing.
+    @rtype: (str name, OrderedDict {"seconds", "rules", "output", "error", "traceback"})
+    """
+    _name, _source, _variables, _path, _backend = task
+    _result = OrderedDict([("seconds", 0.0), ("rules", 0), ("output", None), ("error", None),
+                           ("traceback", None)])
+    _start = time.time()
+    _stdout, _stdin = sys.stdout, sys.stdin
+    sys.stdout, sys.stdin = StringIO(), StringIO()
+    _FLEET["host"] = _name
+    try:
+        _globals = dict(_FLEET["common"])
+        _globals.update(_variables or {})
+        if type(_source) == str:
+            _code = _FLEET["scripts"].get(_source)
+            if _code is None:
+                _code = _FLEET["scripts"][_source] = _fleetscript(_source)
+            _globals.update({"__name__": "__fleet__", "__file__": _source})
+            exec _code in _globals
+            _instances = [_value for _value in _globals.itervalues() if isinstance(_value, BlackSalt)]
+            _blacksalt = _globals.get("iptables") if len(_instances) != 1 else _instances[0]
+            if not isinstance(_blacksalt, BlackSalt):
+                raise IPTablesError("%s left %d BlackSalt instances and none named iptables"
+                                    % (_source, len(_instances)))
+        else:
+            _blacksalt = _source(**_globals)
+            if not isinstance(_blacksalt, BlackSalt):
+                raise IPTablesError("The builder for %s returned %r, not a BlackSalt" % (_name, _blacksalt))
+        if _backend:
+            _blacksalt.backend = _backend
+        if _blacksalt.sets and _blacksalt.backend != "nft":
+            _fleetwrite("%s.ipset" % _path, _blacksalt.iter_ipsets())
+        _fleetwrite(_path, _blacksalt.iter_lines())
+        _result["rules"] = sum(1 for _rule in _blacksalt.rules if isinstance(_rule, Rule))
+        _result["output"] = _path
+    except BaseException as err:
+        if isinstance(err, KeyboardInterrupt):
+            raise
+        _result["error"] = "%s: %s" % (type(err).__name__, err)
+        _result["traceback"] = traceback.format_exc()
+    finally:
+        sys.stdout, sys.stdin = _stdout, _stdin
+        _FLEET["host"] = None
+    _result["seconds"] = round(time.time() - _start, 4)
+    return _name, _result
+
+
+def _fleetwrite(path, lines):
+    """
+    Write the lines to path through a temporary file
+    """
+    _temporary = "%s.tmp" % path
+    try:
+        with open(_temporary, "w") as _output:
+            _writelines(_output, lines)
+        os.rename(_temporary, path)
+    finally:
+        if os.path.exists(_temporary):
+            os.remove(_temporary)
+
+
+#################
+# COMPILE CACHE #
+#################
+class CompileCache(object):
+    """
+    An on-disk cache of rendered outputs, content addressed by a ruleset's
+    contenthash() and backend, BlackSalt(cachedir=...). It also remembers
+    the key last written to each scriptfile, or applied with each iptables
+    binary, so an unchanged ruleset isn't written or applied again. Once
+    the outputs take more than maxsize bytes the least recently used are
+    evicted.
+
+        DIRECTORY/outputs/KEY   a rendered output, KEY is HASH-BACKEND
+        DIRECTORY/deployed      JSON {path: KEY} of what was last deployed
+    """
+    def __init__(self, directory, maxsize=CACHESIZE):
+        self.directory = directory
+        self.maxsize = maxsize
+        self._outputs = os.path.join(directory, "outputs")
+        self._deployed = os.path.join(directory, "deployed")
+        if not os.path.isdir(self._outputs):
+            os.makedirs(self._outputs)
+
+    def __repr__(self):
+        return "<CompileCache %s: %d outputs>" % (self.directory, len(os.listdir(self._outputs)))
+
+    def key(self, contenthash, backend):
+        """
+        @summary: The cache key of a content hash rendered by a backend
+        @rtype: str
+        """
+        return "%s-%s" % (contenthash, backend)
+
+    #######
+    # GET #
+    #######
+    def get(self, key):
+        """
+        @summary: The path of a cached output, marked as just used, or None
+                  if it isn't cached
+        @rtype: str or None
+        @param key: str
+        """
+        _path = os.path.join(self._outputs, key)
+        try:
+            os.utime(_path, None)
+        except OSError:
+            return None
+        return _path
+
+    #######
+    # PUT #
+    #######
+    def put(self, key, lines):
+        """
+        @summary: Render lines into the cache under key, through a temporary
+                  file so a partial output is never cached, then evict
+        @rtype: str (the path of the cached output)
+        @param key: str
+        @param lines: iterable of str
+        """
+        _path = os.path.join(self._outputs, key)
+        _temporary = "%s.%d.tmp" % (_path, os.getpid())
+        try:
+            with open(_temporary, "w") as _output:
+                _writelines(_output, lines)
+            os.rename(_temporary, _path)
+        finally:
+            if os.path.exists(_temporary):
+                os.remove(_temporary)
+        self.evict(keep=key)
+        return _path
+
+    ###########
+    # ENTRIES #
+    ###########
+    def entries(self):
+        """
+        @summary: The cached outputs, most recently used first, and whether
+                  each is the one last deployed somewhere
+        @rtype: list of OrderedDict {"key", "hash", "backend", "size", "used", "deployed"}
+        """
+        _deployed = {}
+        for _target, _key in self.deployments().iteritems():
+            _deployed.setdefault(_key, []).append(_target)
+        _entries = []
+        for _key in os.listdir(self._outputs):
+            if _key.endswith(".tmp"):
+                continue
+            try:
+                _stat = os.stat(os.path.join(self._outputs, _key))
+            except OSError:
+                continue
+            _hash, _sep, _backend = _key.partition("-")
+            _entries.append(OrderedDict([("key", _key), ("hash", _hash), ("backend", _backend),
+                                         ("size", _stat.st_size), ("used", _stat.st_mtime),
+                                         ("deployed", sorted(_deployed.get(_key, [])))]))
+        _entries.sort(key=lambda _entry: _entry["used"], reverse=True)
+        return _entries
+
+    def size(self):
+        """
+        @summary: The bytes the cached outputs take
+        @rtype: int
+        """
+        return sum(_entry["size"] for _entry in self.entries())
+
+    #########
+    # EVICT #
+    #########
+    def evict(self, keep=None):
+        """
+        @summary: Remove the least recently used outputs until the rest fit
+                  in maxsize bytes, never the output keep
+        @rtype: int (the number of outputs removed)
+        @param keep: str key
+        """
+        _entries = self.entries()
+        _size = sum(_entry["size"] for _entry in _entries)
+        _removed = 0
+        for _entry in reversed(_entries):
+            if _size <= self.maxsize:
+                break
+            if _entry["key"] == keep:
+                continue
+            self._remove(_entry["key"])
+            _size -= _entry["size"]
+            _removed += 1
+        return _removed
+
+    #########
+    # PURGE #
+    #########
+    def purge(self, keys=None):
+        """
+        @summary: Remove the given outputs, or every output and what was last
+                  deployed, so the next generate() or apply() runs in full
+        @rtype: int (the number of outputs removed)
+        @param keys: list of str, or None for everything
+        """
+        if keys is None:
+            keys = [_entry["key"] for _entry in self.entries()]
+            if os.path.exists(self._deployed):
+                os.remove(self._deployed)
+        else:
+            _deployments = self.deployments()
+            self._savedeployed(dict((_target, _key) for _target, _key in _deployments.iteritems()
+                                    if _key not in keys))
+        return sum(1 for _key in keys if self._remove(_key))
+
+    ############
+    # DEPLOYED #
+    ############
+    def deployments(self):
+        """
+        @summary: What was last deployed to each path
+        @rtype: dict {path: key}
+        """
+        try:
+            with open(self._deployed, "r") as _deployed:
+                return json.load(_deployed)
+        except (IOError, ValueError):
+            return {}
+
+    def deployed(self, target):
+        """
+        @summary: The key last deployed to a scriptfile or iptables binary
+        @rtype: str or None
+        """
+        return self.deployments().get(os.path.abspath(target))
+
+    def setdeployed(self, target, key):
+        """
+        @summary: Record the key just deployed to a scriptfile or iptables binary
+        @rtype: None
+        """
+        _deployments = self.deployments()
+        _deployments[os.path.abspath(target)] = key
+        self._savedeployed(_deployments)
+
+    ###########
+    # HELPERS #
+    ###########
+    def _savedeployed(self, deployments):
+        _temporary = "%s.%d.tmp" % (self._deployed, os.getpid())
+        with open(_temporary, "w") as _deployed:
+            json.dump(deployments, _deployed, indent=2, sort_keys=True)
+        os.rename(_temporary, self._deployed)
+
+    def _remove(self, key):
+        try:
+            os.remove(os.path.join(self._outputs, key))
+            return True
+        except OSError:
+            return False
+
+
+########
+# COST #
+########
+#: A traffic class's interface or protocol when it's one no rule names
+ANY = "*"
+
+
+class _CostRule(object):
+    """
+    What estimate() needs to know about a rule; the interface, protocol and
+    states it's limited to, whether it matches on anything else, what it
+    does with a packet and the match modules it loads
+    """
+    __slots__ = ("ifname", "ifdir", "protocol", "states", "narrow", "kind", "chain", "verdict", "modules")
+
+    def __init__(self, rule, chains):
+        _space = MatchSpace(rule)
+        _options = _simoptions(rule.extra or "")
+        _ports = _space.sport != (0, 65535) or _space.dport != (0, 65535) or _space.icmp is not None
+        self.ifname = rule._ifname
+        self.ifdir = rule._ifdir
+        self.protocol = _space.protocol
+        self.states = _space.states
+        #: Matching on anything else makes it only maybe match a class
+        self.narrow = bool(_space.mask or _ports or _options["sport"] or _options["dport"]
+                           or _options["set"] or _options["unmodelled"])
+        self.verdict = (rule.target or "").split(" ", 1)[0]
+        self.chain = _options["goto"] or (self.verdict if self.verdict in chains else None)
+        if _options["goto"]:
+            self.kind = "goto"
+        elif self.chain:
+            self.kind = "jump"
+        elif self.verdict == "RETURN":
+            self.kind = "return"
+        elif self.verdict in _VERDICTS:
+            self.kind = "verdict"
+        else:
+            self.kind = None  # LOG and the like, the packet carries on
+        self.modules = set()
+        if rule._state:
+            self.modules.add("state")
+        if _ports:
+            self.modules.add(_space.protocol or "tcp")
+        _tokens = (rule.extra or "").split()
+        self.modules.update(_value for _option, _value in zip(_tokens, _tokens[1:]) if _option == "-m")
+
+    def relation(self, ifname, direction, protocol, state):
+        """
+        @summary: Whether every packet of a traffic class matches this rule,
+                  only some may, or none can
+        @rtype: str "certain" or "maybe", None if none can
+        """
+        if state != ANY and state not in self.states:
+            return None
+        if self.protocol is not None and self.protocol != protocol:
+            return None
+        _maybe = self.narrow
+        if self.ifname:
+            if self.ifdir != direction:
+                _maybe = True
+            elif self.ifname != ifname:
+                if not self.ifname.endswith("+"):
+                    return None
+                _prefix = self.ifname[:-1]
+                if ifname.startswith(_prefix):
+                    pass  # eth0, or eth1+, all match eth+
+                elif ifname == ANY or ifname.endswith("+") and _prefix.startswith(ifname[:-1]):
+                    _maybe = True
+                else:
+                    return None
+        return "maybe" if _maybe else "certain"
+
+
+class _CostModel(object):
+    """
+    The worst case walk of each chain by each traffic class, see
+    BlackSalt.estimate(). A user defined chain is walked once per class
+    however many rules jump to it.
+    """
+    def __init__(self, chains, policies):
+        self.policies = policies
+        self.rules = dict((_chain, [(_line, _CostRule(_rule, chains)) for _line, _rule in _entries])
+                          for _chain, _entries in chains.iteritems())
+        self.walks = {}
+
+    def walk(self, chain, cls, stack=()):
+        """
+        @summary: The worst case walk of a chain by a class of packets; every
+                  rule up to the first one certain to stop the whole class
+                  is tested, and each chain it may jump to is walked
+        @rtype: dict {"tests", "best", "jumps", "final", "verdict", "line",
+                "path", "modules", "chains"}; tests is the most rules tested,
+                best the fewest before the class could get a verdict (None
+                if it can't), final whether the whole class gets a verdict,
+                line the rule giving it (0 for the policy) and chains the
+                rules tested in each chain
+        @param cls: tuple (interface, direction, protocol, state)
+        """
+        _key = (chain, cls)
+        if _key in self.walks:
+            return self.walks[_key]
+        _walk = {"tests": 0, "best": None, "jumps": 0, "final": False, "verdict": None, "line": 0,
+                 "path": [chain], "modules": set(), "chains": {chain: 0}}
+        if chain in stack:
+            return _walk  # iptables won't load a loop, a jump back to a chain is taken as a return
+        for _line, _rule in self.rules.get(chain, []):
+            _relation = _rule.relation(*cls)
+            _walk["tests"] += 1
+            _walk["chains"][chain] += 1
+            if _rule.protocol in [None, cls[2]]:
+                _walk["modules"].update(_rule.modules)  # the kernel checks the protocol before any match
+            if _relation is None:
+                continue
+            if _rule.chain:
+                _sub = self.walk(_rule.chain, cls, stack + (chain,))
+                if _walk["best"] is None and _sub["best"] is not None:
+                    _walk["best"] = _walk["tests"] + _sub["best"]
+                _walk["tests"] += _sub["tests"]
+                _walk["jumps"] += 1 + _sub["jumps"]
+                _walk["modules"].update(_sub["modules"])
+                _walk["path"].extend(_chain for _chain in _sub["path"] if _chain not in _walk["path"])
+                for _chain, _tests in _sub["chains"].iteritems():
+                    _walk["chains"][_chain] = _walk["chains"].get(_chain, 0) + _tests
+                if _relation == "certain" and (_sub["final"] or _rule.kind == "goto"):
+                    _walk.update(final=_sub["final"], verdict=_sub["verdict"], line=_sub["line"])
+                    break
+            elif _rule.kind:
+                if _walk["best"] is None:
+                    _walk["best"] = _walk["tests"]
+                if _relation == "certain":
+                    if _rule.kind == "verdict":
+                        _walk.update(final=True, verdict=_rule.verdict, line=_line)
+                    break
+        if not _walk["final"] and chain in BUILTIN_CHAINS:
+            _walk.update(final=True, verdict=self.policies.get(chain, "ACCEPT"), line=0)
+            if _walk["best"] is None:
+                _walk["best"] = _walk["tests"]
+        self.walks[_key] = _walk
+        return _walk
+
+
+def _costclasses(chains):
+    """
+    @summary: The traffic classes worth telling apart; each interface and
+              protocol a rule names and ANY for the rest, by each state if
+              a rule matches on state
+    @rtype: (list of interfaces, list of protocols, list of states)
+    """
+    _ifnames, _protocols, _states = set(), set(), False
+    for _entries in chains.itervalues():
+        for _line, _rule in _entries:
+            if _rule._ifname:
+                _ifnames.add(_rule._ifname)
+            _protocols.add("icmp" if _rule.icmp is not None else _protocolname(_rule.protocol))
+            _states = _states or bool(_rule._state)
+    _protocols.discard(None)
+    return (sorted(_ifnames) + [ANY], sorted(_protocols) + [ANY],
+            sorted(STATES, key=["NEW", "ESTABLISHED", "RELATED", "INVALID"].index) if _states else [ANY])
+
+
+def _costwalks(model, chains):
+    """
+    @summary: The worst case walk of each builtin chain by each traffic class
+    @rtype: generator of ((chain, interface, protocol, state), walk), see
+            _CostModel.walk()
+    """
+    _ifnames, _protocols, _states = _costclasses(chains)
+    for _chain in BUILTIN_CHAINS:
+        _direction = "out" if _chain == "OUTPUT" else "in"
+        for _ifname in _ifnames:
+            for _protocol in _protocols:
+                for _state in _states:
+                    yield (_chain, _ifname, _protocol, _state), model.walk(_chain, (_ifname, _direction,
+                                                                                    _protocol, _state))
+
+
+def _dominant(tests, share):
+    """
+    @summary: The fewest chains that together make share of all the tests
+    @rtype: list of str, costliest first
+    """
+    _total = sum(tests.itervalues())
+    _dominant, _covered = [], 0
+    for _chain, _tests in sorted(tests.iteritems(), key=lambda _item: (-_item[1], _item[0])):
+        if not _tests or _covered >= share * _total:
+            break
+        _dominant.append(_chain)
+        _covered += _tests
+    return _dominant
+
+
+def _costtotals(chains, policies):
+    """
+    @summary: The worst case rules tested summed over every traffic class
+              of each builtin chain
+    @rtype: dict {chain: int}
+    """
+    _totals = dict((_chain, 0) for _chain in BUILTIN_CHAINS)
+    for _class, _walk in _costwalks(_CostModel(chains, policies), chains):
+        _totals[_class[0]] += _walk["tests"]
+    return _totals
+
+
+#############
+# FAST PATH #
+#############
+def _statecertain(space):
+    """
+    Whether a rule matches every packet in its states, nothing but the
+    states is matched on and the options in extra are only comments
+    """
+    if space.ifin or space.ifout or space.protocol or space.icmp is not None or space.mask \
+            or space.sport != (0, 65535) or space.dport != (0, 65535):
+        return False
+    if not space.extra:
+        return True
+    _options = _simoptions(space.extra)
+    return not (_options["goto"] or _options["sport"] or _options["dport"] or _options["set"]
+                or _options["unmodelled"])
+
+
+def _fastpathplan(entries, spaces, states, policy, accepting):
+    """
+    @summary: Where a chain can take a fast path and what it does to the
+              rules after it, see BlackSalt.fastpath(). A state can be taken
+              if the first rule certain to stop it accepts it, or none does
+              and the policy accepts, and the fast path goes after the last
+              earlier rule that could do anything but accept it. Only the
+              states it saves tests for are taken.
+    @rtype: (position, states, Rule, changes) or None if nothing is saved;
+            the index in the entries the fast path goes in front of, the
+            states it takes, the fast path rule and a new rule, the same
+            rule or None (removed) for each entry
+    @param entries: list of (line, Rule) of one chain, see _chaintable()
+    @param spaces: list of the MatchSpace of each entry
+    @param policy: the chain's policy, None for a user defined chain
+    @param accepting: dict {state: set of chains certain to accept it}
+    """
+    _witnesses, _barriers = {}, {}
+    for _state in states:
+        _barriers[_state] = -1
+        _witnesses[_state] = len(entries) - 1 if policy == "ACCEPT" else None  # The policy costs no test
+        for _index, _space in enumerate(spaces):
+            if _state not in _space.states:
+                continue
+            _certain = _statecertain(_space)
+            if _statetarget(_space, _state, accepting) != "ACCEPT":
+                if _certain and (_space.terminal or _space.target in accepting.get(_state, ())):
+                    _witnesses[_state] = None  # It's stopped here by something else
+                    break
+                _barriers[_state] = _index
+            elif _certain:
+                _witnesses[_state] = _index
+                break
+    _states = [_state for _state in states if _witnesses[_state] is not None]
+    if not _states:
+        return None
+    _position = max(_barriers[_state] for _state in _states) + 1
+    _hoisted = [_state for _state in _states if _witnesses[_state] > _position]
+    if not _hoisted:
+        return None
+
+    _fastrule = Rule(chain=entries[0][1].chain, state=list(_hoisted), target="accept")
+    _changes = [_rule for _line, _rule in entries]
+    for _index in xrange(_position, len(entries)):
+        _rule = entries[_index][1]
+        if not _rule._state or not set(_rule._state) & set(_hoisted):
+            continue
+        _left = [_state for _state in _rule._state if _state not in _hoisted]
+        if _left:
+            _changes[_index] = _rule.copy()
+            _changes[_index].set_state(_left)
+        else:
+            _changes[_index] = None
+    return _position, _hoisted, _fastrule, _changes
+
+
+def _statetarget(space, state, accepting):
+    """
+    A rule's target, ACCEPT for a jump to a chain certain to accept
+    every packet in the state
+    """
+    if space.target in accepting.get(state, ()):
+        return "ACCEPT"
+    return space.target
+
+
+def _statetrace(spaces, state, policy, accepting):
+    """
+    @summary: The rules a packet in a state may meet in a chain and the
+              verdict it gets if none of them match, after the first rule
+              certain to stop it; a run of ACCEPT rules ending in an ACCEPT
+              verdict makes no difference to the verdict and is left out.
+              Two chains with the same trace for a state give every packet
+              in that state the same verdict.
+    @rtype: (list of rule matches and targets, verdict)
+    @param spaces: list of the MatchSpace of each rule in a chain
+    @param accepting: dict {state: set of chains certain to accept it}
+    """
+    _trace = []
+    _verdict = policy
+    for _space in spaces:
+        if state not in _space.states:
+            continue
+        _target = _statetarget(_space, state, accepting)
+        if (_space.terminal or _target == "ACCEPT") and _statecertain(_space):
+            _verdict = _target.split(" ", 1)[0]
+            break
+        _trace.append((_space.ifin, _space.ifout, _space.protocol, _space.icmp, _space.network, _space.mask,
+                       _space.sport, _space.dport, _space.extra, _target))
+    while _verdict == "ACCEPT" and _trace and _trace[-1][-1] == "ACCEPT":
+        _trace.pop()
+    return _trace, _verdict
+
+
+###########
+# MONITOR #
+###########
+#: Counter sources a Monitor can run by name, see Monitor.command()
+MONITOR_SOURCES = ["list", "save"]
+_NAN = float("nan")
+
+
+class Monitor(object):
+    """
+    Polls the packet and byte counters of the running firewall and keeps
+    the rate of each rule of a BlackSalt instance over the last length
+    polls, in ring buffers allocated once, so polling every second for as
+    long as it runs doesn't grow its memory. The source is "list" for
+    iptables -L -v -x -n, "save" for iptables-save -c, a command as a list,
+    a str path to a file of either output read on each poll, or a callable
+    returning lines. Counters are matched to rules by chain and position,
+    a chain whose rule count doesn't match is skipped until it does, see
+    remap() after the rules change. start() polls every interval seconds
+    in a thread, or call poll() from a loop of your own. Rates of a poll
+    that had no earlier counters to go by, or after a counter went back
+    (the rules were reloaded), are NaN. Hooks are called as hook(event,
+    data) after each poll, event "poll" with data {"time", "rules",
+    "seconds", "skipped"}, or event "error" with data {"error"}.
+    """
+    def __init__(self, blacksalt, source="list", interval=1.0, length=60, hooks=None):
+        if type(source) == str and source not in MONITOR_SOURCES and not os.path.isfile(source):
+            raise IPTablesError("source must be one of %s, a command, a file or a callable"
+                                % ", ".join(MONITOR_SOURCES))
+        self.blacksalt = blacksalt
+        self.source = source
+        self.interval = interval  # Seconds between polls in the thread
+        self.length = length  # Polls kept in each rule's ring buffer
+        self.hooks = list(hooks or [])
+        self.polls = 0
+        self.errors = 0
+        self.error = None  # The last error, as a str
+        self.seconds = 0.0  # What the last poll took
+        self.skipped = []  # Chains the last poll had the wrong number of counters for
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.remap()
+
+    def __repr__(self):
+        return "<Monitor: %d rules, %d polls>" % (len(self.rules), self.polls)
+
+    def hook(self, callback):
+        """
+        @summary: Call callback(event, data) after each poll
+        @rtype: None
+        """
+        self.hooks.append(callback)
+
+    def remap(self):
+        """
+        @summary: Match the counters to the rules again, after rules are
+                  added or removed, and start every ring buffer afresh
+        @rtype: None
+        """
+        _chains, _policies = _chaintable(self.blacksalt.rules)
+        with self._lock:
+            self.rules = []
+            self.chains = OrderedDict()  # chain -> (first slot, rules)
+            for _chain, _entries in _chains.iteritems():
+                self.chains[_chain] = (len(self.rules), len(_entries))
+                self.rules.extend(_rule for _line, _rule in _entries)
+            self._slots = dict((id(_rule), _slot) for _slot, _rule in enumerate(self.rules))
+            _count = len(self.rules)
+            #: The rates of rule n are at n * length to (n + 1) * length, oldest at position
+            self.packetrates = array("d", [_NAN]) * (_count * self.length)
+            self.byterates = array("d", [_NAN]) * (_count * self.length)
+            self.times = array("d", [_NAN]) * self.length
+            self.position = 0
+            self._packets = array("d", [_NAN]) * _count  # The counters of the last poll
+            self._bytes = array("d", [_NAN]) * _count
+            self._newpackets = array("d", [_NAN]) * _count
+            self._newbytes = array("d", [_NAN]) * _count
+            self._last = None
+
+    ########
+    # POLL #
+    ########
+    def command(self):
+        """
+        @summary: The command a named source runs
+        @rtype: list or None for a file or callable source
+        """
+        if self.source == "list":
+            return [self.blacksalt.iptables, "-L", "-v", "-x", "-n"]
+        if self.source == "save":
+            return [self.blacksalt.iptables + "-save", "-c", "-t", "filter"]
+        if isinstance(self.source, (list, tuple)):
+            return list(self.source)
+        return None
+
+    def poll(self):
+        """
+        @summary: Read the counters once and add the rates since the last
+                  poll to the ring buffers
+        @rtype: int, the rules whose counters were read
+        @raise IPTablesError: when the source can't be read
+        """
+        _start = time.time()
+        _command = self.command()
+        try:
+            if _command:
+                _process = subprocess.Popen(_command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                try:
+                    _seen = self._read(_process.stdout)
+                finally:
+                    _error = _process.stderr.read()
+                    _status = _process.wait()
+                if _status:
+                    raise IPTablesError("%s exited %d: %s" % (" ".join(_command), _status, _error.strip()))
+            elif callable(self.source):
+                _seen = self._read(self.source())
+            else:
+                with open(self.source, "r") as _source:
+                    _seen = self._read(_source)
+        except (OSError, IOError) as err:
+            raise IPTablesError("Can't read counters: %s" % err)
+        _rules = self._record(_start, _seen)
+        self.seconds = time.time() - _start
+        self._notify("poll", {"time": _start, "rules": _rules, "seconds": self.seconds, "skipped": self.skipped})
+        return _rules
+
+    def _read(self, lines):
+        """
+        @summary: Parse counters into the new counter arrays as they're read,
+                  from iptables -L -v -x -n or iptables-save -c lines
+        @rtype: dict {chain: counters read}
+        """
+        _chains = self.chains
+        _packets, _bytes = self._newpackets, self._newbytes
+        _seen = dict.fromkeys(_chains, 0)
+        _chain = None
+        _first = _count = _index = _column = 0
+        for _line in lines:
+            if _line.startswith("["):
+                #: [12:3400] -A INPUT ...
+                _counters, _rule = _line[1:].split("]", 1)
+                _chain = _rule.split(None, 2)[1]
+                if _chain not in _chains:
+                    continue
+                _index = _seen[_chain]
+                _seen[_chain] = _index + 1
+                _first, _count = _chains[_chain]
+                if _index < _count:
+                    _packets[_first + _index], _bytes[_first + _index] = map(float, _counters.split(":"))
+                continue
+            _fields = _line.split()
+            if not _fields:
+                continue
+            _heading = _CHAIN.match(_line)
+            if _heading:
+                _chain = _heading.group(1) if _heading.group(1) in _chains else None
+                if _chain:
+                    _first, _count = _chains[_chain]
+            elif _fields[0] in ["pkts", "num"]:
+                _column = _fields.index("pkts")
+            elif _chain and _fields[0][:1].isdigit():
+                _index = _seen[_chain]
+                _seen[_chain] = _index + 1
+                if _index < _count:
+                    _packets[_first + _index] = _counter(_fields[_column])
+                    _bytes[_first + _index] = _counter(_fields[_column + 1])
+        return _seen
+
+    def _record(self, now, seen):
+        """
+        @summary: Add the rates of each rule since the last poll at the
+                  current position of the ring buffers, NaN for the rules
+                  of skipped chains
+        @rtype: int, the rules recorded
+        """
+        _length = self.length
+        _elapsed = now - self._last if self._last is not None else 0.0
+        _rules = 0
+        _skipped = []
+        with self._lock:
+            _position = self.position
+            _packetrates, _byterates = self.packetrates, self.byterates
+            _packets, _bytes = self._packets, self._bytes
+            _newpackets, _newbytes = self._newpackets, self._newbytes
+            for _chain, (_first, _count) in self.chains.iteritems():
+                if seen.get(_chain) != _count:
+                    _skipped.append(_chain)
+                    for _slot in xrange(_first, _first + _count):
+                        _packetrates[_slot * _length + _position] = _byterates[_slot * _length + _position] = _NAN
+                        _packets[_slot] = _bytes[_slot] = _NAN
+                    continue
+                _rules += _count
+                for _slot in xrange(_first, _first + _count):
+                    _at = _slot * _length + _position
+                    _packet, _byte = _newpackets[_slot], _newbytes[_slot]
+                    #: NaN compares False, so a first poll or a reset counter gives NaN
+                    if _elapsed and _packet >= _packets[_slot] and _byte >= _bytes[_slot]:
+                        _packetrates[_at] = (_packet - _packets[_slot]) / _elapsed
+                        _byterates[_at] = (_byte - _bytes[_slot]) / _elapsed
+                    else:
+                        _packetrates[_at] = _byterates[_at] = _NAN
+                    _packets[_slot], _bytes[_slot] = _packet, _byte
+            self.times[_position] = now
+            self.position = (_position + 1) % _length
+            self.polls += 1
+            self.skipped = _skipped
+            self._last = now
+        return _rules
+
+    ##########
+    # THREAD #
+    ##########
+    def start(self):
+        """
+        @summary: Poll every interval seconds in a daemon thread until stop(),
+                  errors are counted, kept in error and passed to the hooks
+        @rtype: None
+        """
+        if self._thread is not None and self._thread.is_alive():
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="blacksalt-monitor")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """
+        @summary: Stop polling and wait for the thread to finish
+        @rtype: None
+        """
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def _run(self):
+        _next = time.time()
+        while not self._stop.is_set():
+            try:
+                self.poll()
+            except IPTablesError as err:
+                self.errors += 1
+                self.error = str(err)
+                self._notify("error", {"error": self.error})
+            #: Keep to the interval whatever a poll takes, skipping polls that overran
+            _next += self.interval
+            _now = time.time()
+            if _next < _now:
+                _next = _now + self.interval - (_now - _next) % self.interval
+            self._stop.wait(_next - _now)
+
+    #########
+    # RATES #
+    #########
+    def rates(self, rule, bytes=False):
+        """
+        @summary: The packet (or byte) rates per second of a rule, oldest
+                  first, NaN where a poll has none
+        @rtype: list of float, length long
+        @param rule: Rule as in BlackSalt.rules, or its position in the
+                     monitor's rules
+        """
+        _slot = rule if isinstance(rule, int) else self._slots.get(id(rule))
+        if _slot is None:
+            raise IPTablesError("Rule isn't monitored, see Monitor.remap()")
+        _rates = self.byterates if bytes else self.packetrates
+        _first = _slot * self.length
+        with self._lock:
+            _position = self.position
+            return (_rates[_first + _position:_first + self.length] + _rates[_first:_first + _position]).tolist()
+
+    def latest(self, bytes=False):
+        """
+        @summary: The rate of every rule at the last poll
+        @rtype: list of (Rule, float), in the monitor's order of rules
+        """
+        _rates = self.byterates if bytes else self.packetrates
+        with self._lock:
+            _at = (self.position - 1) % self.length
+            return [(_rule, _rates[_slot * self.length + _at]) for _slot, _rule in enumerate(self.rules)]
+
+    def top(self, count=10, bytes=False):
+        """
+        @summary: The rules with the highest rates at the last poll
+        @rtype: list of (Rule, float), highest first
+        """
+        return heapq.nlargest(count, (_entry for _entry in self.latest(bytes) if _entry[1] == _entry[1]),
+                              key=lambda _entry: _entry[1])
+
+    def _notify(self, event, data):
+        for _hook in self.hooks:
+            _hook(event, data)
+
+
+################
+# LOG ANALYSIS #
+################
+_MASK64 = (1 << 64) - 1
+
+
+def _mix64(value):
+    """
+    A 64 bit hash of a str, hash() mixed so its bits are evenly spread
+    """
+    _hash = hash(value) & _MASK64
+    _hash = ((_hash ^ (_hash >> 33)) * 0xff51afd7ed558ccd) & _MASK64
+    _hash = ((_hash ^ (_hash >> 33)) * 0xc4ceb9fe1a85ec53) & _MASK64
+    return _hash ^ (_hash >> 33)
+
+
+class CountMinSketch(object):
+    """
+    Approximate counts of any number of keys in width * depth counters; a
+    count is never under, and over by at most 2/width of the total with
+    probability 1 - 0.5 ** depth. With keep=N the N keys with the highest
+    counts so far are kept as candidates for top().
+    """
+    def __init__(self, width=2048, depth=4, keep=0):
+        self.width = width
+        self.depth = depth
+        self.keep = keep
+        self.total = 0
+        self.rows = [array("L", [0]) * width for _row in xrange(depth)]
+        self._candidates = {}  # key -> count, at most keep of them
+        self._floor = 0  # The lowest candidate count once there are keep of them
+
+    def add(self, key, count=1, hashed=None):
+        """
+        @summary: Count a key count times
+        @rtype: int, the key's count so far
+        @param hashed: _mix64(key), when the caller has it already
+        """
+        _hash = _mix64(key) if hashed is None else hashed
+        _step = (_hash >> 32) | 1
+        _width = self.width
+        _estimate = None
+        for _row in self.rows:
+            _at = _hash % _width
+            _value = _row[_at] + count
+            _row[_at] = _value
+            if _estimate is None or _value < _estimate:
+                _estimate = _value
+            _hash += _step
+        self.total += count
+        if self.keep:
+            _candidates = self._candidates
+            if key in _candidates or len(_candidates) < self.keep:
+                _candidates[key] = _estimate
+            elif _estimate > self._floor:
+                del _candidates[min(_candidates, key=_candidates.get)]
+                _candidates[key] = _estimate
+                self._floor = min(_candidates.itervalues())
+        return _estimate
+
+    def estimate(self, key):
+        """
+        @summary: A key's count so far
+        @rtype: int
+        """
+        _hash = _mix64(key)
+        _step = (_hash >> 32) | 1
+        _estimate = None
+        for _row in self.rows:
+            _value = _row[_hash % self.width]
+            if _estimate is None or _value < _estimate:
+                _estimate = _value
+            _hash += _step
+        return _estimate
+
+    def top(self, count=10):
+        """
+        @summary: The candidate keys with the highest counts
+        @rtype: list of (key, count), highest first
+        """
+        return heapq.nlargest(count, self._candidates.iteritems(), key=lambda _item: _item[1])
+
+
+class HyperLogLog(object):
+    """
+    An approximate count of distinct keys in 2 ** precision bytes, within
+    about 1.04 / sqrt(2 ** precision) of the true count
+    """
+    def __init__(self, precision=12):
+        self.precision = precision
+        self.registers = bytearray(1 << precision)
+
+    def add(self, key, hashed=None):
+        """
+        @summary: Count a key, once however often it's added
+        @rtype: None
+        @param hashed: _mix64(key), when the caller has it already
+        """
+        _hash = _mix64(key) if hashed is None else hashed
+        _register = _hash >> (64 - self.precision)
+        _rank = 64 - self.precision - (_hash & ((1 << (64 - self.precision)) - 1)).bit_length() + 1
+        if _rank > self.registers[_register]:
+            self.registers[_register] = _rank
+
+    def count(self):
+        """
+        @summary: The number of distinct keys added
+        @rtype: int
+        """
+        _size = len(self.registers)
+        _estimate = 0.7213 / (1 + 1.079 / _size) * _size * _size / sum(2.0 ** -_rank for _rank in self.registers)
+        _empty = self.registers.count("\x00")
+        if _estimate <= 2.5 * _size and _empty:
+            _estimate = _size * math.log(float(_size) / _empty)  # Linear counting for small counts
+        return int(round(_estimate))
+
+
+class LogAnalyzer(object):
+    """
+    Reads netfilter LOG lines, from kern.log or a pipe, and keeps what's
+    being logged in fixed memory however many lines it reads. Lines are
+    attributed to the LOG rules of a BlackSalt instance by their
+    --log-prefix, and counted exactly by prefix and input interface; the
+    heaviest sources, destinations and protocol/destination ports are
+    found with count-min sketches, and distinct sources, in all and by
+    prefix, counted with HyperLogLog. Lines are first counted exactly in a
+    buffer of about buffer distinct (prefix, interface, source,
+    destination, protocol, port) keys, which goes into the sketches when
+    full, so the sketches are updated once per key rather than per line.
+    Source ports are ephemeral and aren't counted. Every interval seconds
+    of reading the hooks are called as hook("summary", summary()).
+    """
+    def __init__(self, blacksalt=None, top=10, width=2048, depth=4, precision=12, interval=60.0, buffer=65536,
+                 hooks=None):
+        self.blacksalt = blacksalt
+        self.topcount = top  # Entries in each list of a summary
+        self.precision = precision
+        self.interval = interval  # Seconds between summaries while reading
+        self.buffer = buffer
+        self.hooks = list(hooks or [])
+        self.sources = CountMinSketch(width, depth, keep=4 * top)
+        self.destinations = CountMinSketch(width, depth, keep=4 * top)
+        self.ports = CountMinSketch(width, depth, keep=4 * top)
+        self.distinct = HyperLogLog(precision)
+        self.lines = 0  # LOG lines read
+        self.prefixes = {}  # prefix -> [lines, HyperLogLog of sources]
+        self.interfaces = {}  # input interface -> lines
+        self._buffered = {}  # (prefix, interface, source, destination, protocol, port) -> lines
+        self._stop = threading.Event()
+        self._next = time.time() + interval  # When the hooks get the next summary
+        self.attribute()
+
+    def __repr__(self):
+        return "<LogAnalyzer: %d lines, %d prefixes>" % (self.lines + sum(self._buffered.itervalues()),
+                                                         len(self.prefixes))
+
+    def hook(self, callback):
+        """
+        @summary: Call callback("summary", summary()) every interval seconds
+                  of reading
+        @rtype: None
+        """
+        self.hooks.append(callback)
+
+    def attribute(self):
+        """
+        @summary: Find the LOG rules of the BlackSalt instance by prefix again,
+                  after rules are added or removed
+        @rtype: None
+        """
+        self.rules = {}  # prefix -> Rule
+        if self.blacksalt is None:
+            return
+        for _rule in self.blacksalt.rules:
+            if isinstance(_rule, Rule) and _rule.target and _rule.target.startswith("LOG "):
+                _tokens = [_quoted or _plain for _quoted, _plain in _TOKEN.findall(_rule.target)]
+                _options = dict(zip(_tokens[1::2], _tokens[2::2]))
+                if "--log-prefix" in _options:
+                    self.rules.setdefault(_options["--log-prefix"].strip(), _rule)
+
+    ########
+    # READ #
+    ########
+    def feed(self, lines):
+        """
+        @summary: Count LOG lines, other lines are skipped
+        @rtype: int, the LOG lines counted
+        @param lines: iterable of str
+        """
+        _buffered = self._buffered
+        _get = _buffered.get
+        _counted = 0
+        for _line in lines:
+            _at = _line.find("IN=")
+            if _at < 0:
+                continue
+            #: The prefix is between "kernel: " and its timestamp, i.e. "[12.345678]", and IN=; the
+            #: prefix itself can be bracketed, i.e. "[UFW BLOCK] "
+            _start = _line.find("kernel: ", 0, _at)
+            _start = _start + 8 if _start >= 0 else 0
+            if _line.startswith("[", _start):
+                _close = _line.find("]", _start, _at)
+                if _close > 0 and not _line[_start + 1:_close].strip(" .0123456789"):
+                    _start = _close + 1
+            _end = _line.find(" ", _at)
+            _field = _line.find(" SRC=", _end)
+            if _field < 0:
+                continue
+            _source = _line[_field + 5:_line.find(" ", _field + 5)]
+            _field = _line.find(" DST=", _field)
+            _destination = _line[_field + 5:_line.find(" ", _field + 5)]
+            _field = _line.find(" PROTO=", _field)
+            _protocol = _line[_field + 7:_line.find(" ", _field + 7)] if _field >= 0 else ""
+            _field = _line.find(" DPT=", _field)
+            _port = _line[_field + 5:_line.find(" ", _field + 5)] if _field >= 0 else ""
+            _key = (_line[_start:_at].strip(), _line[_at + 3:_end], _source, _destination, _protocol, _port)
+            _buffered[_key] = _get(_key, 0) + 1
+            _counted += 1
+            if not _counted & 0xFFF:
+                if len(_buffered) >= self.buffer:
+                    self.flush()
+                self._summarize()
+        return _counted
+
+    def flush(self):
+        """
+        @summary: Move the buffered counts into the sketches, each source,
+                  destination and port is added once with its total
+        @rtype: None
+        """
+        _prefixes, _interfaces = self.prefixes, self.interfaces
+        _sources, _destinations, _ports, _pairs = {}, {}, {}, set()
+        for (_prefix, _interface, _source, _destination, _protocol, _port), _count in self._buffered.iteritems():
+            _entry = _prefixes.get(_prefix)
+            if _entry is None:
+                _entry = _prefixes[_prefix] = [0, HyperLogLog(self.precision)]
+            _entry[0] += _count
+            _interfaces[_interface] = _interfaces.get(_interface, 0) + _count
+            _sources[_source] = _sources.get(_source, 0) + _count
+            _destinations[_destination] = _destinations.get(_destination, 0) + _count
+            _port = "%s/%s" % (_protocol.lower(), _port) if _port else _protocol.lower()
+            _ports[_port] = _ports.get(_port, 0) + _count
+            _pairs.add((_prefix, _source))
+            self.lines += _count
+        self._buffered.clear()
+        _hashes = {}
+        for _source, _count in _sources.iteritems():
+            _hash = _hashes[_source] = _mix64(_source)
+            self.sources.add(_source, _count, _hash)
+            self.distinct.add(_source, _hash)
+        for _prefix, _source in _pairs:
+            _prefixes[_prefix][1].add(_source, _hashes[_source])
+        for _destination, _count in _destinations.iteritems():
+            self.destinations.add(_destination, _count)
+        for _port, _count in _ports.iteritems():
+            self.ports.add(_port, _count)
+
+    def read(self, source, follow=False, poll=0.5):
+        """
+        @summary: Count the LOG lines of a file or pipe a line at a time; with
+                  follow keep reading lines as they are added, like tail -f,
+                  from the end of the file, reopening it when it's rotated,
+                  until stop()
+        @rtype: OrderedDict, see summary()
+        @param source: str path or file-like object
+        @param poll: seconds between looking for new lines when following
+        """
+        _source = open(source, "r") if type(source) == str else source
+        self._stop.clear()
+        try:
+            if not follow:
+                self.feed(_source)
+            else:
+                if _source is not source:
+                    _source.seek(0, os.SEEK_END)
+                while not self._stop.is_set():
+                    self.feed(iter(_source.readline, ""))
+                    self._summarize()
+                    if _source is not source and _rotated(source, _source):
+                        _source.close()
+                        _source = open(source, "r")
+                        continue
+                    self._stop.wait(poll)
+        finally:
+            if _source is not source:
+                _source.close()
+        return self.summary()
+
+    def stop(self):
+        """
+        @summary: Stop a read() that's following a file
+        @rtype: None
+        """
+        self._stop.set()
+
+    ###########
+    # SUMMARY #
+    ###########
+    def summary(self):
+        """
+        @summary: The top of everything counted so far
+        @rtype: OrderedDict {"lines", "attributed", "distinct sources",
+                "prefixes": [(prefix, Rule or None, lines, distinct sources)],
+                "interfaces", "sources", "destinations", "ports": [(key,
+                lines)]}, highest first; the counts of sources, destinations
+                and ports can be over, never under
+        """
+        self.flush()
+        _top = self.topcount
+        _prefixes = heapq.nlargest(_top, self.prefixes.iteritems(), key=lambda _item: _item[1][0])
+        return OrderedDict([
+            ("lines", self.lines),
+            ("attributed", sum(_entry[0] for _prefix, _entry in self.prefixes.iteritems() if _prefix in self.rules)),
+            ("distinct sources", self.distinct.count()),
+            ("prefixes", [(_prefix, self.rules.get(_prefix), _lines, _sources.count())
+                          for _prefix, (_lines, _sources) in _prefixes]),
+            ("interfaces", heapq.nlargest(_top, self.interfaces.iteritems(), key=lambda _item: _item[1])),
+            ("sources", self.sources.top(_top)),
+            ("destinations", self.destinations.top(_top)),
+            ("ports", self.ports.top(_top)),
+        ])
+
+    def _summarize(self):
+        """
+        Call the hooks with a summary if it's been interval seconds since the last
+        """
+        if self.hooks and time.time() >= self._next:
+            self._next = time.time() + self.interval
+            self._notify("summary", self.summary())
+
+    def _notify(self, event, data):
+        for _hook in self.hooks:
+            _hook(event, data)
+
+
+def _rotated(path, source):
+    """
+    Whether the file at a path was replaced or truncated since it was opened
+    """
+    try:
+        _stat = os.stat(path)
+    except OSError:
+        return False
+    return _stat.st_ino != os.fstat(source.fileno()).st_ino or _stat.st_size < source.tell()
@@ -10,6 +10,10 @@ iptables = BlackSalt()
 #                                      # to stdout when generating the tables.
 #       scriptfile = "Name and location of file"  #If set, generating rule will output
 #                                                 # to this file
+#       backend = "iptables" or "restore"  # This defaults to iptables, restore outputs
+#                                          # an iptables-restore file instead of a script
+#       overwrite = "prompt", "always", "never" or "error"  # What to do when the scriptfile
+#                                                           # already exists, defaults to prompt
 # These can be set after creation, by just setting the variables i.e.
 # iptables.printmode = False
 # iptables.scriptfile = "/usr/local/scripts/firewall"
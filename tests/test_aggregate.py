@@ -0,0 +1,52 @@
+"""
+aggregate() subnet merging
+"""
+
+import unittest
+
+from blacksalt import BlackSalt
+
+
+def _restore(blacksalt):
+    return [_line for _line in blacksalt.iter_restore() if _line.startswith("-A ")]
+
+
+class TestAggregate(unittest.TestCase):
+    def test_adjacent_subnets_merged(self):
+        _blacksalt = BlackSalt(printmode=False, backend="restore")
+        for _subnet in ["192.168.10.0/24", "192.168.11.0/24", "192.168.12.0/24"]:
+            _blacksalt.setrule(chain="input", protocol="tcp", dst=22, subnet=_subnet, target="accept")
+        self.assertEqual(_blacksalt.aggregate(), 1)
+        self.assertEqual(_restore(_blacksalt), [
+            "-A INPUT -p tcp -s 192.168.10.0/23 --dport 22 -j ACCEPT",
+            "-A INPUT -p tcp -s 192.168.12.0/24 --dport 22 -j ACCEPT"])
+
+    def test_runs_end_at_other_rules(self):
+        _blacksalt = BlackSalt(printmode=False, backend="restore")
+        _blacksalt.setrule(chain="input", protocol="tcp", dst=22, subnet="192.168.10.0/24", target="accept")
+        _blacksalt.setrule(chain="input", protocol="tcp", dst=22, target="drop")
+        _blacksalt.setrule(chain="input", protocol="tcp", dst=22, subnet="192.168.11.0/24", target="accept")
+        _before = _restore(_blacksalt)
+        self.assertEqual(_blacksalt.aggregate(), 0)
+        self.assertEqual(_restore(_blacksalt), _before)
+
+    def test_overlapping_logs_kept(self):
+        _blacksalt = BlackSalt(printmode=False, backend="restore")
+        for _subnet in ["10.0.0.0/24", "10.0.0.0/25", "10.0.1.0/24"]:
+            _blacksalt.setrule(chain="input", subnet=_subnet, target="log")
+        self.assertEqual(_blacksalt.aggregate(), 0)
+        self.assertEqual(_restore(_blacksalt), [
+            "-A INPUT -s 10.0.0.0/24 -j LOG",
+            "-A INPUT -s 10.0.0.0/25 -j LOG",
+            "-A INPUT -s 10.0.1.0/24 -j LOG"])
+
+    def test_disjoint_logs_merged(self):
+        _blacksalt = BlackSalt(printmode=False, backend="restore")
+        for _subnet in ["10.0.0.0/25", "10.0.0.128/25"]:
+            _blacksalt.setrule(chain="input", subnet=_subnet, target="log")
+        self.assertEqual(_blacksalt.aggregate(), 1)
+        self.assertEqual(_restore(_blacksalt), ["-A INPUT -s 10.0.0.0/24 -j LOG"])
+
+
+if __name__ == "__main__":
+    unittest.main()
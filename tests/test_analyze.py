@@ -0,0 +1,38 @@
+"""
+analyze() shadowed and redundant rules
+"""
+
+import unittest
+
+from blacksalt import BlackSalt
+
+
+class TestAnalyze(unittest.TestCase):
+    def setUp(self):
+        self.blacksalt = BlackSalt(printmode=False, backend="restore")
+        self.blacksalt.setrule(chain="input", protocol="tcp", dst=22, target="accept")
+        self.blacksalt.setrule(chain="input", protocol="tcp", dst=22, subnet="10.0.0.0/8", target="drop")
+        self.blacksalt.setrule(chain="input", protocol="tcp", dst=22, subnet="10.1.0.0/16", target="accept")
+        self.blacksalt.setrule(chain="input", subnet="10.0.0.0/8", target="drop")
+        self.blacksalt.setrule(chain="input", protocol="tcp", dst=80, target="accept")
+        self.blacksalt.setrule(chain="input", protocol="tcp", target="drop")
+
+    def test_report(self):
+        _report = self.blacksalt.analyze()
+        self.assertEqual(_report["shadowed"], [(2, 1)])
+        self.assertEqual(_report["redundant"], [(3, 1)])
+        self.assertEqual(_report["correlated"], [(4, 1), (5, 4)])
+        self.assertEqual(_report["generalization"], [(6, 1)])
+        self.assertEqual(len(self.blacksalt.rules), 6)
+
+    def test_prune(self):
+        self.blacksalt.analyze(prune=True)
+        self.assertEqual([_rule.generate().strip() for _rule in self.blacksalt.rules], [
+            "-A INPUT -p tcp --dport 22 -j ACCEPT",
+            "-A INPUT -s 10.0.0.0/8 -j DROP",
+            "-A INPUT -p tcp --dport 80 -j ACCEPT",
+            "-A INPUT -p tcp -j DROP"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,48 @@
+"""
+collapsesets() runs and targets
+"""
+
+import unittest
+
+from blacksalt import BlackSalt
+
+_OVERLAPPING = ["10.0.0.0/24"] + ["10.0.0.%d" % _host for _host in range(8)]
+_DISJOINT = ["10.0.%d.0/24" % _net for _net in range(9)]
+
+
+def _collapsed(subnets, target):
+    _blacksalt = BlackSalt(printmode=False, backend="restore")
+    _blacksalt.setrule(chain="input", subnet="192.168.0.0/16", target="drop")
+    for _subnet in subnets:
+        _blacksalt.setrule(chain="input", subnet=_subnet, target=target)
+    return _blacksalt, _blacksalt.collapsesets(minsize=8)
+
+
+class TestCollapseSets(unittest.TestCase):
+    def test_overlapping_verdicts_collapsed(self):
+        _blacksalt, _removed = _collapsed(_OVERLAPPING, "accept")
+        self.assertEqual(_removed, 8)
+        self.assertEqual(list(_blacksalt.sets.values()), [["10.0.0.0/24"]])
+
+    def test_overlapping_logs_kept_apart(self):
+        _blacksalt, _removed = _collapsed(_OVERLAPPING, "log")
+        #: The hosts don't overlap each other, only the /24 before them
+        self.assertEqual(_removed, 7)
+        self.assertEqual(list(_blacksalt.sets.values()), [["10.0.0.0/29"]])
+        self.assertEqual([_rule.generate().strip() for _rule in _blacksalt.rules][1:], [
+            "-A INPUT -s 10.0.0.0/24 -j LOG",
+            "-A INPUT -m set --match-set %s src -j LOG" % list(_blacksalt.sets)[0]])
+
+    def test_overlapping_jumps_kept_apart(self):
+        _blacksalt, _removed = _collapsed(_OVERLAPPING, "audit")
+        self.assertEqual(_removed, 7)
+        self.assertEqual(len(_blacksalt.rules), 3)
+
+    def test_disjoint_logs_collapsed(self):
+        _blacksalt, _removed = _collapsed(_DISJOINT, "log")
+        self.assertEqual(_removed, 8)
+        self.assertEqual(list(_blacksalt.sets.values()), [["10.0.0.0/21", "10.0.8.0/24"]])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+"""
+compiletree() sub-chain names
+"""
+
+import unittest
+
+from blacksalt import BlackSalt, Rule
+
+
+def _long(chains, blacksalt=None, network=10):
+    _blacksalt = blacksalt or BlackSalt(printmode=False, backend="restore")
+    for _chain in chains:
+        for _index in range(40):
+            _blacksalt.setrule(chain=_chain, protocol=["tcp", "udp"][_index % 2],
+                               subnet="%d.%d.0.0/16" % (network, _index), dst=1000 + _index, target="accept")
+    return _blacksalt
+
+
+def _created(blacksalt):
+    return [_rule.split()[1] for _rule in blacksalt.rules if not isinstance(_rule, Rule) and _rule.startswith("-N ")]
+
+
+class TestSubChainNames(unittest.TestCase):
+    def test_compiled_again_after_more_rules(self):
+        _blacksalt = _long(["input"])
+        self.assertTrue(_blacksalt.compiletree(minrules=4))
+        _first = _created(_blacksalt)
+        _long(["input"], _blacksalt, 172)
+        self.assertTrue(_blacksalt.compiletree(minrules=4))
+        _names = _created(_blacksalt)
+        self.assertEqual(len(_names), len(set(_names)))
+        self.assertEqual(_names[:len(_first)], _first)
+
+    def test_long_chains_with_a_common_prefix(self):
+        _chains = ["customer-traffic-alpha-in", "customer-traffic-bravo-in"]
+        _blacksalt = _long(_chains)
+        _count = _blacksalt.compiletree(minrules=4)
+        _names = _created(_blacksalt)
+        self.assertEqual(len(_names), _count)
+        self.assertEqual(len(_names), len(set(_names)))
+        self.assertFalse(set(_names) & set(_chains))
+        self.assertTrue(all(len(_name) <= 28 for _name in _names))
+
+    def test_existing_chain_names_skipped(self):
+        _blacksalt = _long(["input"])
+        _blacksalt.setrule(chain="bs-input-1", protocol="tcp", dst=22, target="accept")
+        _blacksalt.compiletree(chains=["INPUT"], minrules=4)
+        self.assertNotIn("bs-input-1", _created(_blacksalt))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+diff() and _diffchain() operations
+"""
+
+import unittest
+from StringIO import StringIO
+
+from blacksalt import BlackSalt, _diffchain
+
+_SAVE = """# Generated by iptables-save v1.4.21
+*filter
+:INPUT DROP [0:0]
+:FORWARD ACCEPT [0:0]
+:OUTPUT ACCEPT [0:0]
+-A INPUT -s 10.0.0.0/24 -j ACCEPT
+-A INPUT -s 10.1.0.0/24 -p tcp -m tcp --dport 22 -j ACCEPT
+-A INPUT -s 10.2.0.5/32 -j DROP
+-A INPUT -s 10.0.1.0/255.0.255.0 -j DROP
+-A INPUT -m state --state RELATED,ESTABLISHED -j ACCEPT
+COMMIT
+"""
+
+
+def _run(chain, old, ops):
+    """
+    The rule specs of a chain after running the operations in order
+    """
+    _specs = list(old)
+    for _op in ops:
+        _words = _op.split(" ", 3)
+        _chain, _position = _words[1], int(_words[2]) - 1
+        assert _chain == chain
+        if _words[0] == "-R":
+            _specs[_position] = _words[3]
+        elif _words[0] == "-I":
+            _specs.insert(_position, _words[3])
+        else:
+            del _specs[_position]
+    return _specs
+
+
+class TestDiffChain(unittest.TestCase):
+    def test_positions(self):
+        _old = ["-s 10.0.0.%d -j ACCEPT" % _index for _index in range(1, 5)]
+        _new = [_old[0], "-s 10.0.0.9 -j ACCEPT", _old[1], _old[2], _old[3]]
+        self.assertEqual(_diffchain("INPUT", _old, _new), ["-I INPUT 2 -s 10.0.0.9 -j ACCEPT"])
+        self.assertEqual(_diffchain("INPUT", _new, _old), ["-D INPUT 2"])
+        _changed = list(_old)
+        _changed[2] = "-s 10.0.0.3 -j DROP"
+        self.assertEqual(_diffchain("INPUT", _old, _changed), ["-R INPUT 3 -s 10.0.0.3 -j DROP"])
+
+    def test_several_inserts_and_deletes(self):
+        _old = ["-s 10.0.0.%d -j ACCEPT" % _index for _index in range(1, 11)]
+        _new = ["-s 10.0.1.1 -j ACCEPT"] + _old[:2] + _old[3:5] + ["-s 10.0.1.2 -j DROP", "-s 10.0.1.3 -j DROP"] \
+            + _old[6:8] + ["-s 10.0.1.4 -j ACCEPT"]
+        _ops = _diffchain("INPUT", _old, _new)
+        self.assertEqual(_run("INPUT", _old, _ops), _new)
+        self.assertEqual(_ops, ["-I INPUT 1 -s 10.0.1.1 -j ACCEPT", "-D INPUT 4", "-R INPUT 6 -s 10.0.1.2 -j DROP",
+                                "-I INPUT 7 -s 10.0.1.3 -j DROP", "-R INPUT 10 -s 10.0.1.4 -j ACCEPT", "-D INPUT 11"])
+        self.assertEqual(_run("INPUT", _new, _diffchain("INPUT", _new, _old)), _old)
+
+
+class TestDiff(unittest.TestCase):
+    def _blacksalt(self):
+        _blacksalt = BlackSalt(printmode=False, backend="restore")
+        _blacksalt.policy("input", "drop")
+        _blacksalt.setrule(chain="input", subnet="10.0.0.0/255.255.255.0", target="accept")
+        _blacksalt.setrule(chain="input", subnet="10.1.0.5/24", protocol="tcp", dst=22, target="accept")
+        _blacksalt.setrule(chain="input", subnet="10.2.0.5", target="drop")
+        _blacksalt.setrule(chain="input", subnet="10.3.1.0/255.0.255.0", target="drop")
+        _blacksalt.setrule(chain="input", state=["established", "related"], target="accept")
+        return _blacksalt
+
+    def test_unchanged_against_iptables_save(self):
+        self.assertEqual(self._blacksalt().diff(StringIO(_SAVE)), [])
+
+    def test_one_rule_changed(self):
+        _blacksalt = self._blacksalt()
+        _blacksalt.setrule(chain="input", protocol="tcp", dst=80, target="accept")
+        self.assertEqual(_blacksalt.diff(StringIO(_SAVE)), ["-I INPUT 6 -p tcp --dport 80 -j ACCEPT"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,83 @@
+"""
+fastpath() hoisting and verdicts
+"""
+
+import unittest
+
+from blacksalt import STATES, BlackSalt, MatchSpace, _chaintable, _statetrace
+
+
+def _restore(blacksalt):
+    return [_line for _line in blacksalt.iter_restore() if _line.startswith("-A ")]
+
+
+def _traces(blacksalt):
+    _chains, _policies = _chaintable(blacksalt.rules)
+    _accepting = dict((_state, set()) for _state in STATES)
+    _spaces = [MatchSpace(_rule) for _line, _rule in _chains["INPUT"]]
+    return dict((_state, _statetrace(_spaces, _state, _policies.get("INPUT", "ACCEPT"), _accepting))
+                for _state in STATES)
+
+
+def _barriers():
+    _blacksalt = BlackSalt(printmode=False, backend="restore")
+    _blacksalt.policy("input", "drop")
+    _blacksalt.setrule(chain="input", protocol="tcp", dst=22, state="new", target="accept")
+    _blacksalt.setrule(chain="input", subnet="10.0.0.0/8", target="drop")
+    _blacksalt.setrule(chain="input", target="log")
+    _blacksalt.setrule(chain="input", state=["established", "related"], target="accept")
+    return _blacksalt
+
+
+def _hoistable():
+    _blacksalt = BlackSalt(printmode=False, backend="restore")
+    _blacksalt.policy("input", "drop")
+    _blacksalt.setrule(chain="input", subnet="10.0.0.0/8", target="drop")
+    _blacksalt.setrule(chain="input", protocol="tcp", dst=22, state=["new", "established"], target="accept")
+    _blacksalt.setrule(chain="input", protocol="tcp", dst=80, state="established", target="accept")
+    _blacksalt.setrule(chain="input", protocol="tcp", dst=443, state="new", target="accept")
+    _blacksalt.setrule(chain="input", state=["established", "related"], target="accept")
+    return _blacksalt
+
+
+class TestFastPath(unittest.TestCase):
+    def test_barriers_ahead_of_the_accepts(self):
+        _blacksalt = _barriers()
+        _before = _restore(_blacksalt)
+        _report = _blacksalt.fastpath()
+        self.assertEqual(_report["chains"], {})
+        self.assertEqual(_restore(_blacksalt), _before)
+
+    def test_hoisted(self):
+        _blacksalt = _hoistable()
+        _report = _blacksalt.fastpath()
+        self.assertEqual(_report["chains"]["INPUT"],
+                         {"states": ["ESTABLISHED", "RELATED"], "line": 3, "stripped": 1, "removed": 2})
+        self.assertEqual(_restore(_blacksalt), [
+            "-A INPUT -s 10.0.0.0/8 -j DROP",
+            "-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT",
+            "-A INPUT -p tcp --dport 22 -m state --state NEW -j ACCEPT",
+            "-A INPUT -p tcp --dport 443 -m state --state NEW -j ACCEPT"])
+        self.assertLess(_report["tests"]["INPUT"][1], _report["tests"]["INPUT"][0])
+
+    def test_rule_stores(self):
+        for _rulestore in ["list", "table", "indexed"]:
+            _blacksalt = BlackSalt(printmode=False, backend="restore", rulestore=_rulestore)
+            for _index in range(5):
+                _blacksalt.setrule(chain="input", subnet="10.%d.0.0/16" % _index, target="accept")
+            _blacksalt.setrule(chain="input", state=["established", "related"], target="accept")
+            _report = _blacksalt.fastpath()
+            self.assertEqual(_report["chains"]["INPUT"]["line"], 1)
+            self.assertEqual(_restore(_blacksalt)[0], "-A INPUT -m state --state ESTABLISHED,RELATED -j ACCEPT")
+            self.assertEqual(len(_restore(_blacksalt)), 6)
+
+    def test_same_verdicts_for_every_state(self):
+        for _build in [_barriers, _hoistable]:
+            _blacksalt = _build()
+            _before = _traces(_blacksalt)
+            _blacksalt.fastpath()
+            self.assertEqual(_traces(_blacksalt), _before)
+
+
+if __name__ == "__main__":
+    unittest.main()
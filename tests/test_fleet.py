@@ -0,0 +1,44 @@
+"""
+compilefleet() host handling
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from blacksalt import BlackSalt, compilefleet
+
+
+def _builder(port=22, **_common):
+    _blacksalt = BlackSalt(printmode=False, backend="restore")
+    _blacksalt.setrule(chain="input", protocol="tcp", dst=port, target="accept")
+    return _blacksalt
+
+
+class TestHostNames(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.outdir = os.path.join(self.directory, "out")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_names_outside_outdir_fail(self):
+        _hosts = [("web1", _builder, {}), ("../escaped", _builder, {}), ("/etc/escaped", _builder, {}),
+                  ("a/b", _builder, {}), ("..", _builder, {})]
+        _report = compilefleet(_hosts, self.outdir, processes=1)
+        self.assertEqual(_report["compiled"], 1)
+        self.assertEqual(_report["failed"], 4)
+        for _name in ["../escaped", "/etc/escaped", "a/b", ".."]:
+            self.assertIn("outside outdir", _report["hosts"][_name]["error"])
+        self.assertEqual(os.listdir(self.directory), ["out"])
+        self.assertEqual(os.listdir(self.outdir), ["web1"])
+
+    def test_names_in_order(self):
+        _report = compilefleet([("../x", _builder, {}), ("web1", _builder, {"port": 80})], self.outdir, processes=1)
+        self.assertEqual(list(_report["hosts"]), ["../x", "web1"])
+
+
+if __name__ == "__main__":
+    unittest.main()
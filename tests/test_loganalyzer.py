@@ -0,0 +1,48 @@
+"""
+LogAnalyzer's reading of netfilter LOG lines
+"""
+
+import unittest
+
+from blacksalt import BlackSalt, LogAnalyzer
+
+_FIELDS = "IN=eth0 OUT= MAC=52:54:00:12:34:56 SRC=%s DST=198.51.100.7 LEN=60 TTL=52 ID=1 DF PROTO=TCP SPT=40000 " \
+          "DPT=22 WINDOW=29200 SYN URGP=0 \n"
+
+
+class TestPrefixes(unittest.TestCase):
+    def _prefixes(self, lines, blacksalt=None):
+        _analyzer = LogAnalyzer(blacksalt)
+        _analyzer.feed(lines)
+        return dict((_prefix, (_rule, _lines)) for _prefix, _rule, _lines, _sources
+                    in _analyzer.summary()["prefixes"])
+
+    def test_bracketed_prefixes(self):
+        _prefixes = self._prefixes([
+            "Oct 18 12:00:01 host kernel: [12345.678901] [UFW BLOCK] " + _FIELDS % "192.0.2.1",
+            "Oct 18 12:00:02 host kernel: [UFW BLOCK] " + _FIELDS % "192.0.2.2",
+            "[   12.5] [UFW BLOCK] " + _FIELDS % "192.0.2.3",
+            "Oct 18 12:00:03 host kernel: [12345.7] DROP [ssh] " + _FIELDS % "192.0.2.4",
+        ])
+        self.assertEqual(_prefixes["[UFW BLOCK]"][1], 3)
+        self.assertEqual(_prefixes["DROP [ssh]"][1], 1)
+
+    def test_plain_prefixes(self):
+        _prefixes = self._prefixes([
+            "Oct 18 12:00:01 host kernel: [12345.678901] DROP-IN: " + _FIELDS % "192.0.2.1",
+            "Oct 18 12:00:02 host kernel: DROP-IN: " + _FIELDS % "192.0.2.2",
+            "Oct 18 12:00:03 host kernel: [1.0] " + _FIELDS % "192.0.2.3",
+        ])
+        self.assertEqual(_prefixes["DROP-IN:"][1], 2)
+        self.assertEqual(_prefixes[""][1], 1)
+
+    def test_attributed_to_rules(self):
+        _blacksalt = BlackSalt(printmode=False)
+        _blacksalt.setrule(chain="input", target='log --log-prefix "[UFW BLOCK] "')
+        _prefixes = self._prefixes(["Oct 18 12:00:01 host kernel: [1.5] [UFW BLOCK] " + _FIELDS % "192.0.2.1"],
+                                   _blacksalt)
+        self.assertIs(_prefixes["[UFW BLOCK]"][0], _blacksalt.rules[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,44 @@
+"""
+The nft backend's grouping of rules into sets and verdict maps
+"""
+
+import unittest
+
+from blacksalt import BlackSalt
+
+
+def _nftrules(rules, chains=()):
+    _blacksalt = BlackSalt(printmode=False, backend="nft")
+    for _chain in chains:
+        _blacksalt.rules.append("-N %s" % _chain)
+    for _rule in rules:
+        _blacksalt.setrule(**_rule)
+    return [_line for _line in _blacksalt.nftables() if _line.startswith("add rule")]
+
+
+class TestSets(unittest.TestCase):
+    def test_overlapping_accepts_share_a_set(self):
+        _lines = _nftrules([{"chain": "input", "subnet": "10.0.0.0/8", "target": "accept"},
+                            {"chain": "input", "subnet": "10.1.0.0/16", "target": "accept"}])
+        self.assertEqual(len(_lines), 1)
+
+    def test_overlapping_logs_stay_apart(self):
+        _lines = _nftrules([{"chain": "input", "subnet": "10.0.0.0/8", "target": "log"},
+                            {"chain": "input", "subnet": "10.1.0.0/16", "target": "log"}])
+        self.assertEqual(len(_lines), 2)
+        self.assertIn("10.1.0.0/16", _lines[1])
+
+    def test_overlapping_jumps_stay_apart(self):
+        _lines = _nftrules([{"chain": "input", "subnet": "10.0.0.0/8", "target": "web"},
+                            {"chain": "input", "subnet": "10.1.0.0/16", "target": "web"}], chains=["web"])
+        self.assertEqual(len(_lines), 2)
+
+    def test_disjoint_logs_share_a_set(self):
+        _lines = _nftrules([{"chain": "input", "subnet": "10.0.0.0/16", "target": "log"},
+                            {"chain": "input", "subnet": "10.1.0.0/16", "target": "log"}])
+        self.assertEqual(len(_lines), 1)
+        self.assertIn("{ 10.0.0.0/16, 10.1.0.0/16 }", _lines[0])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,50 @@
+"""
+reorder() by packet counters
+"""
+
+import unittest
+from StringIO import StringIO
+
+from blacksalt import BlackSalt
+
+_COUNTERS = """Chain INPUT (policy DROP 10 packets, 600 bytes)
+    pkts      bytes target     prot opt in     out     source               destination
+       1       60 ACCEPT     tcp  --  *      *       0.0.0.0/0            0.0.0.0/0            tcp dpt:22
+     100     6000 ACCEPT     tcp  --  *      *       0.0.0.0/0            0.0.0.0/0            tcp dpt:80
+      50     3000 ACCEPT     udp  --  *      *       0.0.0.0/0            0.0.0.0/0            udp dpt:53
+    1000    60000 DROP       tcp  --  *      *       0.0.0.0/0            0.0.0.0/0
+
+Chain FORWARD (policy ACCEPT 0 packets, 0 bytes)
+    pkts      bytes target     prot opt in     out     source               destination
+
+Chain OUTPUT (policy ACCEPT 0 packets, 0 bytes)
+    pkts      bytes target     prot opt in     out     source               destination
+"""
+
+
+class TestReorder(unittest.TestCase):
+    def setUp(self):
+        self.blacksalt = BlackSalt(printmode=False, backend="restore")
+        self.blacksalt.setrule(chain="input", protocol="tcp", dst=22, target="accept")
+        self.blacksalt.setrule(chain="input", protocol="tcp", dst=80, target="accept")
+        self.blacksalt.setrule(chain="input", protocol="udp", dst=53, target="accept")
+        self.blacksalt.setrule(chain="input", protocol="tcp", target="drop")
+
+    def test_busiest_first_without_passing_overlaps(self):
+        _report = self.blacksalt.reorder(StringIO(_COUNTERS))
+        self.assertEqual([_rule.generate().strip() for _rule in self.blacksalt.rules], [
+            "-A INPUT -p tcp --dport 80 -j ACCEPT",
+            "-A INPUT -p udp --dport 53 -j ACCEPT",
+            "-A INPUT -p tcp --dport 22 -j ACCEPT",
+            "-A INPUT -p tcp -j DROP"])
+        _before, _after = _report["INPUT"]
+        self.assertLess(_after, _before)
+
+    def test_counters_not_matching_the_rules(self):
+        _before = list(self.blacksalt.rules)
+        self.blacksalt.reorder({"INPUT": (10, [1, 100, 50])})
+        self.assertEqual(list(self.blacksalt.rules), _before)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,33 @@
+"""
+iptables-restore output
+"""
+
+import sys
+import unittest
+from StringIO import StringIO
+
+from blacksalt import BlackSalt, Rule
+
+
+class TestRuleWithoutChain(unittest.TestCase):
+    def setUp(self):
+        self.stdout, self.stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+
+    def tearDown(self):
+        sys.stdout, sys.stderr = self.stdout, self.stderr
+
+    def test_skipped_on_stderr(self):
+        _blacksalt = BlackSalt(printmode=False, backend="restore")
+        _blacksalt.setrule(chain="input", protocol="tcp", dst=22, target="accept")
+        _blacksalt.rules.append(Rule(protocol="tcp", dst=80, target="accept"))
+        _output = StringIO()
+        _blacksalt.write(_output)
+        self.assertIn("-A INPUT -p tcp --dport 22 -j ACCEPT\n", _output.getvalue())
+        self.assertNotIn("80", _output.getvalue())
+        self.assertEqual(sys.stdout.getvalue(), "")
+        self.assertIn("Skipping rule without a chain", sys.stderr.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,27 @@
+"""
+Rule validation and rendering
+"""
+
+import unittest
+
+from blacksalt import MatchSpace, Rule, _nftrule
+
+
+class TestICMP(unittest.TestCase):
+    def test_echo_reply_is_rendered(self):
+        _rule = Rule(chain="input", protocol="icmp", icmp=0, target="accept")
+        self.assertEqual(_rule.generate(), " -A INPUT -p icmp --icmp-type 0 -j ACCEPT")
+
+    def test_echo_reply_is_matched(self):
+        _rule = Rule(chain="input", protocol="icmp", icmp=0, target="accept")
+        self.assertEqual(MatchSpace(_rule).icmp, 0)
+        _matches = _nftrule(_rule, {}, {})[0]
+        self.assertIn(("icmp type", "0", (0, 0)), _matches)
+
+    def test_no_icmp_type(self):
+        _rule = Rule(chain="input", protocol="icmp", target="accept")
+        self.assertEqual(_rule.generate(), " -A INPUT -p icmp -j ACCEPT")
+
+
+if __name__ == "__main__":
+    unittest.main()
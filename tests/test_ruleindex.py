@@ -0,0 +1,92 @@
+"""
+RuleIndex ids and queries
+"""
+
+import random
+import unittest
+
+from blacksalt import Rule, RuleIndex, parsesubnet
+
+
+def _accept(port):
+    return Rule(chain="input", protocol="tcp", dst=port, target="accept")
+
+
+class TestIds(unittest.TestCase):
+    def setUp(self):
+        self.index = RuleIndex()
+        self.rules = [_accept(_number) for _number in range(1, 6)]
+        self.ids = [self.index.append(_rule) for _rule in self.rules]
+
+    def test_insert(self):
+        _first = self.index.insertbefore(self.ids[2], _accept(100))
+        _second = self.index.insertafter(self.ids[2], _accept(101))
+        self.index.insert(0, _accept(102))
+        self.assertEqual(len(set(self.ids + [_first, _second])), 7)
+        for _id, _rule in zip(self.ids, self.rules):
+            self.assertIs(self.index.get(_id), _rule)
+        self.assertEqual([self.index.position(_id) for _id in self.ids], [1, 2, 4, 6, 7])
+        self.assertEqual(self.index.position(_first), 3)
+
+    def test_delete(self):
+        self.index.delete(self.ids[1])
+        self.assertRaises(IndexError, self.index.get, self.ids[1])
+        self.assertEqual([self.index.position(_id) for _id in self.ids[2:]], [1, 2, 3])
+        self.assertNotIn(self.ids[1], [self.index.append(_accept(_port)) for _port in range(10)])
+
+    def test_replace(self):
+        _new = _accept(200)
+        self.assertIs(self.index.replace(self.ids[3], _new), self.rules[3])
+        self.assertIs(self.index.get(self.ids[3]), _new)
+        self.assertEqual(self.index.position(self.ids[3]), 3)
+        self.assertEqual(self.index.query(dport=200), [self.ids[3]])
+        self.assertEqual(self.index.query(dport=4), [])
+
+    def test_reset_keeps_ids(self):
+        self.index.reset(list(reversed(list(self.index))))
+        self.assertEqual(list(self.index.ids()), list(reversed(self.ids)))
+
+    def test_reset_doesnt_reissue_deleted_ids(self):
+        self.index.delete(self.ids[-1])
+        self.index.reset(list(self.index))
+        self.assertNotIn(self.index.append(_accept(6)), self.ids)
+
+
+class TestQuery(unittest.TestCase):
+    def setUp(self):
+        _random = random.Random(20)
+        self.index = RuleIndex()
+        self.index.blocksize = 8
+        for _count in range(300):
+            self.index.append(Rule(
+                chain=_random.choice(["input", "output", "audit"]), protocol=_random.choice(["tcp", "udp"]),
+                dst=_random.choice([None, 22, 53, 80]), target=_random.choice(["accept", "drop"]),
+                subnet=_random.choice([None, "10.0.0.0/8", "10.%d.0.0/16" % _random.randint(0, 3),
+                                       "10.0.%d.%d" % (_random.randint(0, 3), _random.randint(0, 255)),
+                                       "10.0.0.0/255.0.255.0"])))
+            if _count % 7 == 0:
+                self.index.delete(self.index.at(_random.randrange(len(self.index))))
+
+    def _scan(self, chain=None, protocol=None, dport=None, subnet=None):
+        _ids = []
+        for _id, _rule in self.index.iteritems():
+            if chain is not None and _rule.chain != chain or protocol is not None and _rule.protocol != protocol:
+                continue
+            if dport is not None and _rule.dst_port != dport:
+                continue
+            if subnet is not None:
+                _network, _mask, _form = parsesubnet(subnet)
+                if _rule._network is None or (_rule._network ^ _network) & _rule._mask & _mask:
+                    continue
+            _ids.append(_id)
+        return _ids
+
+    def test_against_a_scan(self):
+        for _criteria in [{"chain": "INPUT"}, {"chain": "audit", "protocol": "udp"}, {"dport": 22},
+                          {"subnet": "10.0.0.0/8"}, {"subnet": "10.1.0.0/16"}, {"subnet": "10.0.2.0/24"},
+                          {"subnet": "10.0.1.7", "protocol": "tcp"}, {"subnet": "10.5.0.0/16", "dport": 80}]:
+            self.assertEqual(self.index.query(**_criteria), self._scan(**_criteria), _criteria)
+
+
+if __name__ == "__main__":
+    unittest.main()
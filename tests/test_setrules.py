@@ -0,0 +1,93 @@
+"""
+setrules() input forms and error reports
+"""
+
+import unittest
+from StringIO import StringIO
+
+from blacksalt import SUBNET_NETMASK, BlackSalt, RuleError, _bulksubnets, parsesubnet
+
+_RECORDS = [
+    {"chain": "input", "protocol": "tcp", "dst": 22, "subnet": "10.0.0.1", "target": "accept"},
+    {"chain": "input", "protocol": "udp", "dst": 53, "subnet": "10.0.0.0/24", "target": "accept"},
+    {"chain": "output", "protocol": "tcp", "dst": 80, "subnet": "10.0.1.0/255.255.255.0", "target": "drop"},
+    {"chain": "forward", "protocol": "icmp", "icmp": 8, "state": "new,established", "target": "accept"},
+    {"chain": "input", "interface": "eth0", "direction": "in", "target": "log"},
+]
+_CSV = """chain,protocol,dst,subnet,icmp,state,interface,direction,target
+input,tcp,22,10.0.0.1,,,,,accept
+input,udp,53,10.0.0.0/24,,,,,accept
+output,tcp,80,10.0.1.0/255.255.255.0,,,,,drop
+forward,icmp,,,8,"new,established",,,accept
+input,,,,,,eth0,in,log
+"""
+
+
+def _generated(blacksalt):
+    return [_rule.generate() for _rule in blacksalt.rules]
+
+
+class TestInputs(unittest.TestCase):
+    def test_same_rules(self):
+        _expected = BlackSalt(printmode=False)
+        for _record in _RECORDS:
+            _record = dict(_record)
+            if "interface" in _record:
+                _record["interface"] = {"name": _record.pop("interface"), "direction": _record.pop("direction")}
+            _expected.setrule(**_record)
+
+        _records = BlackSalt(printmode=False)
+        _records.setrules(_RECORDS)
+        _columns = BlackSalt(printmode=False)
+        _options = sorted(set().union(*_RECORDS))
+        _columns.setrules(dict((_option, [_record.get(_option) for _record in _RECORDS]) for _option in _options))
+        _csv = BlackSalt(printmode=False)
+        _csv.setrules(StringIO(_CSV))
+        for _blacksalt in [_records, _columns, _csv]:
+            self.assertEqual(_generated(_blacksalt), _generated(_expected))
+            self.assertEqual([_rule.warning for _rule in _blacksalt.rules],
+                             [_rule.warning for _rule in _expected.rules])
+
+
+class TestErrors(unittest.TestCase):
+    def test_rows_reported(self):
+        _blacksalt = BlackSalt(printmode=False)
+        _report = _blacksalt.setrules([
+            {"chain": "input", "protocol": "tcp", "dst": 22, "target": "accept"},
+            {"chain": "input", "protocol": "tcp", "dst": 70000, "target": "accept"},
+            {"chain": "input", "subnet": "10.0.0.300", "target": "accept"},
+            {"chain": "input", "protocol": "tcp", "dst": 80, "target": "accept"},
+            {"chain": "input", "protocol": "nope", "subnet": "10.0.0.0/33", "target": "accept"},
+        ])
+        self.assertEqual(_report["added"], 2)
+        self.assertEqual([(_row, _option) for _row, _option, _message in _report["errors"]],
+                         [(2, "dst"), (3, "subnet"), (5, "protocol"), (5, "subnet")])
+        self.assertIn("0-65535", _report["errors"][0][2])
+        self.assertEqual(_generated(_blacksalt), [" -A INPUT -p tcp --dport 22 -j ACCEPT",
+                                                  " -A INPUT -p tcp --dport 80 -j ACCEPT"])
+
+    def test_csv_rows_count_from_after_the_header(self):
+        _report = BlackSalt(printmode=False).setrules(StringIO("chain,dst,target\ninput,22,accept\ninput,x,accept\n"))
+        self.assertEqual([_error[:2] for _error in _report["errors"]], [(2, "dst")])
+
+
+class TestSubnets(unittest.TestCase):
+    def test_as_parsesubnet(self):
+        _values = ["10.0.0.1", "10.0.0.0/24", "10.0.0.0/0", "10.0.0.0/32", "255.255.255.255", "10.0.0.0/255.255.0.0",
+                   "10.0.0.300", "10.0.0", "10.0.0.1.2", "010.0.0.1", "10.0.0.01", "10.0.0.0/33", "10.0.0.0/",
+                   "a.b.c.d", "", "/24", 10]
+        _parsed = _bulksubnets(_values)
+        for _value in _values:
+            try:
+                _expected = parsesubnet(_value)
+            except (RuleError, AttributeError):
+                _expected = None
+            if _value in _parsed:
+                self.assertEqual(_parsed[_value], _expected, _value)
+            else:
+                #: Left to parsesubnet(), a netmask or an error
+                self.assertTrue(_expected is None or _expected[2] == SUBNET_NETMASK, _value)
+
+
+if __name__ == "__main__":
+    unittest.main()